@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+"""Выгрузка истории комментариев и постов из базы данных в Parquet или CSV.gz для анализа"""
+import argparse
+import importlib.util
+
+from xpom_bot import EXPORT_DIR, export_history
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--format", choices=["parquet", "csv"], default=None,
+                        help="формат выгрузки (по умолчанию parquet, если установлен pyarrow, иначе csv)")
+    parser.add_argument("--output", default=EXPORT_DIR, help=f"каталог для выгрузки (по умолчанию {EXPORT_DIR})")
+    args = parser.parse_args()
+
+    if args.format == "parquet" and importlib.util.find_spec("pyarrow") is None:
+        parser.error("для выгрузки в Parquet установите пакет pyarrow")
+
+    target_dir, files = export_history(args.format, args.output)
+    print(f"📦 Выгрузка сохранена в {target_dir}, файлов: {len(files)}")
+    for file_path in files:
+        print(f"  {file_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+import asyncio
+import os
+
+os.environ.setdefault("VK_TOKEN", "test")
+
+import xpom_bot
+
+
+def test_comment_routed_by_every_matched_keyword(monkeypatch):
+    # Чат 1 без подписок, чат 2 подписан только на «продам»
+    monkeypatch.setattr(xpom_bot, "routing_index",
+                        xpom_bot.RoutingIndex([1, 2], [(2, "keyword", "продам")]))
+    texts = [xpom_bot.normalize_text("продам и купить квартиру")]
+
+    matches = asyncio.run(xpom_bot.match_comments_for_tenants(texts, [(None, ["купить", "продам"])]))
+
+    assert matches == [[(None, "купить", ("купить", "продам"))]]
+    _, _, keywords = matches[0][0]
+    assert xpom_bot.get_comment_chats("g", keywords) == (1, 2)
+
+
+def test_comment_with_unsubscribed_keyword_only(monkeypatch):
+    monkeypatch.setattr(xpom_bot, "routing_index",
+                        xpom_bot.RoutingIndex([1, 2], [(2, "keyword", "продам")]))
+    texts = [xpom_bot.normalize_text("хочу купить квартиру")]
+
+    matches = asyncio.run(xpom_bot.match_comments_for_tenants(texts, [(None, ["купить", "продам"])]))
+
+    assert matches == [[(None, "купить", ("купить",))]]
+    assert xpom_bot.get_comment_chats("g", ("купить",)) == (1,)
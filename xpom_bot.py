@@ -1,28 +1,45 @@
 import vk_api
+import aiohttp
+from aiohttp import web
 import json
 import re
 import logging
 import sqlite3
 import time
 import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import urllib.parse
+import importlib.util
 import sys
+import csv
+import gzip
+import shutil
+import itertools
+import hashlib
+import html
+import bisect
+from collections import deque, OrderedDict
+import weakref
+import tracemalloc
+import signal
+import socket
 from datetime import datetime
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackContext
 from telegram.ext import JobQueue
 from telegram.error import TelegramError, NetworkError
-import requests
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
 import io
-import pandas as pd
 import os
-from openpyxl import Workbook, load_workbook
-from openpyxl.styles import Font, PatternFill, Alignment
-from openpyxl.utils import get_column_letter
 from dotenv import load_dotenv
 
+# Быстрый разбор JSON ответов VK, если установлен orjson
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
 # Загружаем переменные окружения из .env файла
 load_dotenv()
 
@@ -54,10 +71,68 @@ if not VK_TOKEN:
 if not TELEGRAM_TOKEN:
     logger.error("❌ TELEGRAM_TOKEN не найден в переменных окружения! Укажите его в файле .env")
 
-# Глобальная переменная для отслеживания состояния выполнения
-is_checking = False
+# ---------------- Получение обновлений Telegram ----------------
+# polling - опрос серверов Telegram, webhook - Telegram сам присылает обновления на WEBHOOK_URL
+TELEGRAM_MODE = os.getenv("TELEGRAM_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram").strip("/")
+# Telegram передает секрет в заголовке каждого запроса, запросы без него отклоняются
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(TELEGRAM_TOKEN.encode()).hexdigest()
+# Адрес своего сервера Bot API (например, локального для тестов), по умолчанию api.telegram.org
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "").rstrip("/")
+
+# ---------------- База данных и режим работы ----------------
+DB_FILE = os.getenv("DB_FILE", "vk_monitor.db")
+
+# single - один процесс (Telegram + проверка), frontend - только Telegram и доставка уведомлений,
+# scanner - только проверка своей части групп
+WORKER_MODE = os.getenv("WORKER_MODE", "single").lower()
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+WORKER_LEASE_TIMEOUT = int(os.getenv("WORKER_LEASE_TIMEOUT", "60"))
+WORKER_HEARTBEAT_INTERVAL = max(1, WORKER_LEASE_TIMEOUT // 4)
+# Неудачная доставка события из очереди повторяется через OUTBOX_RETRY_DELAY, 2 * OUTBOX_RETRY_DELAY, ...
+# секунд, после OUTBOX_MAX_ATTEMPTS попыток событие остается в очереди как недоставленное
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+OUTBOX_RETRY_DELAY = 60
+OUTBOX_FAILED_RETENTION_DAYS = 7
+# Комментарий, взятый в отправку процессом, который затем упал, снова доступен через столько секунд
+NOTIFY_CLAIM_TIMEOUT = 600
+
+# Telegram обслуживает только один экземпляр (ведущий), остальные ждут освобождения аренды
+LEADER_LEASE_TIMEOUT = int(os.getenv("LEADER_LEASE_TIMEOUT", "30"))
+LEADER_HEARTBEAT_INTERVAL = max(1, LEADER_LEASE_TIMEOUT // 3)
+LEADER_ID = f"{WORKER_ID}-{os.urandom(4).hex()}"
+
+# Многопользовательский режим: у каждого чата Telegram свои группы и ключевые слова,
+# общая группа ВК при этом загружается один раз за проверку
+MULTI_TENANT = os.getenv("MULTI_TENANT", "0") == "1"
+
+# Одновременно выполняется только одна проверка, остальные ручные проверки ждут своей очереди
+scan_lock = asyncio.Lock()
 bot_start_time = None
 
+# Корректная остановка: сколько секунд ждать завершения текущей проверки после SIGTERM
+SHUTDOWN_TIMEOUT = int(os.getenv("SHUTDOWN_TIMEOUT", "20"))
+shutdown_requested = False
+current_scan_task = None
+
+# После каждой порции постов сохраняется контрольная точка проверки
+SCAN_POSTS_PER_BATCH = 10
+
+# ---------------- Параметры проверки ----------------
+CHECK_INTERVAL = int(os.getenv("CHECK_INTERVAL", "600"))
+# Проверка, не уложившаяся в столько секунд, прерывается сторожевым таймером (0 - без ограничения)
+SCAN_DEADLINE = int(os.getenv("SCAN_DEADLINE", "1800"))
+# VK возвращает не больше 100 постов и комментариев за запрос
+POSTS_COUNT = max(1, min(100, int(os.getenv("POSTS_COUNT", "20"))))
+COMMENTS_COUNT = max(1, min(100, int(os.getenv("COMMENTS_COUNT", "100"))))
+# Посты старше стольких дней не проверяются (0 - без ограничения)
+MAX_POST_AGE_DAYS = int(os.getenv("MAX_POST_AGE_DAYS", "0"))
+# Закрепленные посты: all - проверять всегда, age - как обычные посты (с учетом возраста), skip - не проверять
+PINNED_POSTS = os.getenv("PINNED_POSTS", "age").lower()
+
 # ---------------- Excel файлы ----------------
 POSTS_EXCEL_FILE = "checked_posts.xlsx"
 COMMENTS_EXCEL_FILE = "found_comments.xlsx"
@@ -70,6 +145,9 @@ def format_excel_file(file_path, sheet_name="Sheet1"):
         if not os.path.exists(file_path):
             return False
 
+        from openpyxl import load_workbook
+        from openpyxl.styles import Font, PatternFill, Alignment
+
         # Загружаем workbook
         wb = load_workbook(file_path)
         ws = wb[sheet_name]
@@ -125,68 +203,81 @@ def format_excel_file(file_path, sheet_name="Sheet1"):
         return False
 
 
+POSTS_EXCEL_HEADERS = [
+    'Ссылка на группу',
+    'Ссылка на пост',
+    'Текст поста (первые 50 символов)',
+    'Дата проверки'
+]
+COMMENTS_EXCEL_HEADERS = [
+    'Имя пользователя',
+    'Ссылка на страницу пользователя',
+    'Город',
+    'Текст комментария',
+    'Ссылка на комментарий',
+    'Найденное ключевое слово',
+    'Дата обнаружения'
+]
+
+
+def create_excel_file(file_path, headers):
+    """Создает Excel файл с заголовками и форматированием"""
+    from openpyxl import Workbook
+
+    wb = Workbook()
+    ws = wb.active
+    ws.title = "Sheet1"
+    ws.append(headers)
+    wb.save(file_path)
+    format_excel_file(file_path)
+
+
 def init_excel_files():
     """Инициализирует Excel файлы с заголовками и форматированием"""
     # Файл для проверенных постов
     if not os.path.exists(POSTS_EXCEL_FILE):
-        df_posts = pd.DataFrame(columns=[
-            'Ссылка на группу',
-            'Ссылка на пост',
-            'Текст поста (первые 50 символов)',
-            'Дата проверки'
-        ])
-        df_posts.to_excel(POSTS_EXCEL_FILE, index=False, engine='openpyxl')
-        format_excel_file(POSTS_EXCEL_FILE)
+        create_excel_file(POSTS_EXCEL_FILE, POSTS_EXCEL_HEADERS)
         logger.info("✅ Создан Excel файл для проверенных постов")
 
     # Файл для найденных комментариев
     if not os.path.exists(COMMENTS_EXCEL_FILE):
-        df_comments = pd.DataFrame(columns=[
-            'Имя пользователя',
-            'Ссылка на страницу пользователя',
-            'Город',
-            'Текст комментария',
-            'Ссылка на комментарий',
-            'Найденное ключевое слово',
-            'Дата обнаружения'
-        ])
-        df_comments.to_excel(COMMENTS_EXCEL_FILE, index=False, engine='openpyxl')
-        format_excel_file(COMMENTS_EXCEL_FILE)
+        create_excel_file(COMMENTS_EXCEL_FILE, COMMENTS_EXCEL_HEADERS)
         logger.info("✅ Создан Excel файл для найденных комментариев")
 
 
-def add_post_to_excel(group_domain, group_id, post_id, post_text):
-    """Добавляет проверенный пост в Excel файл"""
-    try:
-        # Читаем существующий файл
-        df = pd.read_excel(POSTS_EXCEL_FILE, engine='openpyxl')
-
-        # Проверяем, нет ли уже этого поста
-        post_exists = ((df['Ссылка на пост'] == f"https://vk.com/wall-{group_id}_{post_id}")).any()
-
-        if not post_exists:
-            # Формируем данные для нового поста
-            group_link = f"https://vk.com/{group_domain}"
-            post_link = f"https://vk.com/wall-{group_id}_{post_id}"
-            post_preview = post_text[:50] + "..." if len(post_text) > 50 else post_text
-            check_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-            new_post = {
-                'Ссылка на группу': group_link,
-                'Ссылка на пост': post_link,
-                'Текст поста (первые 50 символов)': post_preview,
-                'Дата проверки': check_date
-            }
+def append_excel_row(file_path, row, key_column):
+    """
+    Добавляет строку в конец Excel файла, если в колонке key_column (номер с 1)
+    еще нет такого же значения. Форматирование файла сохраняется.
+    """
+    from openpyxl import load_workbook
+
+    wb = load_workbook(file_path)
+    ws = wb.active
+    key_value = row[key_column - 1]
 
-            # Добавляем новую строку
-            df = pd.concat([df, pd.DataFrame([new_post])], ignore_index=True)
+    for (value,) in ws.iter_rows(min_row=2, min_col=key_column, max_col=key_column, values_only=True):
+        if value == key_value:
+            wb.close()
+            return False
 
-            # Сохраняем обратно в Excel
-            df.to_excel(POSTS_EXCEL_FILE, index=False, engine='openpyxl')
+    ws.append(row)
+    ws.auto_filter.ref = ws.dimensions
+    wb.save(file_path)
+    return True
 
-            # Форматируем файл после добавления данных
-            format_excel_file(POSTS_EXCEL_FILE)
 
+def add_post_to_excel(group_domain, group_id, post_id, post_text):
+    """Добавляет проверенный пост в Excel файл"""
+    try:
+        # Формируем данные для нового поста
+        group_link = f"https://vk.com/{group_domain}"
+        post_link = f"https://vk.com/wall-{group_id}_{post_id}"
+        post_preview = post_text[:50] + "..." if len(post_text) > 50 else post_text
+        check_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+        # Добавляем строку, если этого поста еще нет
+        if append_excel_row(POSTS_EXCEL_FILE, [group_link, post_link, post_preview, check_date], key_column=2):
             logger.info(f"✅ Добавлен пост в Excel: {group_domain} - {post_id}")
             return True
         return False
@@ -199,33 +290,19 @@ def add_post_to_excel(group_domain, group_id, post_id, post_text):
 def add_comment_to_excel(comment_data):
     """Добавляет найденный комментарий в Excel файл"""
     try:
-        # Читаем существующий файл
-        df = pd.read_excel(COMMENTS_EXCEL_FILE, engine='openpyxl')
-
-        # Проверяем, нет ли уже этого комментария
-        comment_exists = ((df['Ссылка на комментарий'] == comment_data['comment_link'])).any()
-
-        if not comment_exists:
-            # Подготавливаем данные для Excel в новом порядке
-            excel_data = {
-                'Имя пользователя': comment_data['user_name'],
-                'Ссылка на страницу пользователя': comment_data['user_link'],
-                'Город': comment_data['city'],
-                'Текст комментария': comment_data['text'],
-                'Ссылка на комментарий': comment_data['comment_link'],
-                'Найденное ключевое слово': comment_data['keyword'],
-                'Дата обнаружения': comment_data['detection_date']
-            }
-
-            # Добавляем новую строку
-            df = pd.concat([df, pd.DataFrame([excel_data])], ignore_index=True)
-
-            # Сохраняем обратно в Excel
-            df.to_excel(COMMENTS_EXCEL_FILE, index=False, engine='openpyxl')
-
-            # Форматируем файл после добавления данных
-            format_excel_file(COMMENTS_EXCEL_FILE)
-
+        # Подготавливаем данные для Excel в новом порядке
+        row = [
+            comment_data['user_name'],
+            comment_data['user_link'],
+            comment_data['city'],
+            comment_data['text'],
+            comment_data['comment_link'],
+            comment_data['keyword'],
+            comment_data['detection_date']
+        ]
+
+        # Добавляем строку, если этого комментария еще нет
+        if append_excel_row(COMMENTS_EXCEL_FILE, row, key_column=5):
             logger.info(f"✅ Добавлен комментарий в Excel: {comment_data['user_name']}")
             return True
         return False
@@ -235,6 +312,17 @@ def add_comment_to_excel(comment_data):
         return False
 
 
+def count_excel_rows(file_path):
+    """Возвращает количество строк данных в Excel файле без чтения всего содержимого"""
+    from openpyxl import load_workbook
+
+    wb = load_workbook(file_path, read_only=True)
+    try:
+        return max(0, (wb.active.max_row or 1) - 1)
+    finally:
+        wb.close()
+
+
 def get_excel_stats():
     """Возвращает статистику по Excel файлам"""
     try:
@@ -242,12 +330,10 @@ def get_excel_stats():
         comments_count = 0
 
         if os.path.exists(POSTS_EXCEL_FILE):
-            df_posts = pd.read_excel(POSTS_EXCEL_FILE, engine='openpyxl')
-            posts_count = len(df_posts)
+            posts_count = count_excel_rows(POSTS_EXCEL_FILE)
 
         if os.path.exists(COMMENTS_EXCEL_FILE):
-            df_comments = pd.read_excel(COMMENTS_EXCEL_FILE, engine='openpyxl')
-            comments_count = len(df_comments)
+            comments_count = count_excel_rows(COMMENTS_EXCEL_FILE)
 
         return posts_count, comments_count
     except Exception as e:
@@ -255,35 +341,107 @@ def get_excel_stats():
         return 0, 0
 
 
-# ---------------- Улучшенная настройка VK API с повторными попытками ----------------
-def create_vk_session_with_retry():
-    """Создает VK сессию с настройками для повторных попыток"""
-    session = vk_api.VkApi(
-        token=VK_TOKEN,
-        api_version='5.131'
-    )
+# ---------------- Общий HTTP-клиент ----------------
+# Все исходящие запросы (VK API, аватарки, проверка доступности) идут через одну сессию aiohttp:
+# соединения переиспользуются, DNS кэшируется, таймауты одинаковые
+HTTP_TIMEOUT = int(os.getenv("HTTP_TIMEOUT", "30"))
+HTTP_CONNECT_TIMEOUT = 10
+HTTP_CONNECTIONS_LIMIT = 100
+HTTP_LIMIT_PER_HOST = int(os.getenv("HTTP_LIMIT_PER_HOST", "10"))
+HTTP_DNS_CACHE_TTL = 300
+HTTP_KEEPALIVE_TIMEOUT = 60
+
+http_session = None
+
+
+def get_http_session():
+    """Возвращает общую сессию aiohttp (создается в работающем цикле событий при первом вызове)"""
+    global http_session
+    if http_session is None or http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_CONNECTIONS_LIMIT,
+            limit_per_host=HTTP_LIMIT_PER_HOST,
+            ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT
+        )
+        http_session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+        )
+    return http_session
 
-    # Настройка повторных попыток для requests
-    retry_strategy = Retry(
-        total=3,
-        backoff_factor=1,
-        status_forcelist=[429, 500, 502, 503, 504],
-    )
-    adapter = HTTPAdapter(max_retries=retry_strategy)
-    session.http.mount("http://", adapter)
-    session.http.mount("https://", adapter)
 
-    # Увеличиваем таймауты
-    session.http.timeout = 30
+async def close_http_session():
+    """Закрывает общую сессию aiohttp"""
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+    http_session = None
+
+
+# ---------------- Асинхронный клиент VK API ----------------
+VK_API_URL = "https://api.vk.com/method/"
+VK_API_VERSION = "5.131"
+
+
+class AsyncVkApiMethod:
+    """Обращение к методам API как в vk_api: await vk.wall.get(owner_id=..., count=...)"""
+
+    __slots__ = ('_vk', '_method')
+
+    def __init__(self, vk, method):
+        self._vk = vk
+        self._method = method
+
+    def __getattr__(self, method):
+        return AsyncVkApiMethod(self._vk, f"{self._method}.{method}")
+
+    async def __call__(self, **kwargs):
+        return await self._vk.method(self._method, kwargs)
+
+
+class AsyncVkApi:
+    """
+    Клиент VK API поверх общей сессии aiohttp. Ошибки API поднимаются как vk_api.exceptions.ApiError,
+    поэтому обработка кодов ошибок остается прежней.
+    """
+
+    def __init__(self, token, api_version=VK_API_VERSION):
+        self.token = token
+        self.api_version = api_version
 
-    return session
+    def __getattr__(self, method):
+        return AsyncVkApiMethod(self, method)
+
+    async def method(self, method, values=None):
+        params = {'v': self.api_version, 'access_token': self.token}
+        for key, value in (values or {}).items():
+            if isinstance(value, (list, tuple)):
+                value = ','.join(str(x) for x in value)
+            params[key] = str(value)
+
+        async with get_http_session().post(VK_API_URL + method, data=params) as response:
+            response.raise_for_status()
+            # Ответы разбираются быстрым парсером JSON
+            data = json_loads(await response.read())
+
+        if 'error' in data:
+            raise vk_api.exceptions.ApiError(self, method, values, False, data['error'])
+        return data['response']
 
 
 # ---------------- База данных ----------------
 def init_db():
-    conn = sqlite3.connect('vk_monitor.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
 
+    # Для новой базы место удаленных строк возвращается по частям (PRAGMA incremental_vacuum),
+    # существующая база переводится в этот режим в первое окно обслуживания
+    cursor.execute('PRAGMA auto_vacuum=INCREMENTAL')
+
+    # WAL позволяет нескольким процессам читать базу во время записи
+    cursor.execute('PRAGMA journal_mode=WAL')
+
     # Таблица для групп ВК
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS vk_groups (
@@ -299,6 +457,31 @@ def init_db():
     columns = [column[1] for column in cursor.fetchall()]
     if 'group_id' not in columns:
         cursor.execute('ALTER TABLE vk_groups ADD COLUMN group_id INTEGER')
+    # Настройки проверки отдельной группы (NULL - значение по умолчанию из .env)
+    if 'posts_count' not in columns:
+        cursor.execute('ALTER TABLE vk_groups ADD COLUMN posts_count INTEGER')
+    if 'max_post_age_days' not in columns:
+        cursor.execute('ALTER TABLE vk_groups ADD COLUMN max_post_age_days INTEGER')
+    if 'pinned_posts' not in columns:
+        cursor.execute('ALTER TABLE vk_groups ADD COLUMN pinned_posts TEXT')
+    # Ошибки загрузки группы и карантин (до quarantined_until группа не проверяется)
+    if 'fail_count' not in columns:
+        cursor.execute('ALTER TABLE vk_groups ADD COLUMN fail_count INTEGER NOT NULL DEFAULT 0')
+    if 'last_error_code' not in columns:
+        cursor.execute('ALTER TABLE vk_groups ADD COLUMN last_error_code INTEGER')
+    if 'last_error' not in columns:
+        cursor.execute('ALTER TABLE vk_groups ADD COLUMN last_error TEXT')
+    if 'quarantined_until' not in columns:
+        cursor.execute('ALTER TABLE vk_groups ADD COLUMN quarantined_until REAL')
+
+    # Кэш соответствий короткое имя группы -> ID группы
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS group_screen_names (
+        screen_name TEXT PRIMARY KEY,
+        group_id INTEGER NOT NULL,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
 
     # Таблица для ключевых слов
     cursor.execute('''
@@ -320,6 +503,205 @@ def init_db():
     )
     ''')
 
+    # Воркеры проверки (аренда с периодическим продлением)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS scan_workers (
+        worker_id TEXT PRIMARY KEY,
+        heartbeat REAL NOT NULL,
+        started_at REAL NOT NULL
+    )
+    ''')
+
+    # Очередь событий от воркеров проверки к процессу с Telegram
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS notification_outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        created_at REAL NOT NULL
+    )
+    ''')
+    cursor.execute("PRAGMA table_info(notification_outbox)")
+    columns = [column[1] for column in cursor.fetchall()]
+    if 'attempts' not in columns:
+        cursor.execute('ALTER TABLE notification_outbox ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0')
+    if 'next_attempt_at' not in columns:
+        cursor.execute('ALTER TABLE notification_outbox ADD COLUMN next_attempt_at REAL NOT NULL DEFAULT 0')
+    # Время перевода в недоставленные (NULL - событие еще в очереди)
+    if 'failed_at' not in columns:
+        cursor.execute('ALTER TABLE notification_outbox ADD COLUMN failed_at REAL')
+    if 'last_error' not in columns:
+        cursor.execute('ALTER TABLE notification_outbox ADD COLUMN last_error TEXT')
+
+    # Запросы на внеочередную проверку от процесса с Telegram
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS scan_requests (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        requested_at REAL NOT NULL
+    )
+    ''')
+
+    # Проверка одной группы: target - группа, chat_id - чат, в который придет итог
+    cursor.execute("PRAGMA table_info(scan_requests)")
+    columns = [column[1] for column in cursor.fetchall()]
+    if 'target' not in columns:
+        cursor.execute('ALTER TABLE scan_requests ADD COLUMN target TEXT')
+    if 'chat_id' not in columns:
+        cursor.execute('ALTER TABLE scan_requests ADD COLUMN chat_id INTEGER')
+
+    # Комментарии, по которым уже отправлено уведомление
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS notified_comments (
+        owner_id INTEGER NOT NULL,
+        post_id INTEGER NOT NULL,
+        comment_id INTEGER NOT NULL,
+        keyword TEXT,
+        notified_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (owner_id, post_id, comment_id)
+    )
+    ''')
+
+    # Архив всех проверенных комментариев
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS comment_archive (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        owner_id INTEGER NOT NULL,
+        post_id INTEGER NOT NULL,
+        comment_id INTEGER NOT NULL,
+        group_domain TEXT,
+        from_id INTEGER,
+        author_name TEXT,
+        author_city TEXT,
+        author_photo TEXT,
+        comment_date INTEGER,
+        text TEXT,
+        text_norm TEXT,
+        archived_at REAL NOT NULL,
+        UNIQUE (owner_id, post_id, comment_id)
+    )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_comment_archive_date ON comment_archive (comment_date)')
+
+    cursor.execute("PRAGMA table_info(comment_archive)")
+    columns = [column[1] for column in cursor.fetchall()]
+    if 'author_city' not in columns:
+        cursor.execute('ALTER TABLE comment_archive ADD COLUMN author_city TEXT')
+    if 'author_photo' not in columns:
+        cursor.execute('ALTER TABLE comment_archive ADD COLUMN author_photo TEXT')
+    if 'text_norm' not in columns:
+        cursor.execute('ALTER TABLE comment_archive ADD COLUMN text_norm TEXT')
+
+    # Полнотекстовый индекс архива (если SQLite собран с FTS5)
+    try:
+        cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS comment_archive_fts USING fts5(
+            text,
+            content='comment_archive',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+        ''')
+        cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS comment_archive_ai AFTER INSERT ON comment_archive BEGIN
+            INSERT INTO comment_archive_fts (rowid, text) VALUES (new.id, new.text);
+        END
+        ''')
+        cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS comment_archive_ad AFTER DELETE ON comment_archive BEGIN
+            INSERT INTO comment_archive_fts (comment_archive_fts, rowid, text) VALUES ('delete', old.id, old.text);
+        END
+        ''')
+        cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS comment_archive_au AFTER UPDATE OF text ON comment_archive BEGIN
+            INSERT INTO comment_archive_fts (comment_archive_fts, rowid, text) VALUES ('delete', old.id, old.text);
+            INSERT INTO comment_archive_fts (rowid, text) VALUES (new.id, new.text);
+        END
+        ''')
+    except sqlite3.OperationalError as e:
+        logger.warning(f"⚠️ FTS5 недоступен, поиск по архиву будет медленным: {e}")
+
+    # Подписки чатов на отдельные группы и ключевые слова
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS chat_subscriptions (
+        chat_id INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        value TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (chat_id, kind, value)
+    )
+    ''')
+
+    # Аренда ведущего экземпляра (опрос Telegram, проверка и доставка уведомлений)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS leader_lease (
+        name TEXT PRIMARY KEY,
+        holder TEXT NOT NULL,
+        expires_at REAL NOT NULL,
+        heartbeat REAL NOT NULL
+    )
+    ''')
+
+    # Контрольные точки проверки: с какой группы и поста продолжать после перезапуска
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS scan_checkpoints (
+        scope TEXT PRIMARY KEY,
+        group_domain TEXT,
+        post_id INTEGER,
+        updated_at REAL NOT NULL
+    )
+    ''')
+
+    # Загрузка истории новых групп: с какого смещения продолжать обход стены
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS group_backfill (
+        group_domain TEXT PRIMARY KEY,
+        next_offset INTEGER NOT NULL DEFAULT 0,
+        done INTEGER NOT NULL DEFAULT 0,
+        created_at REAL NOT NULL,
+        updated_at REAL
+    )
+    ''')
+
+    # Многопользовательский режим: группы и ключевые слова каждого чата
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS tenant_groups (
+        tenant_id INTEGER NOT NULL,
+        domain TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (tenant_id, domain)
+    )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_tenant_groups_domain ON tenant_groups (domain)')
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS tenant_keywords (
+        tenant_id INTEGER NOT NULL,
+        keyword TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (tenant_id, keyword)
+    )
+    ''')
+
+    # Уведомления в многопользовательском режиме отмечаются для каждого чата отдельно
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS tenant_notified_comments (
+        tenant_id INTEGER NOT NULL,
+        owner_id INTEGER NOT NULL,
+        post_id INTEGER NOT NULL,
+        comment_id INTEGER NOT NULL,
+        keyword TEXT,
+        notified_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (tenant_id, owner_id, post_id, comment_id)
+    )
+    ''')
+
+    # Состояние уведомления: pending - отправляется, queued - в очереди воркера, sent - отправлено,
+    # failed - не доставлено после всех попыток. Старые записи - отправленные уведомления
+    for table in ('notified_comments', 'tenant_notified_comments'):
+        cursor.execute(f"PRAGMA table_info({table})")
+        if 'status' not in [column[1] for column in cursor.fetchall()]:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN status TEXT NOT NULL DEFAULT 'sent'")
+
     # Таблица для статистики
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS bot_stats (
@@ -339,7 +721,7 @@ def init_db():
 
 
 def get_db_connection():
-    return sqlite3.connect('vk_monitor.db')
+    return sqlite3.connect(DB_FILE, timeout=30)
 
 
 # ---------------- Функции для работы со статистикой ----------------
@@ -368,19 +750,37 @@ def increment_total_comments_count():
     update_total_comments_count(current_count + 1)
 
 
+def get_tenant_comments_count(tenant_id):
+    """Количество комментариев, о которых отправлены уведомления чату tenant_id"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT COUNT(*) FROM tenant_notified_comments WHERE tenant_id = ? AND status = 'sent'",
+                   (tenant_id,))
+    result = cursor.fetchone()
+    conn.close()
+    return result[0]
+
+
 # ---------------- Инициализация VK API ----------------
-try:
-    vk_session = create_vk_session_with_retry()
-    vk = vk_session.get_api()
-    print("✓ VK API подключен")
-except Exception as e:
-    print(f"✗ Ошибка VK API: {e}")
-    vk = None
+# Клиент создается при первом обращении, а не при импорте модуля
+vk_client = None
+
+
+def get_vk():
+    """Возвращает объект VK API, при первом вызове создает клиент"""
+    global vk_client
+    if vk_client is None:
+        if not VK_TOKEN:
+            logger.error("✗ Ошибка VK API: не задан VK_TOKEN")
+            return None
+        vk_client = AsyncVkApi(VK_TOKEN)
+        logger.info("✓ VK API подключен")
+    return vk_client
 
 
 # ---------------- Функция для получения статуса бота ----------------
-def get_bot_status():
-    """Возвращает статус бота"""
+def get_bot_status(tenant_id=None):
+    """Возвращает статус бота (в многопользовательском режиме - со списками чата tenant_id)"""
     global bot_start_time
     status = "🟢 ОНЛАЙН"
 
@@ -392,10 +792,10 @@ def get_bot_status():
     else:
         uptime_str = "неизвестно"
 
-    groups = get_groups()
-    keywords = get_keywords()
+    groups = get_groups(tenant_id)
+    keywords = get_keywords(tenant_id)
     chats = get_all_chats()
-    total_comments = get_total_comments_count()
+    total_comments = get_total_comments_count() if tenant_id is None else get_tenant_comments_count(tenant_id)
 
     # Статистика из Excel файлов
     excel_posts, excel_comments = get_excel_stats()
@@ -412,6 +812,13 @@ def get_bot_status():
         f"🕒 Последняя проверка: {datetime.now().strftime('%H:%M:%S')}"
     )
 
+    quarantined = get_quarantined_groups(tenant_id)
+    if quarantined:
+        status_info += f"\n🚧 Групп на карантине: {len(quarantined)} (/quarantine)"
+
+    for job in scan_jobs:
+        status_info += "\n" + job.get_progress_text()
+
     return status_info
 
 
@@ -422,10 +829,10 @@ async def check_access(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 # ---------------- Функция для получения аватарки пользователя ----------------
-def get_user_photo_url(user_id):
+async def get_user_photo_url(user_id):
     """Получает URL аватарки пользователя VK"""
     try:
-        user_info = vk.users.get(
+        user_info = await get_vk().users.get(
             user_ids=user_id,
             fields="photo_100,photo_200,photo_max"
         )
@@ -442,9 +849,9 @@ def get_user_photo_url(user_id):
 async def download_photo(url):
     """Загружает изображение по URL"""
     try:
-        response = requests.get(url, timeout=10)
-        if response.status_code == 200:
-            return io.BytesIO(response.content)
+        async with get_http_session().get(url) as response:
+            if response.status == 200:
+                return io.BytesIO(await response.read())
     except Exception as e:
         return None
 
@@ -479,32 +886,800 @@ def extract_group_id_from_url(url):
     return url
 
 
+# ---------------- Нормализация текста ----------------
+# Символы, которые удаляются из текста: невидимые (нулевой ширины, мягкий перенос),
+# селекторы вариантов и теги эмодзи
+INVISIBLE_CHARS = [0x00AD, 0x034F, 0x180E, 0x200B, 0x200C, 0x200D, 0x200E, 0x200F,
+                   0x2060, 0x2061, 0x2062, 0x2063, 0x2064, 0x20E3, 0xFEFF]
+INVISIBLE_RANGES = [(0xFE00, 0xFE0F), (0xE0020, 0xE007F)]
+# Эмодзи заменяются пробелом: ими часто разделяют слова («ремонт🔥квартир»)
+EMOJI_RANGES = [(0x1F000, 0x1FAFF), (0x2600, 0x27BF), (0x2B00, 0x2BFF), (0x231A, 0x231B),
+                (0x23E9, 0x23FA)]
+
+NORMALIZE_TABLE = {code: None for code in INVISIBLE_CHARS}
+for _start, _end in INVISIBLE_RANGES:
+    NORMALIZE_TABLE.update({code: None for code in range(_start, _end + 1)})
+for _start, _end in EMOJI_RANGES:
+    NORMALIZE_TABLE.update({code: ' ' for code in range(_start, _end + 1)})
+NORMALIZE_TABLE.update({ord('ё'): 'е', ord('Ё'): 'е'})
+
+# Латинские буквы и цифры, похожие на русские буквы. Заменяются только в словах,
+# где уже есть русские буквы («рем0нт», «pемонт»), чтобы не портить латинские слова и числа.
+# Цифра заменяется, только если рядом с ней нет других цифр: «100руб» остается как есть
+HOMOGLYPH_TABLE = str.maketrans({
+    'a': 'а', 'b': 'в', 'c': 'с', 'e': 'е', 'h': 'н', 'k': 'к', 'm': 'м', 'o': 'о',
+    'p': 'р', 't': 'т', 'x': 'х', 'y': 'у',
+})
+DIGIT_HOMOGLYPHS = {'0': 'о', '3': 'з', '4': 'ч', '6': 'б'}
+SINGLE_DIGIT_PATTERN = re.compile(r'(?<!\d)[0346](?!\d)')
+MIXED_SCRIPT_PATTERN = re.compile(r'\b(?=\w*[а-я])(?=\w*[a-z0-9])\w+')
+
+
+def replace_homoglyphs(match):
+    word = match.group(0).translate(HOMOGLYPH_TABLE)
+    return SINGLE_DIGIT_PATTERN.sub(lambda digit: DIGIT_HOMOGLYPHS[digit.group(0)], word)
+
+
+def normalize_text(text):
+    """
+    Приводит текст к каноническому виду для поиска ключевых слов: нижний регистр, ё -> е,
+    без невидимых символов, эмодзи заменены пробелами, латинские буквы и отдельные цифры
+    внутри русских слов заменены на похожие русские буквы.
+    """
+    if not text:
+        return ''
+    text = text.translate(NORMALIZE_TABLE).lower()
+    return MIXED_SCRIPT_PATTERN.sub(replace_homoglyphs, text)
+
+
+# ---------------- Правила ключевых слов ----------------
+# Ключевое слово может быть правилом: AND, OR, NOT, "точная фраза", NEAR/n (слова в пределах n слов),
+# слово* (поиск по началу слова) и скобки. Например: купить AND NOT продам, "ремонт квартир" NEAR/5 недорого.
+# Обычные ключевые слова без операторов ищутся как целые слова (фраза из нескольких слов - подряд).
+# слово~ или слово~n - поиск с опечатками (не более n правок), при FUZZY_MATCHING=1 - для всех слов.
+TOKEN_PATTERN = re.compile(r'\w+')
+RULE_SYNTAX_PATTERN = re.compile(r'["()*~]|\b(?:AND|OR|NOT)\b|\bNEAR/\d+')
+PLAIN_KEYWORD_PATTERN = re.compile(r'\w+(?:[\s\-]+\w+)*')
+# Слово в правиле может содержать дефисы (wi-fi), как и обычное ключевое слово
+RULE_LEXER_PATTERN = re.compile(r'\s*(?:(\()|(\))|"([^"]*)"|NEAR/(\d+)|(\w+(?:-\w+)*(?:\*|~\d?)?)|(\S))')
+
+# Поиск с опечатками
+FUZZY_MATCHING = os.getenv("FUZZY_MATCHING", "0") == "1"
+FUZZY_MAX_DISTANCE = max(1, min(3, int(os.getenv("FUZZY_MAX_DISTANCE", "2"))))
+FUZZY_MIN_WORD_LENGTH = 5
+
+
+def get_fuzzy_distance(word):
+    """Допустимое число опечаток для слова при автоматическом режиме (короткие слова - без опечаток)"""
+    if len(word) < FUZZY_MIN_WORD_LENGTH:
+        return 0
+    return min(FUZZY_MAX_DISTANCE, 1 if len(word) < 9 else 2)
+
+
+def get_deletes(word, distance):
+    """Все варианты слова, получаемые удалением не более distance букв (включая само слово)"""
+    result = {word}
+    level = {word}
+    for _ in range(distance):
+        next_level = set()
+        for variant in level:
+            if len(variant) <= 1:
+                continue
+            for i in range(len(variant)):
+                next_level.add(variant[:i] + variant[i + 1:])
+        next_level -= result
+        result |= next_level
+        level = next_level
+    return result
+
+
+def edit_distance(a, b, limit):
+    """
+    Расстояние Дамерау-Левенштейна (с перестановкой соседних букв).
+    Если расстояние больше limit, возвращает limit + 1.
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+
+    previous_previous = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        row_min = i
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if (previous_previous is not None and i > 1 and j > 1
+                    and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]):
+                current[j] = min(current[j], previous_previous[j - 2] + 1)
+            row_min = min(row_min, current[j])
+        if row_min > limit:
+            return limit + 1
+        previous_previous, previous = previous, current
+
+    return min(previous[-1], limit + 1)
+
+
+# ---------------- Ограниченные кэши ----------------
+# Предельные размеры кэшей в памяти (число записей на процесс)
+FUZZY_CACHE_SIZE = int(os.getenv("FUZZY_CACHE_SIZE", "100000"))
+KEYWORD_MATCHER_CACHE_SIZE = int(os.getenv("KEYWORD_MATCHER_CACHE_SIZE", "256"))
+SCREEN_NAME_CACHE_SIZE = int(os.getenv("SCREEN_NAME_CACHE_SIZE", "50000"))
+ROUTING_CACHE_SIZE = int(os.getenv("ROUTING_CACHE_SIZE", "50000"))
+
+# Все живые кэши процесса для /memory (кэши удаленных объектов исчезают отсюда сами)
+bounded_caches = weakref.WeakSet()
+
+
+class BoundedCache:
+    """
+    Кэш с ограниченным числом записей: при переполнении вытесняются записи,
+    к которым дольше всего не обращались (LRU). Считает попадания и вытеснения.
+    """
+
+    def __init__(self, name, max_size):
+        self.name = name
+        self.max_size = max_size
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        bounded_caches.add(self)
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        try:
+            value = self.data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        while len(self.data) > self.max_size:
+            self.data.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.data.clear()
+
+
+def get_cache_stats():
+    """Сводка по кэшам: имя -> (записей, предел, экземпляров, попаданий, промахов, вытеснений)"""
+    stats = {}
+    for cache in list(bounded_caches):
+        size, limit, count, hits, misses, evictions = stats.get(cache.name, (0, 0, 0, 0, 0, 0))
+        stats[cache.name] = (size + len(cache), limit + cache.max_size, count + 1,
+                             hits + cache.hits, misses + cache.misses, evictions + cache.evictions)
+    return dict(sorted(stats.items()))
+
+
+# Один кэш нечеткого поиска на все индексы удалений: предел FUZZY_CACHE_SIZE общий,
+# сколько бы наборов ключевых слов ни было в кэше keyword_matchers
+fuzzy_lookup_cache = BoundedCache('fuzzy_lookup', FUZZY_CACHE_SIZE)
+deletion_index_versions = itertools.count()
+
+
+class DeletionIndex:
+    """
+    Индекс удалений (как в SymSpell): для каждого ключевого слова заранее сохраняются
+    все варианты с удаленными буквами. Слово из комментария находится по своим вариантам
+    удалений за несколько обращений к словарю, без сравнения со всеми ключевыми словами.
+    """
+
+    def __init__(self):
+        self.terms = {}
+        self.deletes = {}
+        self.max_distance = 0
+        # Ключ записей индекса в fuzzy_lookup_cache, меняется при добавлении слова
+        # (старые записи вытесняются сами)
+        self.version = next(deletion_index_versions)
+
+    def add(self, term, distance):
+        if self.terms.get(term, -1) >= distance:
+            return
+        self.terms[term] = distance
+        self.max_distance = max(self.max_distance, distance)
+        for variant in get_deletes(term, distance):
+            self.deletes.setdefault(variant, set()).add(term)
+        self.version = next(deletion_index_versions)
+
+    def lookup(self, token):
+        """
+        Возвращает пары (ключевое слово, число правок) для ключевых слов, от которых token отличается
+        не более чем на наибольшее допустимое для этого слова число правок
+        """
+        key = (self.version, token)
+        result = fuzzy_lookup_cache.get(key)
+        if result is not None:
+            return result
+
+        candidates = set()
+        for variant in get_deletes(token, self.max_distance):
+            terms = self.deletes.get(variant)
+            if terms:
+                candidates |= terms
+
+        result = []
+        for term in candidates:
+            distance = edit_distance(token, term, self.terms[term])
+            if distance <= self.terms[term]:
+                result.append((term, distance))
+        result = tuple(result)
+        fuzzy_lookup_cache[key] = result
+        return result
+
+
+class KeywordRuleError(ValueError):
+    """Ошибка разбора правила ключевого слова"""
+
+
+class TokenIndex:
+    """Позиции слов в тексте комментария. Строится один раз и используется всеми правилами"""
+
+    __slots__ = ('text', 'tokens', 'positions', 'fuzzy_positions', '_sorted_tokens')
+
+    def __init__(self, text, deletion_index=None):
+        # text - уже нормализованный текст (normalize_text)
+        self.text = text
+        self.tokens = TOKEN_PATTERN.findall(text)
+        self.positions = {}
+        for position, token in enumerate(self.tokens):
+            self.positions.setdefault(token, []).append(position)
+        self._sorted_tokens = None
+
+        # Позиции слов, похожих на ключевые слова с опечатками: term -> [(позиция, число правок)].
+        # Одно слово может входить в правила с разным допустимым числом правок (слово~1 и слово~2)
+        self.fuzzy_positions = {}
+        if deletion_index is not None and deletion_index.terms:
+            for token, token_positions in self.positions.items():
+                for term, distance in deletion_index.lookup(token):
+                    self.fuzzy_positions.setdefault(term, []).extend(
+                        (position, distance) for position in token_positions)
+            for term_positions in self.fuzzy_positions.values():
+                term_positions.sort()
+
+    def prefix_positions(self, prefix):
+        if self._sorted_tokens is None:
+            self._sorted_tokens = sorted(self.positions)
+        result = []
+        index = bisect.bisect_left(self._sorted_tokens, prefix)
+        while index < len(self._sorted_tokens) and self._sorted_tokens[index].startswith(prefix):
+            result.extend(self.positions[self._sorted_tokens[index]])
+            index += 1
+        result.sort()
+        return result
+
+
+class TermRule:
+    positional = True
+
+    def __init__(self, word):
+        self.word = word
+
+    def positions(self, index):
+        return index.positions.get(self.word, [])
+
+    def matches(self, index):
+        return self.word in index.positions
+
+
+class FuzzyTermRule:
+    positional = True
+
+    def __init__(self, word, distance):
+        self.word = word
+        self.distance = distance
+
+    def positions(self, index):
+        return [position for position, distance in index.fuzzy_positions.get(self.word, ())
+                if distance <= self.distance]
+
+    def matches(self, index):
+        return any(distance <= self.distance for _, distance in index.fuzzy_positions.get(self.word, ()))
+
+
+class PrefixRule:
+    positional = True
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+
+    def positions(self, index):
+        return index.prefix_positions(self.prefix)
+
+    def matches(self, index):
+        return bool(self.positions(index))
+
+
+class PhraseRule:
+    positional = True
+
+    def __init__(self, parts):
+        self.parts = parts
+
+    def positions(self, index):
+        starts = self.parts[0].positions(index)
+        for offset, part in enumerate(self.parts[1:], 1):
+            part_positions = part.positions(index)
+            if not part_positions:
+                return []
+            part_positions = set(part_positions)
+            starts = [start for start in starts if start + offset in part_positions]
+        return starts
+
+    def matches(self, index):
+        return bool(self.positions(index))
+
+
+class NearRule:
+    positional = True
+
+    def __init__(self, left, right, distance):
+        self.left = left
+        self.right = right
+        self.distance = distance
+
+    def positions(self, index):
+        right_positions = self.right.positions(index)
+        if not right_positions:
+            return []
+        result = []
+        for position in self.left.positions(index):
+            i = bisect.bisect_left(right_positions, position - self.distance)
+            if i < len(right_positions) and right_positions[i] <= position + self.distance:
+                result.append(position)
+        return result
+
+    def matches(self, index):
+        return bool(self.positions(index))
+
+
+class AndRule:
+    positional = False
+
+    def __init__(self, children):
+        self.children = children
+
+    def matches(self, index):
+        return all(child.matches(index) for child in self.children)
+
+
+class OrRule:
+    positional = False
+
+    def __init__(self, children):
+        self.children = children
+
+    def matches(self, index):
+        return any(child.matches(index) for child in self.children)
+
+
+class NotRule:
+    positional = False
+
+    def __init__(self, child):
+        self.child = child
+
+    def matches(self, index):
+        return not self.child.matches(index)
+
+
+class RegexRule:
+    """Ключевое слово со спецсимволами ищется старым способом - регулярным выражением по тексту"""
+    positional = False
+
+    def __init__(self, keyword):
+        self.pattern = re.compile(r'\b' + re.escape(normalize_text(keyword)) + r'\b', re.IGNORECASE)
+
+    def matches(self, index):
+        return self.pattern.search(index.text) is not None
+
+
+def make_term(word, fuzzy=False, distance=None):
+    """Слово с точным совпадением или с опечатками (distance=None - автоматически по длине слова)"""
+    if distance is None:
+        distance = get_fuzzy_distance(word) if fuzzy else 0
+    distance = min(distance, FUZZY_MAX_DISTANCE)
+    return FuzzyTermRule(word, distance) if distance > 0 else TermRule(word)
+
+
+def make_phrase(words, fuzzy=False):
+    parts = [make_term(word, fuzzy) for word in words]
+    return parts[0] if len(parts) == 1 else PhraseRule(parts)
+
+
+class KeywordRuleParser:
+    """Разбор правила методом рекурсивного спуска: OR < AND < NOT < NEAR < слово/фраза/скобки"""
+
+    def __init__(self, rule, fuzzy=False):
+        self.rule = rule
+        self.fuzzy = fuzzy
+        self.tokens = []
+        for match in RULE_LEXER_PATTERN.finditer(rule):
+            open_paren, close_paren, phrase, near, word, other = match.groups()
+            if open_paren:
+                self.tokens.append(('(', None))
+            elif close_paren:
+                self.tokens.append((')', None))
+            elif phrase is not None:
+                self.tokens.append(('phrase', phrase))
+            elif near:
+                self.tokens.append(('near', int(near)))
+            elif word in ('AND', 'OR', 'NOT'):
+                self.tokens.append((word, None))
+            elif word:
+                self.tokens.append(('word', word))
+            elif other:
+                raise KeywordRuleError(f"недопустимый символ «{other}»")
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos][0] if self.pos < len(self.tokens) else None
+
+    def take(self):
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def parse(self):
+        if not self.tokens:
+            raise KeywordRuleError("пустое правило")
+        node = self.parse_or()
+        if self.pos != len(self.tokens):
+            raise KeywordRuleError(f"лишний элемент «{self.tokens[self.pos][1] or self.tokens[self.pos][0]}»")
+        return node
+
+    def parse_or(self):
+        children = [self.parse_and()]
+        while self.peek() == 'OR':
+            self.take()
+            children.append(self.parse_and())
+        return children[0] if len(children) == 1 else OrRule(children)
+
+    def parse_and(self):
+        children = [self.parse_not()]
+        while self.peek() in ('AND', 'NOT', 'word', 'phrase', '('):
+            if self.peek() == 'AND':
+                self.take()
+            children.append(self.parse_not())
+        return children[0] if len(children) == 1 else AndRule(children)
+
+    def parse_not(self):
+        if self.peek() == 'NOT':
+            self.take()
+            return NotRule(self.parse_not())
+        return self.parse_near()
+
+    def parse_near(self):
+        node = self.parse_primary()
+        while self.peek() == 'near':
+            _, distance = self.take()
+            right = self.parse_primary()
+            if not node.positional or not right.positional:
+                raise KeywordRuleError("NEAR можно использовать только между словами и фразами")
+            node = NearRule(node, right, distance)
+        return node
+
+    def parse_primary(self):
+        kind = self.peek()
+        if kind is None:
+            raise KeywordRuleError("неожиданный конец правила")
+        _, value = self.take()
+        if kind == '(':
+            node = self.parse_or()
+            if self.peek() != ')':
+                raise KeywordRuleError("не закрыта скобка")
+            self.take()
+            return node
+        if kind == 'phrase':
+            words = TOKEN_PATTERN.findall(normalize_text(value))
+            if not words:
+                raise KeywordRuleError("пустая фраза в кавычках")
+            return make_phrase(words, self.fuzzy)
+        if kind == 'word':
+            # Слово через дефис ищется как фраза из его частей, * и ~ относятся к последней части
+            *head, word = normalize_text(value).split('-')
+            if word.endswith('*'):
+                node = PrefixRule(word[:-1])
+            elif '~' in word:
+                word, distance = word.split('~')
+                node = make_term(word, distance=int(distance) if distance else max(1, get_fuzzy_distance(word)))
+            else:
+                node = make_term(word, self.fuzzy)
+            if not head:
+                return node
+            return PhraseRule([make_term(part, self.fuzzy) for part in head] + [node])
+        raise KeywordRuleError(f"неожиданный элемент «{kind}»")
+
+
+def compile_keyword_rule(keyword, fuzzy=FUZZY_MATCHING):
+    """Компилирует ключевое слово или правило в вычислитель над TokenIndex"""
+    if RULE_SYNTAX_PATTERN.search(keyword):
+        return KeywordRuleParser(keyword, fuzzy).parse()
+    if PLAIN_KEYWORD_PATTERN.fullmatch(keyword.strip()):
+        return make_phrase(TOKEN_PATTERN.findall(normalize_text(keyword)), fuzzy)
+    return RegexRule(keyword)
+
+
+def collect_fuzzy_terms(rule):
+    """Возвращает все слова с опечатками из дерева правила"""
+    if isinstance(rule, FuzzyTermRule):
+        return [rule]
+    children = []
+    if isinstance(rule, (AndRule, OrRule)):
+        children = rule.children
+    elif isinstance(rule, NotRule):
+        children = [rule.child]
+    elif isinstance(rule, PhraseRule):
+        children = rule.parts
+    elif isinstance(rule, NearRule):
+        children = [rule.left, rule.right]
+    return [term for child in children for term in collect_fuzzy_terms(child)]
+
+
+def validate_keyword_rule(keyword):
+    """Возвращает текст ошибки, если правило не удается разобрать, иначе None"""
+    try:
+        compile_keyword_rule(keyword)
+        return None
+    except KeywordRuleError as e:
+        return str(e)
+
+
+class KeywordMatcher:
+    """
+    Набор скомпилированных правил. Текст комментария разбивается на слова один раз,
+    простые слова ищутся через словарь, остальные правила вычисляются по индексу слов.
+    Возвращается первое (в порядке списка) сработавшее ключевое слово
+    или, для общего списка нескольких чатов, все сработавшие (match_all).
+    """
+
+    def __init__(self, keywords):
+        self.term_order = {}
+        self.term_keywords = {}
+        self.rules = []
+        self.deletion_index = DeletionIndex()
+
+        for order, keyword in enumerate(keywords):
+            try:
+                rule = compile_keyword_rule(keyword)
+            except KeywordRuleError as e:
+                logger.warning(f"⚠️ Правило '{keyword}' не разобрано ({e}), ищется как обычное слово")
+                rule = RegexRule(keyword)
+
+            for term in collect_fuzzy_terms(rule):
+                self.deletion_index.add(term.word, term.distance)
+
+            if isinstance(rule, TermRule):
+                self.term_order.setdefault(rule.word, (order, keyword))
+                self.term_keywords.setdefault(rule.word, []).append(keyword)
+            else:
+                self.rules.append((order, keyword, rule))
+
+    def match(self, text_norm):
+        """Ищет совпадение в нормализованном тексте (normalize_text)"""
+        if not text_norm:
+            return None
+
+        index = TokenIndex(text_norm, self.deletion_index)
+
+        best = None
+        if self.term_order:
+            for token in index.positions:
+                found = self.term_order.get(token)
+                if found and (best is None or found[0] < best[0]):
+                    best = found
+
+        for order, keyword, rule in self.rules:
+            if best is not None and order > best[0]:
+                break
+            if rule.matches(index):
+                return keyword
+
+        return best[1] if best else None
+
+    def match_all(self, text_norm):
+        """Возвращает множество всех сработавших ключевых слов"""
+        found = set()
+        if not text_norm:
+            return found
+
+        index = TokenIndex(text_norm, self.deletion_index)
+        if self.term_keywords:
+            for token in index.positions:
+                found.update(self.term_keywords.get(token, ()))
+
+        for _, keyword, rule in self.rules:
+            if keyword not in found and rule.matches(index):
+                found.add(keyword)
+        return found
+
+
+# Скомпилированные наборы правил по спискам ключевых слов
+keyword_matchers = BoundedCache('keyword_matchers', KEYWORD_MATCHER_CACHE_SIZE)
+
+
+def get_keyword_matcher(keywords):
+    """Возвращает скомпилированный набор правил для списка ключевых слов"""
+    key = tuple(keywords)
+    matcher = keyword_matchers.get(key)
+    if matcher is None:
+        matcher = KeywordMatcher(keywords)
+        keyword_matchers[key] = matcher
+    return matcher
+
+
+# ---------------- Проверка комментариев в пуле процессов ----------------
+# Число процессов для проверки больших пачек (0 - проверять только в основном процессе)
+MATCH_WORKERS = int(os.getenv("MATCH_WORKERS", str(max(1, (os.cpu_count() or 2) - 1))))
+# Пачки меньше этого размера проверяются в основном процессе: передача в пул дороже самой проверки
+MATCH_POOL_MIN_BATCH = int(os.getenv("MATCH_POOL_MIN_BATCH", "2000"))
+MATCH_INPROCESS_CHUNK = 500
+
+match_pool = None
+
+
+def match_batch_in_worker(keywords, texts, all_matches=False):
+    """
+    Проверяет пачку нормализованных текстов в процессе пула. Список ключевых слов передается
+    с пачкой: процесс хранит скомпилированные наборы правил в своем кэше get_keyword_matcher,
+    поэтому пул общий для всех чатов и групп и не пересоздается при изменении слов.
+    Возвращает только совпадения: список пар (номер текста в пачке, номер ключевого слова),
+    при all_matches - (номер текста, список номеров всех сработавших ключевых слов).
+    """
+    matcher = get_keyword_matcher(keywords)
+    positions = {}
+    for i, keyword in enumerate(keywords):
+        positions.setdefault(keyword, i)
+
+    result = []
+    for i, text in enumerate(texts):
+        if all_matches:
+            found = matcher.match_all(text)
+            if found:
+                result.append((i, [positions[keyword] for keyword in found]))
+            continue
+        keyword = matcher.match(text)
+        if keyword is not None:
+            result.append((i, positions[keyword]))
+    return result
+
+
+def get_match_pool():
+    """Возвращает пул процессов проверки (запускается при первой большой пачке)"""
+    global match_pool
+    if match_pool is None:
+        match_pool = ProcessPoolExecutor(
+            max_workers=MATCH_WORKERS,
+            mp_context=multiprocessing.get_context('spawn')
+        )
+        logger.info(f"⚙️ Запущен пул проверки: {MATCH_WORKERS} процессов")
+    return match_pool
+
+
+def shutdown_match_pool(cancel_futures=True):
+    """
+    Останавливает пул процессов проверки. cancel_futures=False - только отцепляет пул:
+    пачки других корутин (например, проверки архива) досчитываются, а следующая пачка запустит новый пул
+    """
+    global match_pool
+    if match_pool is not None:
+        match_pool.shutdown(wait=False, cancel_futures=cancel_futures)
+        match_pool = None
+
+
+async def match_comments(texts_norm, keywords, all_matches=False):
+    """
+    Проверяет пачку нормализованных текстов на ключевые слова.
+    Возвращает список найденных ключевых слов (None - совпадения нет) в порядке текстов,
+    при all_matches - список множеств всех сработавших ключевых слов.
+    Большие пачки делятся между процессами пула, маленькие проверяются на месте
+    с передачей управления циклу событий между частями.
+    """
+    results = [set() if all_matches else None for _ in texts_norm]
+    if not texts_norm or not keywords:
+        return results
+
+    if MATCH_WORKERS > 0 and len(texts_norm) >= MATCH_POOL_MIN_BATCH:
+        pool = None
+        try:
+            pool = get_match_pool()
+            loop = asyncio.get_running_loop()
+            keywords = tuple(keywords)
+            chunk_size = -(-len(texts_norm) // MATCH_WORKERS)
+            chunks = [texts_norm[i:i + chunk_size] for i in range(0, len(texts_norm), chunk_size)]
+            chunk_results = await asyncio.gather(
+                *[loop.run_in_executor(pool, match_batch_in_worker, keywords, chunk, all_matches) for chunk in chunks]
+            )
+            for chunk_index, chunk_matches in enumerate(chunk_results):
+                offset = chunk_index * chunk_size
+                for i, found in chunk_matches:
+                    if all_matches:
+                        results[offset + i] = {keywords[keyword_index] for keyword_index in found}
+                    else:
+                        results[offset + i] = keywords[found]
+            return results
+        except Exception as e:
+            logger.error(f"❌ Ошибка пула проверки, проверяем в основном процессе: {e}")
+            if pool is match_pool:
+                shutdown_match_pool(cancel_futures=False)
+
+    matcher = get_keyword_matcher(keywords)
+    match = matcher.match_all if all_matches else matcher.match
+    for start in range(0, len(texts_norm), MATCH_INPROCESS_CHUNK):
+        for i in range(start, min(start + MATCH_INPROCESS_CHUNK, len(texts_norm))):
+            results[i] = match(texts_norm[i])
+        await asyncio.sleep(0)
+    return results
+
+
+async def match_comments_for_tenants(texts_norm, watchers):
+    """
+    Проверяет пачку текстов для всех чатов, отслеживающих группу ([(tenant_id, ключевые слова)]).
+    Возвращает для каждого текста список троек (tenant_id, ключевое слово, все сработавшие слова чата):
+    ключевое слово - первое сработавшее из списка чата (для Excel и отметки об отправке),
+    по всем сработавшим словам уведомление направляется чатам, подписанным на ключевые слова.
+
+    Тексты проверяются один раз по объединенному списку ключевых слов всех чатов.
+    Объединенный список сортируется, чтобы группы с одинаковым набором чатов
+    пользовались одним скомпилированным набором правил.
+    """
+    if len(watchers) == 1:
+        tenant_id, keywords = watchers[0]
+        # Без подписок на ключевые слова все совпадения ведут в одни и те же чаты, достаточно первого
+        if tenant_id is not None or not get_routing_index().has_keyword_subscriptions():
+            matches = await match_comments(texts_norm, keywords)
+            return [[(tenant_id, keyword, (keyword,))] if keyword else [] for keyword in matches]
+        all_keywords = keywords
+    else:
+        all_keywords = sorted({keyword for _, keywords in watchers for keyword in keywords})
+
+    found_sets = await match_comments(texts_norm, all_keywords, all_matches=True)
+    results = []
+    for found in found_sets:
+        text_matches = []
+        if found:
+            for tenant_id, keywords in watchers:
+                matched = tuple(keyword for keyword in keywords if keyword in found)
+                if matched:
+                    text_matches.append((tenant_id, matched[0], matched))
+        results.append(text_matches)
+    return results
+
+
 # ---------------- Функция для проверки ключевых слов ----------------
-def contains_keyword(text, keywords):
+def contains_keyword(text, keywords, text_norm=None):
     """
-    Проверяет, содержит ли текст любое из ключевых слов.
+    Проверяет, содержит ли текст любое из ключевых слов (или срабатывает ли любое из правил).
     Учитывает разные регистры и исключает случаи, когда ключевое слово является частью другого слова.
+    text_norm - уже нормализованный текст, если он был вычислен заранее.
     """
     if not text or not keywords:
         return False, None
 
-    for keyword in keywords:
-        # Используем регулярное выражение для поиска целых слов с игнорированием регистра
-        pattern = r'\b' + re.escape(keyword) + r'\b'
-        if re.search(pattern, text, re.IGNORECASE):
-            return True, keyword
+    if text_norm is None:
+        text_norm = normalize_text(text)
 
-    return False, None
+    found_keyword = get_keyword_matcher(keywords).match(text_norm)
+    return found_keyword is not None, found_keyword
 
 
 # ---------------- Клавиатура ----------------
 def get_main_keyboard():
     keyboard = [
-        [KeyboardButton("Добавить группу"), KeyboardButton("Добавить ключевое слово")],
+        [KeyboardButton("Добавить группу"), KeyboardButton("Импорт групп"), KeyboardButton("Добавить ключевое слово")],
         [KeyboardButton("Список групп"), KeyboardButton("Список ключевых слов")],
-        [KeyboardButton("Проверить сейчас"), KeyboardButton("Удалить группу"),
-         KeyboardButton("Удалить ключевое слово")],
-        [KeyboardButton("Удалить все ключевые слова"), KeyboardButton("Статус"), KeyboardButton("Экспорт в Excel")],
+        [KeyboardButton("Проверить сейчас"), KeyboardButton("Проверить группу")],
+        [KeyboardButton("Удалить группу"), KeyboardButton("Удалить ключевое слово")],
+        [KeyboardButton("Удалить все ключевые слова"), KeyboardButton("Статус")],
+        [KeyboardButton("Экспорт в Excel")],
         [KeyboardButton("Добавить чат"), KeyboardButton("Удалить чат"), KeyboardButton("Список чатов")]
     ]
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True, is_persistent=True)
@@ -513,10 +1688,10 @@ def get_main_keyboard():
 def get_admin_keyboard():
     keyboard = [
         [KeyboardButton("Статус"), KeyboardButton("Экспорт в Excel")],
-        [KeyboardButton("Добавить группу"), KeyboardButton("Добавить ключевое слово")],
+        [KeyboardButton("Добавить группу"), KeyboardButton("Импорт групп"), KeyboardButton("Добавить ключевое слово")],
         [KeyboardButton("Список групп"), KeyboardButton("Список ключевых слов")],
-        [KeyboardButton("Проверить сейчас"), KeyboardButton("Удалить группу"),
-         KeyboardButton("Удалить ключевое слово")],
+        [KeyboardButton("Проверить сейчас"), KeyboardButton("Проверить группу")],
+        [KeyboardButton("Удалить группу"), KeyboardButton("Удалить ключевое слово")],
         [KeyboardButton("Удалить все ключевые слова")],
         [KeyboardButton("Добавить чат"), KeyboardButton("Удалить чат"), KeyboardButton("Список чатов")]
     ]
@@ -534,20 +1709,13 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         chat_id = update.effective_chat.id
         chat_title = update.effective_chat.title
 
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            'INSERT OR IGNORE INTO telegram_chats (chat_id, chat_type, chat_title) VALUES (?, ?, ?)',
-            (chat_id, chat_type, chat_title)
-        )
-        conn.commit()
-        conn.close()
+        add_chat_to_db(chat_id, chat_type, chat_title)
 
         await update.message.reply_html(
             f"👋 Приветствую участников группы {chat_title}!\n\n"
             "Я бот для мониторинга комментариев ВКонтакте. "
             "Теперь эта группа будет получать уведомления о найденных комментариях.\n\n"
-            f"{get_bot_status()}\n\n"
+            f"{get_bot_status(get_tenant_id(update))}\n\n"
             "Для управления настройками используйте кнопки ниже:",
             reply_markup=get_admin_keyboard()
         )
@@ -557,7 +1725,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"Привет, {user.mention_html()}!\n\n"
             "Я бот для мониторинга комментариев ВКонтакте.\n"
             "Я проверяю последние 20 постов в указанных группах на наличие ключевых слов.\n\n"
-            f"{get_bot_status()}\n\n"
+            f"{get_bot_status(get_tenant_id(update))}\n\n"
             "Используй кнопки ниже для управления мной:",
             reply_markup=get_main_keyboard()
         )
@@ -573,24 +1741,195 @@ async def keyboard_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Клавиатура активирована", reply_markup=get_main_keyboard())
 
 
-# ---------------- Утилиты базы данных ----------------
-def add_chat_to_db(chat_id: int, chat_type: str, chat_title: str = None):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        'INSERT OR IGNORE INTO telegram_chats (chat_id, chat_type, chat_title) VALUES (?, ?, ?)',
-        (chat_id, chat_type, chat_title)
-    )
-    conn.commit()
-    conn.close()
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Поиск по архиву комментариев: /search [7d] запрос"""
+    args = list(context.args or [])
+    days = None
+    if args and re.fullmatch(r'\d+d', args[0]):
+        days = int(args.pop(0)[:-1])
 
+    query = ' '.join(args).strip()
+    if not query:
+        await update.message.reply_text(
+            "Использование: /search [период] запрос\n"
+            "Например: /search 7d ремонт квартир\n"
+            "Слово со звездочкой ищется по началу: /search ремонт*")
+        return
 
-def remove_chat_from_db(chat_id: int):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM telegram_chats WHERE chat_id = ?', (chat_id,))
-    conn.commit()
+    start_time = time.perf_counter()
+    try:
+        results = search_comment_archive(query, days=days, tenant_id=get_tenant_id(update))
+    except sqlite3.OperationalError as e:
+        await update.message.reply_text(f"❌ Некорректный запрос: {e}")
+        return
+    elapsed_ms = (time.perf_counter() - start_time) * 1000
+
+    await update.message.reply_html(format_search_results(query, results, elapsed_ms),
+                                    disable_web_page_preview=True)
+
+
+async def subscribe_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Подписка чата на группу или ключевое слово: /subscribe group|keyword значение"""
+    chat_id = update.effective_chat.id
+    args = list(context.args or [])
+
+    if MULTI_TENANT:
+        await update.message.reply_text("⚠️ В многопользовательском режиме уведомления приходят по вашим "
+                                        "собственным спискам групп и ключевых слов, подписки не нужны")
+        return
+
+    if not is_chat_in_db(chat_id):
+        await update.message.reply_text("❌ Сначала добавьте этот чат для уведомлений кнопкой \"Добавить чат\"")
+        return
+
+    if len(args) < 2 or args[0] not in SUBSCRIPTION_KINDS:
+        await update.message.reply_text(
+            "Использование:\n"
+            "/subscribe group ссылка_на_группу - получать уведомления только из этих групп\n"
+            "/subscribe keyword слово - получать уведомления только по этим ключевым словам")
+        return
+
+    kind = args[0]
+    value = ' '.join(args[1:]).strip()
+    if kind == 'group':
+        value = extract_group_id_from_url(value)
+        if value.lower() not in [domain.lower() for domain, _ in get_groups()]:
+            await update.message.reply_text(f"⚠️ Группы {value} нет в списке отслеживаемых")
+            return
+    elif value.lower() not in [keyword.lower() for keyword in get_keywords()]:
+        await update.message.reply_text(f"⚠️ Ключевого слова '{value}' нет в списке")
+        return
+
+    add_subscription(chat_id, kind, value)
+    logger.info(f"📬 Чат {chat_id} подписан: {kind} = {value}")
+    await update.message.reply_html(get_subscriptions_text(chat_id))
+
+
+async def unsubscribe_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Отмена подписки: /unsubscribe group|keyword значение или /unsubscribe all"""
+    chat_id = update.effective_chat.id
+    args = list(context.args or [])
+
+    if args == ['all']:
+        remove_subscription(chat_id)
+    elif len(args) >= 2 and args[0] in SUBSCRIPTION_KINDS:
+        value = ' '.join(args[1:]).strip()
+        if args[0] == 'group':
+            value = extract_group_id_from_url(value)
+        if not remove_subscription(chat_id, args[0], value):
+            await update.message.reply_text("⚠️ Такой подписки нет")
+            return
+    else:
+        await update.message.reply_text(
+            "Использование:\n"
+            "/unsubscribe group ссылка_на_группу\n"
+            "/unsubscribe keyword слово\n"
+            "/unsubscribe all - получать все уведомления")
+        return
+
+    await update.message.reply_html(get_subscriptions_text(chat_id))
+
+
+async def subscriptions_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Показывает подписки текущего чата"""
+    await update.message.reply_html(get_subscriptions_text(update.effective_chat.id))
+
+
+async def groupcfg_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Настройки проверки группы: /groupcfg группа [posts N] [age N] [pinned all|age|skip] | reset"""
+    if MULTI_TENANT:
+        # Глубина проверки общая для всех чатов, отслеживающих группу
+        await update.message.reply_text("⚠️ В многопользовательском режиме настройки групп задаются "
+                                        "администратором через переменные окружения")
+        return
+
+    args = list(context.args or [])
+    groups = {domain.lower(): domain for domain, _ in get_groups()}
+
+    if not args or len(args) % 2 == 0 and args[1:] != ['reset']:
+        await update.message.reply_text(
+            "Использование:\n"
+            "/groupcfg группа - показать настройки\n"
+            "/groupcfg группа posts 10 age 7 pinned skip - изменить\n"
+            "/groupcfg группа reset - вернуть значения по умолчанию\n\n"
+            "posts - число последних постов (1-100), age - максимальный возраст поста в днях (0 - без ограничения), "
+            "pinned - закрепленные посты: all - проверять всегда, age - с учетом возраста, skip - не проверять. "
+            "Значение default возвращает настройку по умолчанию.")
+        return
+
+    domain = groups.get(extract_group_id_from_url(args[0]).lower())
+    if not domain:
+        await update.message.reply_text(f"⚠️ Группы {args[0]} нет в списке отслеживаемых")
+        return
+
+    if args[1:] == ['reset']:
+        reset_group_settings(domain)
+    else:
+        changes = {}
+        for name, value in zip(args[1::2], args[2::2]):
+            if name not in GROUP_SETTINGS:
+                await update.message.reply_text(f"⚠️ Неизвестная настройка {name}. Доступны: {', '.join(GROUP_SETTINGS)}")
+                return
+            try:
+                changes[name] = parse_group_setting(name, value.lower())
+            except ValueError as e:
+                await update.message.reply_text(f"⚠️ Неверное значение {name}: {e}")
+                return
+        for name, value in changes.items():
+            set_group_setting(domain, name, value)
+        if changes:
+            logger.info(f"⚙️ Настройки группы {domain} изменены: {changes}")
+
+    await update.message.reply_text(get_group_settings_text(domain))
+
+
+async def quarantine_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Группы на карантине: /quarantine, /quarantine reset группа|all"""
+    args = list(context.args or [])
+    tenant_id = get_tenant_id(update)
+
+    if args and args[0] == 'reset':
+        target = ' '.join(args[1:]).strip()
+        groups = {domain.lower(): domain for domain, _ in get_groups(tenant_id)}
+        if target == 'all' and tenant_id is None:
+            released = release_group_quarantine()
+        elif target and extract_group_id_from_url(target).lower() in groups:
+            released = release_group_quarantine(groups[extract_group_id_from_url(target).lower()])
+        else:
+            await update.message.reply_text(
+                "Использование:\n"
+                "/quarantine - группы на карантине\n"
+                "/quarantine reset группа - вернуть группу в проверку\n"
+                "/quarantine reset all - вернуть все группы")
+            return
+        logger.info(f"🚧 Снят карантин с {released} групп")
+        await update.message.reply_text(f"✅ Возвращено в проверку групп: {released}")
+        return
+
+    await update.message.reply_text(get_quarantine_text(tenant_id))
+
+
+# ---------------- Утилиты базы данных ----------------
+def add_chat_to_db(chat_id: int, chat_type: str, chat_title: str = None):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        'INSERT OR IGNORE INTO telegram_chats (chat_id, chat_type, chat_title) VALUES (?, ?, ?)',
+        (chat_id, chat_type, chat_title)
+    )
+    conn.commit()
+    conn.close()
+    invalidate_routing_index()
+
+
+def remove_chat_from_db(chat_id: int):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM telegram_chats WHERE chat_id = ?', (chat_id,))
+    cursor.execute('DELETE FROM chat_subscriptions WHERE chat_id = ?', (chat_id,))
+    conn.commit()
     conn.close()
+    invalidate_routing_index()
 
 
 def is_chat_in_db(chat_id: int):
@@ -627,146 +1966,2924 @@ def get_chats_list_text():
     return "📋 Чаты для уведомлений:\n" + "\n".join(chat_list)
 
 
-def get_groups():
+def get_tenant_id(update: Update):
+    """Чат-владелец списков в многопользовательском режиме (None - общие списки)"""
+    if not MULTI_TENANT:
+        return None
+    return update.effective_chat.id
+
+
+def get_groups(tenant_id: int = None):
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute('SELECT domain, group_id FROM vk_groups')
+    if tenant_id is None:
+        cursor.execute('SELECT domain, group_id FROM vk_groups')
+    else:
+        cursor.execute('''
+            SELECT g.domain, g.group_id FROM tenant_groups t
+            JOIN vk_groups g ON g.domain = t.domain
+            WHERE t.tenant_id = ?
+            ORDER BY t.created_at, t.domain
+        ''', (tenant_id,))
     groups = [(row[0], row[1]) for row in cursor.fetchall()]
     conn.close()
     return groups
 
 
-def get_keywords():
+def get_keywords(tenant_id: int = None):
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute('SELECT keyword FROM keywords')
+    if tenant_id is None:
+        cursor.execute('SELECT keyword FROM keywords')
+    else:
+        cursor.execute('SELECT keyword FROM tenant_keywords WHERE tenant_id = ? ORDER BY rowid', (tenant_id,))
     keywords = [row[0] for row in cursor.fetchall()]
     conn.close()
     return keywords
 
 
-def add_group(domain: str, group_id: int = None):
+def add_group(domain: str, group_id: int = None, tenant_id: int = None):
     conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute('INSERT OR IGNORE INTO vk_groups (domain, group_id) VALUES (?, ?)', (domain, group_id))
+    if cursor.rowcount:
+        schedule_group_backfill(cursor, domain)
+    if tenant_id is not None:
+        cursor.execute('INSERT OR IGNORE INTO tenant_groups (tenant_id, domain) VALUES (?, ?)', (tenant_id, domain))
+    conn.commit()
+    conn.close()
+
+
+def add_keyword(keyword: str, tenant_id: int = None):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    if tenant_id is None:
+        cursor.execute('INSERT OR IGNORE INTO keywords (keyword) VALUES (?)', (keyword,))
+    else:
+        cursor.execute('INSERT OR IGNORE INTO tenant_keywords (tenant_id, keyword) VALUES (?, ?)',
+                       (tenant_id, keyword))
+    conn.commit()
+    conn.close()
+
+
+def delete_dependent_subscriptions(cursor, kind, value):
+    """
+    Удаляет подписки чатов на удаленные группы или ключевые слова: иначе чат, подписанный
+    только на них, перестал бы получать уведомления. Возвращает число удаленных подписок
+    """
+    cursor.execute('DELETE FROM chat_subscriptions WHERE kind = ? AND value = ?', (kind, value.lower()))
+    removed = cursor.rowcount
+    if removed:
+        logger.info(f"🔕 Удалено подписок чатов на {SUBSCRIPTION_KINDS[kind]} {value}: {removed}")
+    return removed
+
+
+def delete_group(domain: str, tenant_id: int = None):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    if tenant_id is not None:
+        cursor.execute('DELETE FROM tenant_groups WHERE tenant_id = ? AND domain = ?', (tenant_id, domain))
+        # Группу, которую отслеживает еще кто-то, продолжаем загружать
+        cursor.execute('SELECT 1 FROM tenant_groups WHERE domain = ? LIMIT 1', (domain,))
+        if cursor.fetchone():
+            conn.commit()
+            conn.close()
+            return
+    cursor.execute('DELETE FROM vk_groups WHERE domain = ?', (domain,))
+    cursor.execute('DELETE FROM group_backfill WHERE group_domain = ?', (domain,))
+    removed = delete_dependent_subscriptions(cursor, 'group', domain)
+    conn.commit()
+    conn.close()
+    if removed:
+        invalidate_routing_index()
+
+
+def delete_keyword(keyword: str, tenant_id: int = None):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    removed = 0
+    if tenant_id is None:
+        cursor.execute('DELETE FROM keywords WHERE keyword = ?', (keyword,))
+        removed = delete_dependent_subscriptions(cursor, 'keyword', keyword)
+    else:
+        cursor.execute('DELETE FROM tenant_keywords WHERE tenant_id = ? AND keyword = ?', (tenant_id, keyword))
+    conn.commit()
+    conn.close()
+    if removed:
+        invalidate_routing_index()
+
+
+def delete_all_keywords(tenant_id: int = None):
+    """Удаляет все ключевые слова из базы данных"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    removed = 0
+    if tenant_id is None:
+        cursor.execute('DELETE FROM keywords')
+        cursor.execute("DELETE FROM chat_subscriptions WHERE kind = 'keyword'")
+        removed = cursor.rowcount
+    else:
+        cursor.execute('DELETE FROM tenant_keywords WHERE tenant_id = ?', (tenant_id,))
+    conn.commit()
+    conn.close()
+    if removed:
+        invalidate_routing_index()
+    logger.info("✅ Все ключевые слова удалены из базы данных" if tenant_id is None
+                else f"✅ Все ключевые слова чата {tenant_id} удалены из базы данных")
+
+
+def get_group_watchers(groups):
+    """
+    Кто отслеживает каждую группу: {домен: [(tenant_id, ключевые слова)]}.
+    В обычном режиме все группы проверяются по общему списку ключевых слов (tenant_id None).
+    """
+    if not MULTI_TENANT:
+        keywords = get_keywords()
+        return {domain: [(None, keywords)] for domain, _ in groups} if keywords else {}
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT tenant_id, keyword FROM tenant_keywords ORDER BY rowid')
+    tenant_keywords = {}
+    for tenant_id, keyword in cursor.fetchall():
+        tenant_keywords.setdefault(tenant_id, []).append(keyword)
+    cursor.execute('SELECT tenant_id, domain FROM tenant_groups')
+    tenant_groups = cursor.fetchall()
+    conn.close()
+
+    domains = {domain for domain, _ in groups}
+    watchers = {}
+    for tenant_id, domain in tenant_groups:
+        if domain in domains and tenant_id in tenant_keywords:
+            watchers.setdefault(domain, []).append((tenant_id, tenant_keywords[tenant_id]))
+    return watchers
+
+
+# ---------------- Настройки проверки групп ----------------
+# Команда /groupcfg -> столбец vk_groups
+GROUP_SETTINGS = {'posts': 'posts_count', 'age': 'max_post_age_days', 'pinned': 'pinned_posts'}
+PINNED_POSTS_MODES = {'all': 'проверять всегда', 'age': 'с учетом возраста', 'skip': 'не проверять'}
+
+
+def get_group_settings():
+    """Возвращает {домен: (число постов, макс. возраст поста в днях, режим закрепленных постов)}"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT domain, posts_count, max_post_age_days, pinned_posts FROM vk_groups')
+    settings = {
+        domain: (
+            posts_count or POSTS_COUNT,
+            max_post_age_days if max_post_age_days is not None else MAX_POST_AGE_DAYS,
+            pinned_posts or PINNED_POSTS
+        )
+        for domain, posts_count, max_post_age_days, pinned_posts in cursor.fetchall()
+    }
+    conn.close()
+    return settings
+
+
+def set_group_setting(domain: str, name: str, value):
+    """Меняет настройку проверки группы (value=None - вернуть значение по умолчанию)"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(f'UPDATE vk_groups SET {GROUP_SETTINGS[name]} = ? WHERE domain = ?', (value, domain))
+    updated = cursor.rowcount > 0
+    conn.commit()
+    conn.close()
+    return updated
+
+
+def reset_group_settings(domain: str):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        'UPDATE vk_groups SET posts_count = NULL, max_post_age_days = NULL, pinned_posts = NULL WHERE domain = ?',
+        (domain,)
+    )
+    conn.commit()
+    conn.close()
+
+
+def parse_group_setting(name: str, value: str):
+    """Проверяет значение настройки группы, при ошибке выбрасывает ValueError"""
+    if value == 'default':
+        return None
+    if name in ('posts', 'age') and not value.isdigit():
+        raise ValueError("нужно целое неотрицательное число")
+    if name == 'posts':
+        count = int(value)
+        if not 1 <= count <= 100:
+            raise ValueError("число постов должно быть от 1 до 100")
+        return count
+    if name == 'age':
+        return int(value)
+    if value not in PINNED_POSTS_MODES:
+        raise ValueError(f"режим закрепленных постов: {', '.join(PINNED_POSTS_MODES)}")
+    return value
+
+
+def filter_posts_for_scan(posts, max_age_days, pinned_mode):
+    """Отбрасывает посты старше max_age_days дней и закрепленные посты согласно pinned_mode"""
+    cutoff = time.time() - max_age_days * 86400 if max_age_days else None
+    result = []
+    for post in posts:
+        if post.is_pinned and pinned_mode != 'age':
+            if pinned_mode == 'all':
+                result.append(post)
+            continue
+        if cutoff is None or post.date >= cutoff:
+            result.append(post)
+    return result
+
+
+def get_group_settings_text(domain: str):
+    posts_count, max_age_days, pinned_mode = get_group_settings()[domain]
+    return (
+        f"⚙️ Настройки проверки группы {domain}:\n"
+        f"📝 Постов: {posts_count}\n"
+        f"📅 Возраст постов: {f'не старше {max_age_days} дн.' if max_age_days else 'без ограничения'}\n"
+        f"📌 Закрепленные посты: {PINNED_POSTS_MODES.get(pinned_mode, pinned_mode)}"
+    )
+
+
+# ---------------- Карантин недоступных групп ----------------
+# Ошибки VK, которые не исправятся повтором: группа закрыта, удалена или заблокирована
+VK_PERMANENT_ERRORS = {
+    15: 'доступ запрещен',
+    18: 'страница удалена или заблокирована',
+    30: 'закрытый профиль',
+    100: 'группа не найдена',
+    203: 'доступ к группе запрещен',
+}
+# Ошибки токена, лимитов и капчи относятся ко всему аккаунту, а не к группе: при них проверка
+# прерывается без учета ошибки группы (как и при недоступности VK по сети)
+VK_ACCOUNT_ERRORS = {
+    5: 'ошибка авторизации',
+    6: 'слишком много запросов в секунду',
+    9: 'слишком много однотипных действий',
+    10: 'внутренняя ошибка сервера VK',
+    14: 'требуется ввод капчи',
+    17: 'требуется подтверждение пользователя',
+    29: 'достигнут лимит запросов',
+}
+# После стольких временных ошибок подряд группа тоже уходит на карантин
+GROUP_FAILURE_THRESHOLD = 3
+# Первый карантин длится GROUP_QUARANTINE_BASE секунд, каждый следующий - вдвое дольше
+GROUP_QUARANTINE_BASE = int(os.getenv("GROUP_QUARANTINE_BASE", "3600"))
+GROUP_QUARANTINE_MAX = int(os.getenv("GROUP_QUARANTINE_MAX", str(7 * 86400)))
+
+
+class VkUnavailableError(Exception):
+    """VK недоступен для всего аккаунта (токен, лимиты, сеть) - ошибка не связана с группой"""
+
+
+def is_account_wide_error(error):
+    """Проверяет, относится ли ошибка ко всему аккаунту (лимиты, токен, сеть), а не к группе"""
+    if isinstance(error, vk_api.exceptions.ApiError):
+        return error.code in VK_ACCOUNT_ERRORS
+    return isinstance(error, (aiohttp.ClientError, ConnectionError, TimeoutError, asyncio.TimeoutError))
+
+
+def record_group_failure(domain: str, error_code, error_text: str):
+    """
+    Учитывает ошибку загрузки группы. Возвращает время окончания карантина
+    или None, если группа пока остается в проверке.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT fail_count FROM vk_groups WHERE domain = ?', (domain,))
+    row = cursor.fetchone()
+    fail_count = (row[0] if row else 0) + 1
+
+    quarantined_until = None
+    if error_code in VK_PERMANENT_ERRORS or fail_count >= GROUP_FAILURE_THRESHOLD:
+        strikes = fail_count if error_code in VK_PERMANENT_ERRORS else fail_count - GROUP_FAILURE_THRESHOLD + 1
+        delay = min(GROUP_QUARANTINE_MAX, GROUP_QUARANTINE_BASE * 2 ** min(strikes - 1, 20))
+        quarantined_until = time.time() + delay
+
+    cursor.execute(
+        '''UPDATE vk_groups SET fail_count = ?, last_error_code = ?, last_error = ?, quarantined_until = ?
+           WHERE domain = ?''',
+        (fail_count, error_code, error_text[:200], quarantined_until, domain)
+    )
+    conn.commit()
+    conn.close()
+    return quarantined_until
+
+
+def record_group_success(domain: str):
+    """Сбрасывает счетчик ошибок группы после успешной загрузки"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        '''UPDATE vk_groups SET fail_count = 0, last_error_code = NULL, last_error = NULL, quarantined_until = NULL
+           WHERE domain = ? AND fail_count > 0''',
+        (domain,)
+    )
+    if cursor.rowcount:
+        logger.info(f"✅ Группа {domain} снова доступна")
+    conn.commit()
+    conn.close()
+
+
+def get_quarantined_groups(tenant_id: int = None):
+    """Возвращает [(домен, число ошибок, код ошибки, текст ошибки, конец карантина)] групп на карантине"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    query = '''
+        SELECT domain, fail_count, last_error_code, last_error, quarantined_until FROM vk_groups
+        WHERE quarantined_until > ?
+    '''
+    params = [time.time()]
+    if tenant_id is not None:
+        query += ' AND domain IN (SELECT domain FROM tenant_groups WHERE tenant_id = ?)'
+        params.append(tenant_id)
+    cursor.execute(query + ' ORDER BY quarantined_until', params)
+    result = cursor.fetchall()
+    conn.close()
+    return result
+
+
+def release_group_quarantine(domain: str = None):
+    """Возвращает группу (или все группы) в проверку. Возвращает число освобожденных групп"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    query = '''UPDATE vk_groups SET fail_count = 0, last_error_code = NULL, last_error = NULL, quarantined_until = NULL
+               WHERE quarantined_until IS NOT NULL'''
+    if domain:
+        cursor.execute(query + ' AND domain = ?', (domain,))
+    else:
+        cursor.execute(query)
+    released = cursor.rowcount
+    conn.commit()
+    conn.close()
+    return released
+
+
+def get_quarantine_text(tenant_id: int = None):
+    """Возвращает отчет о группах на карантине"""
+    groups = get_quarantined_groups(tenant_id)
+    if not groups:
+        return "✅ Групп на карантине нет"
+
+    lines = [f"🚧 Групп на карантине: {len(groups)}"]
+    for domain, fail_count, error_code, error_text, quarantined_until in groups:
+        reason = VK_PERMANENT_ERRORS.get(error_code) or error_text or "неизвестная ошибка"
+        code = f"[{error_code}] " if error_code else ""
+        until = datetime.fromtimestamp(quarantined_until).strftime('%d.%m %H:%M')
+        lines.append(f"• {domain}: {code}{reason}, ошибок подряд: {fail_count}, следующая попытка {until}")
+    return "\n".join(lines)
+
+
+# ---------------- Подписки чатов ----------------
+SUBSCRIPTION_KINDS = {'group': 'группы', 'keyword': 'ключевые слова'}
+
+
+def add_subscription(chat_id: int, kind: str, value: str):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        'INSERT OR IGNORE INTO chat_subscriptions (chat_id, kind, value) VALUES (?, ?, ?)',
+        (chat_id, kind, value.lower())
+    )
+    conn.commit()
+    conn.close()
+    invalidate_routing_index()
+
+
+def remove_subscription(chat_id: int, kind: str = None, value: str = None):
+    """Удаляет подписку чата. Без kind удаляются все подписки чата"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    if kind is None:
+        cursor.execute('DELETE FROM chat_subscriptions WHERE chat_id = ?', (chat_id,))
+    else:
+        cursor.execute(
+            'DELETE FROM chat_subscriptions WHERE chat_id = ? AND kind = ? AND value = ?',
+            (chat_id, kind, value.lower())
+        )
+    removed = cursor.rowcount
     conn.commit()
     conn.close()
+    invalidate_routing_index()
+    return removed
+
+
+def get_subscriptions(chat_id: int = None):
+    """Возвращает подписки (chat_id, kind, value) одного или всех чатов"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    if chat_id is None:
+        cursor.execute('SELECT chat_id, kind, value FROM chat_subscriptions')
+    else:
+        cursor.execute('SELECT chat_id, kind, value FROM chat_subscriptions WHERE chat_id = ?', (chat_id,))
+    subscriptions = cursor.fetchall()
+    conn.close()
+    return subscriptions
+
+
+class RoutingIndex:
+    """
+    Индекс маршрутизации уведомлений: (группа, ключевое слово) -> чаты.
+    Чат без подписок на группы получает уведомления из всех групп,
+    без подписок на ключевые слова - по всем ключевым словам.
+    """
+
+    def __init__(self, chat_ids, subscriptions):
+        self.chat_ids = list(chat_ids)
+        known_chats = set(self.chat_ids)
+        self.by_group = {}
+        self.by_keyword = {}
+
+        filtered_groups = set()
+        filtered_keywords = set()
+        for chat_id, kind, value in subscriptions:
+            if chat_id not in known_chats:
+                continue
+            if kind == 'group':
+                self.by_group.setdefault(value, set()).add(chat_id)
+                filtered_groups.add(chat_id)
+            elif kind == 'keyword':
+                self.by_keyword.setdefault(value, set()).add(chat_id)
+                filtered_keywords.add(chat_id)
+
+        self.any_group = known_chats - filtered_groups
+        self.any_keyword = known_chats - filtered_keywords
+        self.cache = BoundedCache('routing', ROUTING_CACHE_SIZE)
+
+    def get_chats(self, group_domain, keyword):
+        """Возвращает чаты, которым нужно уведомление о совпадении (в порядке добавления чатов)"""
+        key = ((group_domain or '').lower(), (keyword or '').lower())
+        chats = self.cache.get(key)
+        if chats is None:
+            by_group = self.any_group | self.by_group.get(key[0], set())
+            by_keyword = self.any_keyword | self.by_keyword.get(key[1], set())
+            matched = by_group & by_keyword
+            chats = tuple(chat_id for chat_id in self.chat_ids if chat_id in matched)
+            self.cache[key] = chats
+        return chats
+
+    def get_chats_for_keywords(self, group_domain, keywords):
+        """Чаты, подписанные хотя бы на одно из сработавших ключевых слов (в порядке добавления чатов)"""
+        matched = set()
+        for keyword in keywords:
+            matched.update(self.get_chats(group_domain, keyword))
+        return tuple(chat_id for chat_id in self.chat_ids if chat_id in matched)
+
+    def has_keyword_subscriptions(self):
+        """Есть ли чаты, получающие уведомления только по части ключевых слов"""
+        return bool(self.by_keyword)
+
+
+routing_index = None
+
+
+def get_routing_index():
+    """Возвращает индекс маршрутизации, при необходимости строит его заново"""
+    global routing_index
+    if routing_index is None:
+        routing_index = RoutingIndex([chat[0] for chat in get_all_chats()], get_subscriptions())
+    return routing_index
+
+
+def invalidate_routing_index():
+    """Сбрасывает индекс маршрутизации после изменения чатов или подписок"""
+    global routing_index
+    routing_index = None
+
+
+def get_subscriptions_text(chat_id: int):
+    """Возвращает описание подписок чата"""
+    subscriptions = get_subscriptions(chat_id)
+    lines = []
+    for kind, title in SUBSCRIPTION_KINDS.items():
+        values = [value for _, k, value in subscriptions if k == kind]
+        lines.append(f"<b>{title.capitalize()}:</b> " + (", ".join(html.escape(v) for v in values) if values else "все"))
+    return "📬 Подписки этого чата:\n" + "\n".join(lines)
+
+
+# ---------------- Улучшенная функция безопасного VK запроса ----------------
+# Не больше VK_REQUESTS_PER_SECOND запросов в секунду (ограничение VK API для ключа пользователя - 3)
+VK_REQUESTS_PER_SECOND = float(os.getenv("VK_REQUESTS_PER_SECOND", "3"))
+
+
+class VkRateLimiter:
+    """
+    Равномерно распределяет запросы к VK во времени. Запросы проверки проходят первыми,
+    фоновые (low_priority) получают слот, только если проверка не пользовалась
+    лимитом хотя бы один интервал: между двумя запросами идущей проверки фоновые не вклиниваются.
+    """
+
+    def __init__(self, rate):
+        self.set_rate(rate)
+        self.next_slot = 0
+        self.last_live_slot = float('-inf')
+        self.live_waiting = 0
+
+    def set_rate(self, rate):
+        self.rate = rate
+        self.interval = 1 / rate if rate > 0 else 0
+
+    def is_live_idle(self, now):
+        return not self.live_waiting and now >= self.last_live_slot + 2 * self.interval
+
+    async def acquire(self, low_priority=False):
+        if not low_priority:
+            self.live_waiting += 1
+        try:
+            while True:
+                now = time.monotonic()
+                if now >= self.next_slot and (not low_priority or self.is_live_idle(now)):
+                    self.next_slot = now + self.interval
+                    if not low_priority:
+                        self.last_live_slot = now
+                    return
+                await asyncio.sleep(max(self.next_slot - now, self.interval if low_priority else 0.01))
+        finally:
+            if not low_priority:
+                self.live_waiting -= 1
+
+
+vk_rate_limiter = VkRateLimiter(VK_REQUESTS_PER_SECOND)
+
+
+def update_worker_rate_share(workers_count):
+    """Воркеры проверки работают с одним токеном и делят VK_REQUESTS_PER_SECOND поровну"""
+    rate = VK_REQUESTS_PER_SECOND / max(1, workers_count)
+    if vk_rate_limiter.rate != rate:
+        vk_rate_limiter.set_rate(rate)
+        logger.info(f"🚦 Лимит запросов к VK для воркера {WORKER_ID}: {rate:.2f} в секунду "
+                    f"({workers_count} воркеров)")
+
+
+async def safe_vk_request(func, *args, low_priority=False, **kwargs):
+    """Безопасный вызов VK API с обработкой ошибок"""
+    max_retries = 3
+    retry_delay = 2
+
+    for attempt in range(max_retries):
+        await vk_rate_limiter.acquire(low_priority)
+        try:
+            return await func(*args, **kwargs)
+        except vk_api.exceptions.ApiError as e:
+            # Закрытая или удаленная группа не станет доступной через пару секунд
+            if attempt == max_retries - 1 or e.code in VK_PERMANENT_ERRORS:
+                raise
+            await asyncio.sleep(retry_delay * (attempt + 1))
+        except (aiohttp.ClientError, ConnectionError, TimeoutError) as e:
+            if attempt == max_retries - 1:
+                raise
+            await asyncio.sleep(retry_delay * (attempt + 1))
+        except Exception as e:
+            raise
+
+    return None
+
+
+# ---------------- Массовый импорт групп ----------------
+# Максимальное количество групп в одном запросе groups.getById
+GROUPS_BATCH_SIZE = 500
+
+# Ссылки вида club123 / public123 / event123 содержат ID группы напрямую
+NUMERIC_GROUP_PATTERN = re.compile(r'^(?:club|public|event)(\d+)$', re.IGNORECASE)
+
+# Кэш соответствий короткое имя -> ID группы (дублируется в таблице group_screen_names)
+screen_name_cache = BoundedCache('screen_names', SCREEN_NAME_CACHE_SIZE)
+
+
+def parse_group_links(raw_items):
+    """
+    Разбирает список ссылок на группы (строки из сообщения или файла).
+    Каждая строка может содержать несколько ссылок через пробел, запятую или точку с запятой.
+    Возвращает уникальные идентификаторы в исходном порядке.
+    """
+    identifiers = []
+    seen = set()
+
+    for item in raw_items:
+        if item is None:
+            continue
+        for part in re.split(r'[\s,;]+', str(item)):
+            part = part.strip()
+            if not part:
+                continue
+            identifier = extract_group_id_from_url(part)
+            if identifier and identifier.lower() not in seen:
+                seen.add(identifier.lower())
+                identifiers.append(identifier)
+
+    return identifiers
+
+
+def read_group_links_from_file(file_name, data):
+    """Читает ссылки на группы из загруженного файла (txt, csv или xlsx)"""
+    extension = os.path.splitext(file_name or '')[1].lower()
+
+    if extension in ('.xlsx', '.xls'):
+        import pandas as pd
+
+        df = pd.read_excel(io.BytesIO(data), header=None, dtype=str)
+        return [cell for cell in df.values.flatten() if isinstance(cell, str)]
+
+    try:
+        content = data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        content = data.decode('cp1251', errors='ignore')
+
+    if extension == '.csv':
+        rows = csv.reader(io.StringIO(content), delimiter=';' if content.count(';') > content.count(',') else ',')
+        return [cell for row in rows for cell in row]
+
+    return content.splitlines()
+
+
+def get_cached_group_ids(screen_names):
+    """Возвращает ID групп из кэша (память, затем база данных)"""
+    result = {}
+    missing = []
+
+    for name in screen_names:
+        group_id = screen_name_cache.get(name.lower())
+        if group_id:
+            result[name] = group_id
+        else:
+            missing.append(name)
+
+    if missing:
+        found = {}
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        for i in range(0, len(missing), GROUPS_BATCH_SIZE):
+            chunk = [name.lower() for name in missing[i:i + GROUPS_BATCH_SIZE]]
+            placeholders = ','.join('?' * len(chunk))
+            cursor.execute(
+                f'SELECT screen_name, group_id FROM group_screen_names WHERE screen_name IN ({placeholders})',
+                chunk
+            )
+            for screen_name, group_id in cursor.fetchall():
+                screen_name_cache[screen_name] = group_id
+                found[screen_name] = group_id
+        conn.close()
+
+        for name in missing:
+            group_id = found.get(name.lower())
+            if group_id:
+                result[name] = group_id
+
+    return result
+
+
+def save_screen_names(mapping):
+    """Сохраняет соответствия короткое имя -> ID группы в кэш и базу данных"""
+    if not mapping:
+        return
+
+    rows = []
+    for name, group_id in mapping.items():
+        screen_name_cache[name.lower()] = group_id
+        rows.append((name.lower(), group_id))
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.executemany(
+        'INSERT OR REPLACE INTO group_screen_names (screen_name, group_id, updated_at) '
+        'VALUES (?, ?, CURRENT_TIMESTAMP)',
+        rows
+    )
+    conn.commit()
+    conn.close()
+
+
+async def resolve_group_batch(batch):
+    """
+    Получает ID групп одним запросом groups.getById.
+    Если VK отклоняет весь запрос из-за некорректного имени, пачка делится пополам.
+    """
+    vk = get_vk()
+    if not vk:
+        return {}
+
+    try:
+        groups_info = await safe_vk_request(
+            vk.groups.getById,
+            group_ids=','.join(batch)
+        )
+    except vk_api.exceptions.ApiError as e:
+        if e.code == 100 and len(batch) > 1:
+            middle = len(batch) // 2
+            result = await resolve_group_batch(batch[:middle])
+            result.update(await resolve_group_batch(batch[middle:]))
+            return result
+        if e.code == 100:
+            return {}
+        raise
+
+    by_name = {}
+    for group_info in groups_info or []:
+        group_id = group_info.get('id')
+        if not group_id:
+            continue
+        by_name[f"club{group_id}"] = group_id
+        if group_info.get('screen_name'):
+            by_name[group_info['screen_name'].lower()] = group_id
+
+    return {name: by_name[name.lower()] for name in batch if name.lower() in by_name}
+
+
+async def resolve_group_ids(identifiers):
+    """
+    Преобразует идентификаторы групп в числовые ID.
+    Сначала используются ссылки с числовым ID и кэш, остальные имена
+    запрашиваются пачками до GROUPS_BATCH_SIZE штук за один вызов groups.getById.
+    Возвращает словарь идентификатор -> ID группы (нераспознанные отсутствуют).
+    """
+    result = {}
+    unresolved = []
+
+    for identifier in identifiers:
+        match = NUMERIC_GROUP_PATTERN.match(identifier)
+        if match:
+            result[identifier] = int(match.group(1))
+        elif identifier.isdigit():
+            result[identifier] = int(identifier)
+        else:
+            unresolved.append(identifier)
+
+    cached = get_cached_group_ids(unresolved)
+    result.update(cached)
+    unresolved = [name for name in unresolved if name not in cached]
+
+    resolved = {}
+    for i in range(0, len(unresolved), GROUPS_BATCH_SIZE):
+        batch = unresolved[i:i + GROUPS_BATCH_SIZE]
+        try:
+            resolved.update(await resolve_group_batch(batch))
+        except Exception as e:
+            logger.error(f"❌ Ошибка пакетного получения ID групп: {e}")
+
+    save_screen_names(resolved)
+    result.update(resolved)
+    return result
+
+
+def add_groups_bulk(groups, tenant_id=None):
+    """Добавляет группы одним запросом. groups - список пар (домен, ID группы)"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    added = 0
+    for domain, group_id in groups:
+        cursor.execute('INSERT OR IGNORE INTO vk_groups (domain, group_id) VALUES (?, ?)', (domain, group_id))
+        if cursor.rowcount:
+            schedule_group_backfill(cursor, domain)
+            if tenant_id is None:
+                added += 1
+        if tenant_id is not None:
+            cursor.execute('INSERT OR IGNORE INTO tenant_groups (tenant_id, domain) VALUES (?, ?)',
+                           (tenant_id, domain))
+            added += cursor.rowcount
+    # Заполняем ID у ранее добавленных групп, где он отсутствовал
+    cursor.executemany(
+        'UPDATE vk_groups SET group_id = ? WHERE domain = ? AND group_id IS NULL',
+        [(group_id, domain) for domain, group_id in groups]
+    )
+    conn.commit()
+    conn.close()
+    return added
+
+
+async def import_groups(raw_items, tenant_id=None):
+    """
+    Массовый импорт групп из списка строк.
+    Возвращает (добавлено, уже было в списке, список нераспознанных идентификаторов).
+    """
+    identifiers = parse_group_links(raw_items)
+    existing = {domain.lower(): group_id for domain, group_id in get_groups(tenant_id)}
+
+    new_identifiers = [i for i in identifiers if existing.get(i.lower()) is None]
+    existing_count = len(identifiers) - len(new_identifiers)
+
+    # Группы, которые бот уже загружает для других чатов, не нужно искать в VK
+    known = {}
+    if tenant_id is not None:
+        known = {domain.lower(): (domain, group_id) for domain, group_id in get_groups() if group_id}
+
+    resolved = await resolve_group_ids([i for i in new_identifiers if i.lower() not in known])
+    failed = [i for i in new_identifiers if i.lower() not in known and i not in resolved]
+
+    added = add_groups_bulk([known[i.lower()] if i.lower() in known else (i, resolved[i])
+                             for i in new_identifiers if i.lower() in known or i in resolved], tenant_id)
+    logger.info(f"✅ Импорт групп: добавлено {added}, уже было {existing_count}, не распознано {len(failed)}")
+
+    return added, existing_count, failed
+
+
+async def backfill_missing_group_ids():
+    """Заполняет отсутствующие ID групп (group_id IS NULL) при запуске бота"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT domain FROM vk_groups WHERE group_id IS NULL')
+    domains = [row[0] for row in cursor.fetchall()]
+    conn.close()
+
+    if not domains:
+        return 0
+
+    resolved = await resolve_group_ids(domains)
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.executemany(
+        'UPDATE vk_groups SET group_id = ? WHERE domain = ?',
+        [(group_id, domain) for domain, group_id in resolved.items()]
+    )
+    conn.commit()
+    conn.close()
+
+    logger.info(f"✅ Заполнены ID для {len(resolved)} из {len(domains)} групп без ID")
+    return len(resolved)
+
+
+def format_import_result(added, existing_count, failed):
+    """Формирует текст отчета об импорте групп"""
+    text = (
+        f"✅ Импорт завершен!\n"
+        f"➕ Добавлено групп: {added}\n"
+        f"⚠️ Уже были в списке: {existing_count}\n"
+        f"❌ Не удалось распознать: {len(failed)}"
+    )
+    if failed:
+        text += "\n\n" + "\n".join(failed[:20])
+        if len(failed) > 20:
+            text += f"\n... и еще {len(failed) - 20}"
+    return text
+
+
+# ---------------- Архив комментариев ----------------
+ARCHIVE_RETENTION_DAYS = int(os.getenv("ARCHIVE_RETENTION_DAYS", "30"))
+SEARCH_RESULTS_LIMIT = 10
+
+# Наличие полнотекстового индекса определяется при первом поиске
+archive_fts_available = None
+
+# Комментарии копятся в буфере и записываются в архив пачками
+ARCHIVE_FLUSH_ROWS = 1000
+archive_buffer = []
+
+
+def archive_comments(group_domain, owner_id, post_id, comments, authors=None):
+    """Добавляет проверенные комментарии поста (CommentRecord) в буфер архива"""
+    authors = authors or {}
+    now = time.time()
+    rows = []
+
+    for comment in comments:
+        if not comment.id:
+            continue
+        author = authors.get(comment.from_id) or EMPTY_AUTHOR
+        rows.append((owner_id, post_id, comment.id, group_domain, comment.from_id, author.name,
+                     author.city, author.photo, comment.date, comment.text, comment.text_norm, now))
+
+    archive_buffer.extend(rows)
+    if len(archive_buffer) >= ARCHIVE_FLUSH_ROWS:
+        flush_archive_buffer()
+
+
+def flush_archive_buffer():
+    """Записывает накопленные комментарии в архив одним запросом"""
+    if not archive_buffer:
+        return
+
+    rows = archive_buffer[:]
+    archive_buffer.clear()
+
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.executemany(
+            'INSERT OR IGNORE INTO comment_archive '
+            '(owner_id, post_id, comment_id, group_domain, from_id, author_name, author_city, author_photo, '
+            'comment_date, text, text_norm, archived_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            rows
+        )
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        logger.error(f"❌ Ошибка сохранения комментариев в архив: {e}")
+
+
+def prune_comment_archive():
+    """
+    Удаляет из архива комментарии старше ARCHIVE_RETENTION_DAYS дней.
+    Перед удалением они дописываются в сжатые помесячные файлы в ARCHIVE_DIR.
+    """
+    if ARCHIVE_RETENTION_DAYS <= 0:
+        return 0
+
+    cutoff = time.time() - ARCHIVE_RETENTION_DAYS * 86400
+    deleted = 0
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    while True:
+        cursor.execute(
+            f'SELECT id, {", ".join(ARCHIVE_EXPORT_COLUMNS)} FROM comment_archive '
+            'WHERE archived_at < ? ORDER BY id LIMIT ?',
+            (cutoff, ARCHIVE_PRUNE_CHUNK)
+        )
+        rows = cursor.fetchall()
+        if not rows:
+            break
+
+        if ARCHIVE_EXPORT_ON_PRUNE:
+            export_archive_partitions([row[1:] for row in rows])
+
+        cursor.execute('DELETE FROM comment_archive WHERE id <= ? AND archived_at < ?', (rows[-1][0], cutoff))
+        deleted += cursor.rowcount
+        conn.commit()
+    conn.close()
+
+    if deleted:
+        logger.info(f"🧹 Удалено {deleted} комментариев из архива (старше {ARCHIVE_RETENTION_DAYS} дней)")
+    return deleted
+
+
+def is_archive_fts_available():
+    """Проверяет наличие полнотекстового индекса архива"""
+    global archive_fts_available
+    if archive_fts_available is None:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'comment_archive_fts'")
+        archive_fts_available = cursor.fetchone() is not None
+        conn.close()
+    return archive_fts_available
+
+
+def build_fts_query(query):
+    """
+    Преобразует пользовательский запрос в запрос FTS5.
+    Каждое слово экранируется кавычками, слово со звездочкой на конце ищется по префиксу.
+    """
+    terms = []
+    for word in re.findall(r'\w+\*?', query):
+        if word.endswith('*'):
+            terms.append(f'"{word[:-1]}"*')
+        else:
+            terms.append(f'"{word}"')
+    return ' '.join(terms)
+
+
+def search_comment_archive(query, days=None, limit=SEARCH_RESULTS_LIMIT, tenant_id=None):
+    """
+    Ищет комментарии в архиве (в многопользовательском режиме - только в группах чата tenant_id).
+    Возвращает список кортежей (домен группы, ID владельца, ID поста, ID комментария,
+    ID автора, имя автора, дата комментария, фрагмент текста), отсортированных по релевантности.
+    """
+    # Без ограничения по дням находятся и комментарии без даты (comment_date IS NULL)
+    date_filter = ''
+    date_params = ()
+    if days:
+        date_filter = 'AND a.comment_date >= ?'
+        date_params = (int(time.time() - days * 86400),)
+    tenant_filter = ''
+    tenant_params = ()
+    if tenant_id is not None:
+        tenant_filter = 'AND a.group_domain IN (SELECT domain FROM tenant_groups WHERE tenant_id = ?)'
+        tenant_params = (tenant_id,)
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    if is_archive_fts_available():
+        fts_query = build_fts_query(query)
+        if not fts_query:
+            conn.close()
+            return []
+        cursor.execute(
+            f'''
+            SELECT a.group_domain, a.owner_id, a.post_id, a.comment_id, a.from_id, a.author_name, a.comment_date,
+                   snippet(comment_archive_fts, 0, char(2), char(3), '…', 16)
+            FROM comment_archive_fts
+            JOIN comment_archive a ON a.id = comment_archive_fts.rowid
+            WHERE comment_archive_fts MATCH ? {date_filter} {tenant_filter}
+            ORDER BY bm25(comment_archive_fts)
+            LIMIT ?
+            ''',
+            (fts_query, *date_params, *tenant_params, limit)
+        )
+    else:
+        # % и _ в запросе ищутся как обычные символы
+        pattern = query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        cursor.execute(
+            f'''
+            SELECT group_domain, owner_id, post_id, comment_id, from_id, author_name, comment_date, substr(text, 1, 200)
+            FROM comment_archive a
+            WHERE text LIKE ? ESCAPE '\\' {date_filter} {tenant_filter}
+            ORDER BY comment_date DESC
+            LIMIT ?
+            ''',
+            (f"%{pattern}%", *date_params, *tenant_params, limit)
+        )
+
+    results = cursor.fetchall()
+    conn.close()
+    return results
+
+
+def format_search_results(query, results, elapsed_ms):
+    """Формирует HTML-сообщение с результатами поиска по архиву"""
+    if not results:
+        return f"🔎 По запросу «{html.escape(query)}» ничего не найдено ({elapsed_ms:.0f} мс)"
+
+    lines = [f"🔎 <b>Результаты по запросу «{html.escape(query)}»</b> ({elapsed_ms:.0f} мс):\n"]
+    for i, (group_domain, owner_id, post_id, comment_id, from_id, author_name, comment_date, fragment) in enumerate(
+            results, 1):
+        date_str = datetime.fromtimestamp(comment_date).strftime('%Y-%m-%d %H:%M') if comment_date else "—"
+        author = html.escape(author_name or f"id{from_id}")
+        fragment = html.escape(fragment or '').replace('\x02', '<b>').replace('\x03', '</b>')
+        lines.append(
+            f"{i}. {date_str} | {html.escape(group_domain or '')} | {author}\n"
+            f"{fragment}\n"
+            f"https://vk.com/wall{owner_id}_{post_id}?reply={comment_id}\n"
+        )
+    return "\n".join(lines)
+
+
+# ---------------- Хранение данных и обслуживание базы ----------------
+# Каталог для помесячных файлов: старые Excel файлы и удаленные из архива комментарии
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+ARCHIVE_EXPORT_ON_PRUNE = os.getenv("ARCHIVE_EXPORT_ON_PRUNE", "1") == "1"
+ARCHIVE_PRUNE_CHUNK = 5000
+ARCHIVE_EXPORT_COLUMNS = ['owner_id', 'post_id', 'comment_id', 'group_domain', 'from_id', 'author_name',
+                          'author_city', 'comment_date', 'text', 'archived_at']
+
+# Сроки хранения остальных таблиц в днях (0 - хранить всегда). Отметки об отправленных
+# уведомлениях должны храниться дольше, чем проверяются посты, иначе уведомления повторятся.
+# По умолчанию проверяются и старые, и закрепленные посты, поэтому отметки хранятся всегда
+NOTIFIED_RETENTION_DAYS = int(os.getenv("NOTIFIED_RETENTION_DAYS", "0"))
+SCREEN_NAME_RETENTION_DAYS = int(os.getenv("SCREEN_NAME_RETENTION_DAYS", "30"))
+SCAN_REQUESTS_RETENTION_DAYS = 1
+
+# Час (по местному времени), в который выполняется ежедневное обслуживание базы и Excel файлов
+MAINTENANCE_HOUR = int(os.getenv("MAINTENANCE_HOUR", "4"))
+last_maintenance_day = None
+
+
+def export_archive_partitions(rows):
+    """Дописывает строки архива в файлы ARCHIVE_DIR/comment_archive_ГГГГ-ММ.csv.gz по месяцу комментария"""
+    partitions = {}
+    for row in rows:
+        comment_date = row[7] or row[9]
+        month = datetime.fromtimestamp(comment_date).strftime('%Y-%m')
+        partitions.setdefault(month, []).append(row)
+
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    for month, month_rows in partitions.items():
+        file_path = os.path.join(ARCHIVE_DIR, f"comment_archive_{month}.csv.gz")
+        is_new = not os.path.exists(file_path)
+        # Каждая дозапись - отдельный gzip-блок, такой файл читается как один (gzip, zcat, pandas)
+        with gzip.open(file_path, 'at', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f)
+            if is_new:
+                writer.writerow(ARCHIVE_EXPORT_COLUMNS)
+            writer.writerows(month_rows)
+
+
+def prune_expired_data():
+    """Удаляет устаревшие строки из всех таблиц согласно срокам хранения"""
+    prune_comment_archive()
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    deleted = {}
+
+    if NOTIFIED_RETENTION_DAYS > 0:
+        cursor.execute('DELETE FROM notified_comments WHERE notified_at < datetime(\'now\', ?)',
+                       (f'-{NOTIFIED_RETENTION_DAYS} days',))
+        deleted['notified_comments'] = cursor.rowcount
+        cursor.execute('DELETE FROM tenant_notified_comments WHERE notified_at < datetime(\'now\', ?)',
+                       (f'-{NOTIFIED_RETENTION_DAYS} days',))
+        deleted['tenant_notified_comments'] = cursor.rowcount
+    if SCREEN_NAME_RETENTION_DAYS > 0:
+        cursor.execute('DELETE FROM group_screen_names WHERE updated_at < datetime(\'now\', ?)',
+                       (f'-{SCREEN_NAME_RETENTION_DAYS} days',))
+        deleted['group_screen_names'] = cursor.rowcount
+    cursor.execute('DELETE FROM scan_requests WHERE requested_at < ?',
+                   (time.time() - SCAN_REQUESTS_RETENTION_DAYS * 86400,))
+    deleted['scan_requests'] = cursor.rowcount
+    cursor.execute('DELETE FROM notification_outbox WHERE failed_at < ?',
+                   (time.time() - OUTBOX_FAILED_RETENTION_DAYS * 86400,))
+    deleted['notification_outbox'] = cursor.rowcount
+
+    conn.commit()
+    conn.close()
+
+    deleted = {table: count for table, count in deleted.items() if count}
+    if deleted:
+        logger.info(f"🧹 Удалены устаревшие записи: {', '.join(f'{t} - {c}' for t, c in deleted.items())}")
+
+
+def rollover_excel_files():
+    """
+    В начале месяца переносит Excel файлы в ARCHIVE_DIR (например, checked_posts_2024-05.xlsx)
+    и начинает новые, чтобы запись и проверка дубликатов работали только с данными текущего месяца.
+    """
+    from openpyxl import load_workbook
+
+    current_month = datetime.now().strftime('%Y-%m')
+
+    for file_path, headers in ((POSTS_EXCEL_FILE, POSTS_EXCEL_HEADERS), (COMMENTS_EXCEL_FILE, COMMENTS_EXCEL_HEADERS)):
+        if not os.path.exists(file_path):
+            continue
+
+        wb = load_workbook(file_path, read_only=True)
+        created = wb.properties.created
+        wb.close()
+        file_month = (created or datetime.fromtimestamp(os.path.getmtime(file_path))).strftime('%Y-%m')
+        if file_month == current_month:
+            continue
+
+        os.makedirs(ARCHIVE_DIR, exist_ok=True)
+        name, ext = os.path.splitext(os.path.basename(file_path))
+        archived_path = os.path.join(ARCHIVE_DIR, f"{name}_{file_month}{ext}")
+        os.replace(file_path, archived_path)
+        create_excel_file(file_path, headers)
+        logger.info(f"🗂 Excel файл за {file_month} перенесен в {archived_path}")
+
+
+def run_database_maintenance():
+    """Возвращает освободившееся место и обновляет статистику для планировщика запросов SQLite"""
+    start_time = time.time()
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    cursor.execute('PRAGMA auto_vacuum')
+    if cursor.fetchone()[0] != 2:
+        # Однократный перевод существующей базы в режим INCREMENTAL требует полного VACUUM
+        logger.info("🗜 Перевод базы данных в режим incremental auto_vacuum (однократно)...")
+        cursor.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        cursor.execute('VACUUM')
+    else:
+        cursor.execute('PRAGMA incremental_vacuum').fetchall()
+
+    cursor.execute('ANALYZE')
+    cursor.execute('PRAGMA optimize')
+    cursor.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+    conn.close()
+
+    logger.info(f"🗜 Обслуживание базы данных завершено за {time.time() - start_time:.1f} сек")
+
+
+# ---------------- Выгрузка истории для анализа ----------------
+EXPORT_DIR = os.getenv("EXPORT_DIR", "export")
+EXPORT_CHUNK_ROWS = 20000
+# Telegram не принимает от ботов файлы больше 50 МБ
+TELEGRAM_MAX_FILE_SIZE = 50 * 1024 * 1024
+
+# Наборы данных: столбцы (имя, тип) и запрос. Строки отсортированы по первому столбцу-дате,
+# по нему же Parquet делится на помесячные разделы. {found} - найденные комментарии (get_export_found_query).
+# В многопользовательском режиме комментарий, найденный для нескольких чатов, выгружается строкой на каждый чат
+EXPORT_DATASETS = {
+    'comments': (
+        [('comment_date', 'timestamp'), ('group_domain', 'str'), ('owner_id', 'int'), ('post_id', 'int'),
+         ('comment_id', 'int'), ('from_id', 'int'), ('author_name', 'str'), ('author_city', 'str'),
+         ('text', 'str'), ('keyword', 'str'), ('tenant_id', 'int'), ('archived_at', 'float')],
+        '''
+        SELECT a.comment_date, a.group_domain, a.owner_id, a.post_id, a.comment_id, a.from_id,
+               a.author_name, a.author_city, a.text, n.keyword, n.tenant_id, a.archived_at
+        FROM comment_archive a
+        LEFT JOIN ({found}) n
+               ON n.owner_id = a.owner_id AND n.post_id = a.post_id AND n.comment_id = a.comment_id
+        ORDER BY a.comment_date
+        '''
+    ),
+    'posts': (
+        [('first_comment_date', 'timestamp'), ('last_comment_date', 'timestamp'), ('group_domain', 'str'),
+         ('owner_id', 'int'), ('post_id', 'int'), ('comments', 'int'), ('found', 'int')],
+        '''
+        SELECT MIN(a.comment_date) AS first_comment_date, MAX(a.comment_date), a.group_domain,
+               a.owner_id, a.post_id, COUNT(DISTINCT a.comment_id), COUNT(DISTINCT n.comment_id)
+        FROM comment_archive a
+        LEFT JOIN ({found}) n
+               ON n.owner_id = a.owner_id AND n.post_id = a.post_id AND n.comment_id = a.comment_id
+        GROUP BY a.owner_id, a.post_id
+        ORDER BY first_comment_date
+        '''
+    ),
+}
+
+
+def get_export_found_query():
+    """
+    Найденные комментарии для выгрузки: уведомление отправлено или стоит в очереди
+    (отметки pending и failed не считаются). В многопользовательском режиме - по чатам
+    """
+    if MULTI_TENANT:
+        return ('''SELECT tenant_id, owner_id, post_id, comment_id, keyword FROM tenant_notified_comments
+                   WHERE status IN ('sent', 'queued')''')
+    return ('''SELECT NULL AS tenant_id, owner_id, post_id, comment_id, keyword FROM notified_comments
+               WHERE status IN ('sent', 'queued')''')
+
+
+def get_export_month(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime('%Y-%m') if timestamp else 'unknown'
+
+
+def write_csv_export(cursor, path, columns):
+    """Пишет результат запроса в path.csv.gz порциями по EXPORT_CHUNK_ROWS строк"""
+    file_path = f"{path}.csv.gz"
+    with gzip.open(file_path, 'wt', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow([name for name, _ in columns])
+        while rows := cursor.fetchmany(EXPORT_CHUNK_ROWS):
+            writer.writerows(rows)
+    return [file_path]
+
+
+def is_parquet_available():
+    """Выгрузка в Parquet возможна, если установлен pyarrow (проверяется без его загрузки)"""
+    return importlib.util.find_spec('pyarrow') is not None
+
+
+def write_parquet_export(cursor, path, columns):
+    """
+    Пишет результат запроса в path/month=ГГГГ-ММ/part-0.parquet порциями по EXPORT_CHUNK_ROWS строк.
+    Строки приходят отсортированными по дате, поэтому открыт всегда только файл текущего месяца.
+    """
+    # pyarrow тяжелый, загружается только для выгрузки (не в каждом процессе пула проверки)
+    import pyarrow
+    import pyarrow.parquet
+
+    arrow_types = {'timestamp': pyarrow.timestamp('s'), 'str': pyarrow.string(),
+                   'int': pyarrow.int64(), 'float': pyarrow.float64()}
+    schema = pyarrow.schema([(name, arrow_types[kind]) for name, kind in columns])
+
+    files = []
+    writer = None
+    current_month = None
+    try:
+        while rows := cursor.fetchmany(EXPORT_CHUNK_ROWS):
+            for month, month_rows in itertools.groupby(rows, key=lambda row: get_export_month(row[0])):
+                if month != current_month:
+                    if writer:
+                        writer.close()
+                    file_path = os.path.join(path, f"month={month}", "part-0.parquet")
+                    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                    writer = pyarrow.parquet.ParquetWriter(file_path, schema, compression='zstd')
+                    files.append(file_path)
+                    current_month = month
+                values = list(zip(*month_rows))
+                writer.write_table(pyarrow.Table.from_arrays(
+                    [pyarrow.array(column, type=field.type) for column, field in zip(values, schema)],
+                    schema=schema
+                ))
+    finally:
+        if writer:
+            writer.close()
+    return files
+
+
+def export_history(export_format=None, output_dir=EXPORT_DIR):
+    """
+    Выгружает архив комментариев и сводку по постам в Parquet (по месяцам) или CSV.gz.
+    Данные читаются из базы порциями и не загружаются в память целиком.
+    Возвращает (каталог выгрузки, список файлов).
+    """
+    export_format = export_format or ('parquet' if is_parquet_available() else 'csv')
+    if export_format == 'parquet' and not is_parquet_available():
+        raise RuntimeError("для выгрузки в Parquet установите пакет pyarrow")
+    if export_format not in ('parquet', 'csv'):
+        raise ValueError(f"неизвестный формат выгрузки: {export_format}")
+
+    target_dir = os.path.join(output_dir, f"export_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
+    os.makedirs(target_dir, exist_ok=True)
+    write_export = write_parquet_export if export_format == 'parquet' else write_csv_export
+
+    files = []
+    conn = get_db_connection()
+    try:
+        found_query = get_export_found_query()
+        for name, (columns, query) in EXPORT_DATASETS.items():
+            cursor = conn.execute(query.format(found=found_query))
+            files += write_export(cursor, os.path.join(target_dir, name), columns)
+            logger.info(f"📦 Выгружен набор {name} ({export_format})")
+    finally:
+        conn.close()
+    return target_dir, files
+
+
+# Форматы экспорта: номер в меню -> (формат, название)
+EXPORT_FORMATS = {
+    '1': ('xlsx', 'Excel (xlsx)'),
+    '2': ('parquet', 'Parquet, история для анализа'),
+    '3': ('csv', 'CSV.gz, история для анализа'),
+}
+
+
+def get_export_menu_text():
+    """Меню выбора формата экспорта"""
+    lines = ["📤 Выберите формат экспорта (введите номер):"]
+    for number, (export_format, title) in EXPORT_FORMATS.items():
+        if export_format == 'parquet' and not is_parquet_available():
+            title += " - недоступно, установите pyarrow"
+        lines.append(f"{number}. {title}")
+    return "\n".join(lines)
+
+
+async def send_excel_files(update: Update):
+    """Отправляет Excel файлы с проверенными постами и найденными комментариями"""
+    excel_posts, excel_comments = get_excel_stats()
+
+    # Форматируем файлы перед отправкой
+    format_excel_file(POSTS_EXCEL_FILE)
+    format_excel_file(COMMENTS_EXCEL_FILE)
+
+    if excel_posts > 0 and os.path.exists(POSTS_EXCEL_FILE):
+        with open(POSTS_EXCEL_FILE, 'rb') as posts_file:
+            await update.message.reply_document(
+                document=posts_file,
+                filename="checked_posts.xlsx",
+                caption=f"📊 Файл с проверенными постами\nКоличество записей: {excel_posts}"
+            )
+    else:
+        await update.message.reply_text("📭 Файл с постами пуст или не существует")
+
+    if excel_comments > 0 and os.path.exists(COMMENTS_EXCEL_FILE):
+        with open(COMMENTS_EXCEL_FILE, 'rb') as comments_file:
+            await update.message.reply_document(
+                document=comments_file,
+                filename="found_comments.xlsx",
+                caption=f"📊 Файл с найденными комментариями\nКоличество записей: {excel_comments}"
+            )
+    else:
+        await update.message.reply_text("📭 Файл с комментариями пуст или не существует")
+
+
+async def send_history_export(update: Update, export_format):
+    """Формирует выгрузку для анализа (parquet или csv) и отправляет ее в чат одним архивом"""
+    flush_archive_buffer()
+    await update.message.reply_text(f"📦 Готовлю выгрузку истории ({'Parquet' if export_format == 'parquet' else 'CSV.gz'})...",
+                                    reply_markup=get_main_keyboard())
+    target_dir, files = await asyncio.to_thread(export_history, export_format)
+    try:
+        # Parquet разбит на помесячные файлы, поэтому выгрузка отправляется одним zip-архивом
+        archive_path = await asyncio.to_thread(shutil.make_archive, target_dir, 'zip', target_dir)
+        if os.path.getsize(archive_path) > TELEGRAM_MAX_FILE_SIZE:
+            await update.message.reply_text(
+                f"⚠️ Выгрузка больше 50 МБ и сохранена на сервере: {archive_path}\n"
+                "Ее также можно получить командой python export_data.py")
+            return
+        with open(archive_path, 'rb') as archive_file:
+            await update.message.reply_document(
+                document=archive_file,
+                filename=os.path.basename(archive_path),
+                caption=f"📦 История комментариев и постов ({export_format}), файлов: {len(files)}"
+            )
+        os.remove(archive_path)
+    finally:
+        shutil.rmtree(target_dir, ignore_errors=True)
+
+
+# ---------------- Проверка архива по новым ключевым словам ----------------
+ARCHIVE_BACKFILL_CHUNK = 2000
+
+
+async def backfill_keywords_from_archive(context: CallbackContext, keywords, report_chat_id=None, tenant_id=None):
+    """
+    Проверяет сохраненные в архиве комментарии на новые ключевые слова.
+    Архив читается порциями, между которыми управление возвращается боту,
+    поэтому проверка не блокирует обработку сообщений и не делает запросов к VK.
+    В многопользовательском режиме проверяются только группы чата tenant_id.
+    """
+    found_count = 0
+    checked_count = 0
+    last_id = 0
+    tenant_domains = {domain for domain, _ in get_groups(tenant_id)} if tenant_id is not None else None
+
+    logger.info(f"📚 Проверка архива по новым ключевым словам: {', '.join(keywords)}")
+
+    try:
+        while not shutdown_requested:
+            conn = get_db_connection()
+            cursor = conn.cursor()
+            cursor.execute(
+                '''
+                SELECT id, group_domain, owner_id, post_id, comment_id, from_id,
+                       author_name, author_city, author_photo, text, text_norm
+                FROM comment_archive
+                WHERE id > ?
+                ORDER BY id
+                LIMIT ?
+                ''',
+                (last_id, ARCHIVE_BACKFILL_CHUNK)
+            )
+            rows = cursor.fetchall()
+            conn.close()
+
+            if not rows:
+                break
+
+            last_id = rows[-1][0]
+            if tenant_domains is not None:
+                rows = [row for row in rows if row[1] in tenant_domains]
+            checked_count += len(rows)
+
+            # При подписках на ключевые слова комментарий направляется по всем сработавшим словам
+            route_all = tenant_id is None and get_routing_index().has_keyword_subscriptions()
+            found_keywords = await match_comments(
+                [row[10] if row[10] is not None else normalize_text(row[9]) for row in rows], keywords,
+                all_matches=route_all
+            )
+
+            for (_, group_domain, owner_id, post_id, comment_id, from_id,
+                 author_name, author_city, author_photo, text, text_norm), found in zip(rows, found_keywords):
+                if not found or (from_id and from_id < 0):
+                    continue
+                matched_keywords = [keyword for keyword in keywords if keyword in found] if route_all else [found]
+                found_keyword = matched_keywords[0]
+                if not claim_comment(owner_id, post_id, comment_id, found_keyword, tenant_id):
+                    continue
+
+                text_message, comment_excel_data = build_found_comment(
+                    group_domain, owner_id, post_id, comment_id, from_id, text, found_keyword,
+                    author_name or "Неизвестный пользователь", author_city or "не указан"
+                )
+                if not await deliver_comment(context, text_message, author_photo, comment_excel_data, group_domain,
+                                             (owner_id, post_id, comment_id, tenant_id), keywords=matched_keywords):
+                    continue
+                increment_total_comments_count()
+                found_count += 1
+
+            # Отдаем управление обработчикам Telegram между порциями
+            await asyncio.sleep(0.05)
+
+        logger.info(f"📚 Проверка архива завершена: просмотрено {checked_count} комментариев, найдено {found_count}")
+
+        if report_chat_id:
+            await context.bot.send_message(
+                chat_id=report_chat_id,
+                text=f"📚 Проверка архива по новым ключевым словам завершена: "
+                     f"просмотрено {checked_count} комментариев, найдено {found_count}"
+            )
+
+    except Exception as e:
+        logger.error(f"❌ Ошибка проверки архива по новым ключевым словам: {e}")
+
+    return found_count
+
+
+# ---------------- Распределение групп между воркерами ----------------
+class HashRing:
+    """Консистентное хеширование: при добавлении воркера переезжает только часть групп"""
+
+    def __init__(self, nodes, replicas=100):
+        self.ring = []
+        for node in nodes:
+            for i in range(replicas):
+                self.ring.append((self._hash(f"{node}#{i}"), node))
+        self.ring.sort()
+        self.keys = [key for key, _ in self.ring]
+
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+    def get_node(self, key):
+        if not self.ring:
+            return None
+        index = bisect.bisect(self.keys, self._hash(key)) % len(self.ring)
+        return self.ring[index][1]
+
+
+def worker_heartbeat():
+    """Регистрирует воркер или продлевает его аренду"""
+    now = time.time()
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        'INSERT INTO scan_workers (worker_id, heartbeat, started_at) VALUES (?, ?, ?) '
+        'ON CONFLICT(worker_id) DO UPDATE SET heartbeat = excluded.heartbeat',
+        (WORKER_ID, now, now)
+    )
+    # Удаляем воркеры, аренда которых давно истекла
+    cursor.execute('DELETE FROM scan_workers WHERE heartbeat < ?', (now - WORKER_LEASE_TIMEOUT * 10,))
+    conn.commit()
+    conn.close()
+
+
+def unregister_worker():
+    """Снимает воркер с учета при остановке, чтобы его группы сразу перешли к другим"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM scan_workers WHERE worker_id = ?', (WORKER_ID,))
+    conn.commit()
+    conn.close()
+
+
+def get_live_workers():
+    """Возвращает воркеры с действующей арендой"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        'SELECT worker_id FROM scan_workers WHERE heartbeat >= ? ORDER BY worker_id',
+        (time.time() - WORKER_LEASE_TIMEOUT,)
+    )
+    workers = [row[0] for row in cursor.fetchall()]
+    conn.close()
+    return workers
+
+
+def get_worker_groups(groups):
+    """Оставляет только группы, принадлежащие текущему воркеру"""
+    if WORKER_MODE != 'scanner':
+        return groups
+
+    workers, ring = get_worker_ring()
+    own_groups = [(domain, group_id) for domain, group_id in groups if ring.get_node(domain) == WORKER_ID]
+    logger.info(f"🧩 Воркер {WORKER_ID}: {len(own_groups)} из {len(groups)} групп ({len(workers)} воркеров)")
+    return own_groups
+
+
+def get_worker_ring():
+    """Возвращает (воркеры с действующей арендой, кольцо хешей для распределения групп между ними)"""
+    workers = get_live_workers()
+    if WORKER_ID not in workers:
+        workers.append(WORKER_ID)
+    return workers, HashRing(workers)
+
+
+def is_worker_group(group_domain):
+    """Проверяет, принадлежит ли группа текущему воркеру"""
+    return get_worker_ring()[1].get_node(group_domain) == WORKER_ID
+
+
+def claim_comment(owner_id, post_id, comment_id, keyword, tenant_id=None):
+    """
+    Берет комментарий в отправку (в многопользовательском режиме - для чата tenant_id).
+    Возвращает False, если уведомление по нему уже отправлено, стоит в очереди или отправляется
+    другим воркером. Отметка остается в состоянии pending до finish_comment_claim; отметку
+    упавшего процесса можно забрать через NOTIFY_CLAIM_TIMEOUT секунд.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    if tenant_id is None:
+        cursor.execute(
+            '''INSERT INTO notified_comments (owner_id, post_id, comment_id, keyword, status, notified_at)
+               VALUES (?, ?, ?, ?, 'pending', CURRENT_TIMESTAMP)
+               ON CONFLICT (owner_id, post_id, comment_id) DO UPDATE
+               SET keyword = excluded.keyword, notified_at = excluded.notified_at
+               WHERE status = 'pending' AND notified_at < datetime('now', ?)''',
+            (owner_id, post_id, comment_id, keyword, f'-{NOTIFY_CLAIM_TIMEOUT} seconds')
+        )
+    else:
+        cursor.execute(
+            '''INSERT INTO tenant_notified_comments (tenant_id, owner_id, post_id, comment_id, keyword, status,
+                                                    notified_at)
+               VALUES (?, ?, ?, ?, ?, 'pending', CURRENT_TIMESTAMP)
+               ON CONFLICT (tenant_id, owner_id, post_id, comment_id) DO UPDATE
+               SET keyword = excluded.keyword, notified_at = excluded.notified_at
+               WHERE status = 'pending' AND notified_at < datetime('now', ?)''',
+            (tenant_id, owner_id, post_id, comment_id, keyword, f'-{NOTIFY_CLAIM_TIMEOUT} seconds')
+        )
+    claimed = cursor.rowcount == 1
+    conn.commit()
+    conn.close()
+    return claimed
+
+
+def finish_comment_claim(claim, status):
+    """
+    Завершает отправку комментария, взятого claim_comment. claim - (owner_id, post_id, comment_id, tenant_id).
+    status None снимает отметку, чтобы следующая проверка отправила уведомление заново.
+    """
+    owner_id, post_id, comment_id, tenant_id = claim
+    if tenant_id is None:
+        table, where, params = 'notified_comments', '', (owner_id, post_id, comment_id)
+    else:
+        table, where, params = 'tenant_notified_comments', ' AND tenant_id = ?', (owner_id, post_id, comment_id, tenant_id)
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    if status is None:
+        cursor.execute(f'DELETE FROM {table} WHERE owner_id = ? AND post_id = ? AND comment_id = ?{where}', params)
+    else:
+        cursor.execute(
+            f'UPDATE {table} SET status = ? WHERE owner_id = ? AND post_id = ? AND comment_id = ?{where}',
+            (status,) + params
+        )
+    conn.commit()
+    conn.close()
+
+
+def enqueue_outbox(kind, payload):
+    """Ставит событие в очередь для процесса, отвечающего за Telegram"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        'INSERT INTO notification_outbox (kind, payload, created_at) VALUES (?, ?, ?)',
+        (kind, json.dumps(payload, ensure_ascii=False), time.time())
+    )
+    conn.commit()
+    conn.close()
+
+
+def request_scan(target=None, chat_id=None):
+    """
+    Запрашивает у воркеров внеочередную проверку всех групп или только группы target
+    (ее проверяет воркер, которому она принадлежит, и присылает итог в чат chat_id)
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('INSERT INTO scan_requests (requested_at, target, chat_id) VALUES (?, ?, ?)',
+                   (time.time(), target, chat_id))
+    conn.commit()
+    conn.close()
+
+
+def get_last_scan_request():
+    """Возвращает номер последнего запроса на внеочередную проверку"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT MAX(id) FROM scan_requests')
+    result = cursor.fetchone()
+    conn.close()
+    return result[0] or 0
+
+
+def get_scan_requests(after_id):
+    """Возвращает запросы на проверку новее after_id: список (номер, группа или None, чат)"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT id, target, chat_id FROM scan_requests WHERE id > ? ORDER BY id', (after_id,))
+    result = cursor.fetchall()
+    conn.close()
+    return result
+
+
+def record_checked_post(group_domain, group_id, post_id, post_text):
+    """Сохраняет проверенный пост (в режиме воркера - через очередь)"""
+    if WORKER_MODE == 'scanner':
+        enqueue_outbox('post', {
+            'group_domain': group_domain,
+            'group_id': group_id,
+            'post_id': post_id,
+            'post_text': post_text
+        })
+    else:
+        add_post_to_excel(group_domain, group_id, post_id, post_text)
+
+
+def get_comment_chats(group_domain, keywords, tenant_id=None):
+    """
+    Чаты для уведомления: чат-владелец в многопользовательском режиме, иначе по подпискам
+    на группу и любое из сработавших ключевых слов keywords
+    """
+    if tenant_id is not None:
+        return [tenant_id]
+    return get_routing_index().get_chats_for_keywords(group_domain, keywords)
+
+
+async def deliver_comment(context, text_message, photo_url, comment_data, group_domain, claim, record=True,
+                          keywords=None):
+    """
+    Отправляет уведомление в подписанные чаты и сохраняет найденный комментарий
+    (в режиме воркера - ставит в очередь). claim - отметка из claim_comment:
+    после отправки она становится sent, при неудаче снимается и комментарий
+    будет отправлен следующей проверкой. record=False - комментарий уже записан в Excel
+    для другого чата. keywords - все сработавшие ключевые слова (по умолчанию только
+    ключевое слово из comment_data). Возвращает True, если уведомление отправлено или в очереди.
+    """
+    tenant_id = claim[3]
+    keywords = list(keywords or [comment_data['keyword']])
+    if WORKER_MODE == 'scanner':
+        enqueue_outbox('comment', {
+            'text_message': text_message,
+            'photo_url': photo_url,
+            'comment_data': comment_data,
+            'group_domain': group_domain,
+            'tenant_id': tenant_id,
+            'claim': claim,
+            'record': record,
+            'keywords': keywords
+        })
+        finish_comment_claim(claim, 'queued')
+        return True
+
+    chat_ids = get_comment_chats(group_domain, keywords, tenant_id)
+    try:
+        delivered = await send_collapsing_duplicates(context, text_message, photo_url, chat_ids,
+                                                     comment_data['text'], group_domain, tenant_id)
+    except Exception:
+        finish_comment_claim(claim, None)
+        raise
+
+    finish_comment_claim(claim, 'sent' if delivered else None)
+    if delivered and record:
+        add_comment_to_excel(comment_data)
+    return delivered
+
+
+async def deliver_outbox(context: CallbackContext):
+    """
+    Доставляет события, поставленные в очередь воркерами проверки. Событие удаляется только
+    после доставки, неудачная повторяется с растущей паузой, а после OUTBOX_MAX_ATTEMPTS попыток
+    остается в очереди как недоставленное (failed_at)
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        '''SELECT id, kind, payload, attempts FROM notification_outbox
+           WHERE failed_at IS NULL AND next_attempt_at <= ? ORDER BY id LIMIT 100''',
+        (time.time(),)
+    )
+    events = cursor.fetchall()
+    conn.close()
+
+    for event_id, kind, payload, attempts in events:
+        data = None
+        try:
+            data = json_loads(payload)
+            if kind == 'post':
+                add_post_to_excel(data['group_domain'], data['group_id'], data['post_id'], data['post_text'])
+            elif kind == 'message':
+                await context.bot.send_message(data['chat_id'], data['text'])
+            elif kind == 'comment':
+                chat_ids = get_comment_chats(data.get('group_domain'),
+                                             data.get('keywords') or [data['comment_data']['keyword']],
+                                             data.get('tenant_id'))
+                if not await send_collapsing_duplicates(context, data['text_message'], data['photo_url'], chat_ids,
+                                                        data['comment_data']['text'], data.get('group_domain'),
+                                                        data.get('tenant_id')):
+                    raise RuntimeError("уведомление не отправлено ни в один чат")
+                if data.get('record', True):
+                    add_comment_to_excel(data['comment_data'])
+                if data.get('claim'):
+                    finish_comment_claim(data['claim'], 'sent')
+        except Exception as e:
+            attempts += 1
+            conn = get_db_connection()
+            cursor = conn.cursor()
+            if attempts >= OUTBOX_MAX_ATTEMPTS:
+                logger.error(f"❌ Событие {event_id} ({kind}) не доставлено после {attempts} попыток: {e}")
+                cursor.execute(
+                    'UPDATE notification_outbox SET attempts = ?, failed_at = ?, last_error = ? WHERE id = ?',
+                    (attempts, time.time(), str(e), event_id)
+                )
+            else:
+                delay = OUTBOX_RETRY_DELAY * 2 ** (attempts - 1)
+                logger.warning(f"⚠️ Ошибка доставки события {event_id} ({kind}), повтор через "
+                               f"{format_duration(delay)}: {e}")
+                cursor.execute(
+                    'UPDATE notification_outbox SET attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?',
+                    (attempts, time.time() + delay, str(e), event_id)
+                )
+            conn.commit()
+            conn.close()
+            if attempts >= OUTBOX_MAX_ATTEMPTS and data and data.get('claim'):
+                finish_comment_claim(data['claim'], 'failed')
+            continue
+
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM notification_outbox WHERE id = ?', (event_id,))
+        conn.commit()
+        conn.close()
+
+
+async def worker_heartbeat_loop():
+    """Периодически продлевает аренду воркера"""
+    while True:
+        try:
+            worker_heartbeat()
+            update_worker_rate_share(len(set(get_live_workers()) | {WORKER_ID}))
+        except Exception as e:
+            logger.error(f"❌ Ошибка продления аренды воркера: {e}")
+        await asyncio.sleep(WORKER_HEARTBEAT_INTERVAL)
+
+
+async def scan_requested_group(target, chat_id):
+    """Проверяет группу по запросу из Telegram и отправляет итог в чат через очередь"""
+    job = ScanJob(target)
+    try:
+        await check_vk_comments(None, job)
+    except Exception as e:
+        logger.error(f"❌ Ошибка проверки группы {target}: {e}")
+    if chat_id:
+        enqueue_outbox('message', {'chat_id': chat_id, 'text': job.get_progress_text()})
+
+
+async def run_scanner():
+    """Основной цикл воркера проверки (без Telegram)"""
+    stop_event = asyncio.Event()
+    install_shutdown_handlers(stop_event.set)
+
+    worker_heartbeat()
+    heartbeat_task = asyncio.create_task(worker_heartbeat_loop())
+    await start_health_server()
+    start_memory_profiling()
+    backfill_task = None
+    last_request = get_last_scan_request()
+    next_check = time.time() + 10
+
+    try:
+        while not shutdown_requested:
+            scan_requests = get_scan_requests(last_request)
+            if scan_requests:
+                last_request = scan_requests[-1][0]
+            targets = {target: chat_id for _, target, chat_id in scan_requests if target}
+            if time.time() >= next_check or len(targets) < len(scan_requests):
+                await periodic_check(None)
+                next_check = time.time() + CHECK_INTERVAL
+            # Отдельную группу проверяет только воркер, которому она принадлежит
+            for target, chat_id in targets.items():
+                if not shutdown_requested and is_worker_group(target):
+                    await scan_requested_group(target, chat_id)
+            # История новых групп проверяется параллельно и уступает запросы основной проверке
+            if backfill_task is None or backfill_task.done():
+                backfill_task = asyncio.create_task(historical_backfill(None))
+            try:
+                await asyncio.wait_for(stop_event.wait(), timeout=5)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        await finish_running_scan()
+        if backfill_task and not backfill_task.done():
+            await asyncio.wait({backfill_task}, timeout=SHUTDOWN_TIMEOUT)
+        heartbeat_task.cancel()
+        unregister_worker()
+        shutdown_match_pool()
+        await close_http_session()
+        await stop_health_server()
+        stop_memory_profiling()
+
+
+# ---------------- Контрольные точки проверки и корректная остановка ----------------
+def get_checkpoint_scope():
+    """Контрольная точка своя у каждого воркера проверки (WORKER_ID для них задается явно)"""
+    return WORKER_ID if WORKER_MODE == 'scanner' else 'main'
+
+
+def load_scan_checkpoint():
+    """Возвращает (группа, последний проверенный пост) прерванной проверки или (None, None)"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        'SELECT group_domain, post_id FROM scan_checkpoints WHERE scope = ?',
+        (get_checkpoint_scope(),)
+    )
+    result = cursor.fetchone()
+    conn.close()
+    return result if result else (None, None)
+
+
+def save_scan_checkpoint(group_domain, post_id):
+    """Запоминает, до какого поста проверена группа"""
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute(
+            'INSERT OR REPLACE INTO scan_checkpoints (scope, group_domain, post_id, updated_at) '
+            'VALUES (?, ?, ?, ?)',
+            (get_checkpoint_scope(), group_domain, post_id, time.time())
+        )
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        logger.error(f"❌ Ошибка сохранения контрольной точки проверки: {e}")
+
+
+def clear_scan_checkpoint():
+    """Удаляет контрольную точку после полного цикла проверки"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM scan_checkpoints WHERE scope = ?', (get_checkpoint_scope(),))
+    conn.commit()
+    conn.close()
+
+
+def cancel_running_scan():
+    """Прерывает проверку, не успевшую завершиться за SHUTDOWN_TIMEOUT секунд"""
+    if current_scan_task and not current_scan_task.done():
+        logger.warning(f"⏱ Проверка не завершилась за {SHUTDOWN_TIMEOUT} сек, прерываем")
+        current_scan_task.cancel()
+
+
+def request_shutdown(stop_callback):
+    """
+    Обработчик SIGTERM/SIGINT: проверка останавливается на ближайшей контрольной точке,
+    а если не успевает за SHUTDOWN_TIMEOUT секунд - прерывается.
+    """
+    global shutdown_requested
+
+    if shutdown_requested:
+        return
+
+    shutdown_requested = True
+    logger.info("🛑 Получен сигнал остановки, завершаем текущие запросы...")
+    asyncio.get_running_loop().call_later(SHUTDOWN_TIMEOUT, cancel_running_scan)
+    stop_callback()
+
+
+def install_shutdown_handlers(stop_callback):
+    """Устанавливает обработчики сигналов остановки в текущем цикле событий"""
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, request_shutdown, stop_callback)
+        except (NotImplementedError, RuntimeError):
+            # На Windows обработчики сигналов в цикле событий не поддерживаются
+            pass
+
+
+async def finish_running_scan():
+    """Дожидается завершения текущей проверки и записывает буферы на диск"""
+    task = current_scan_task
+    if task and not task.done() and task is not asyncio.current_task():
+        await asyncio.wait({task}, timeout=SHUTDOWN_TIMEOUT)
+        if not task.done():
+            task.cancel()
+            await asyncio.wait({task})
+
+    flush_archive_buffer()
+
+
+async def on_post_init(application: Application):
+    """Перехватываем сигналы остановки, чтобы проверка успела сохранить прогресс"""
+    install_shutdown_handlers(application.stop_running)
+    application.create_task(leader_heartbeat_loop(application))
+    await start_health_server()
+    start_memory_profiling()
+
+
+async def on_post_stop(application: Application):
+    """Завершение текущей проверки и запись буферов перед остановкой"""
+    await finish_running_scan()
+    await close_http_session()
+    await stop_health_server()
+    stop_memory_profiling()
+    # Резервный экземпляр может сразу занять место ведущего
+    release_leader_lease()
+
+
+# ---------------- Единственный активный экземпляр ----------------
+def try_acquire_leader_lease():
+    """
+    Занимает или продлевает аренду ведущего экземпляра.
+    Возвращает True, если аренда за этим экземпляром, иначе False.
+    """
+    now = time.time()
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        '''
+        INSERT INTO leader_lease (name, holder, expires_at, heartbeat) VALUES ('telegram', ?, ?, ?)
+        ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at,
+                                        heartbeat = excluded.heartbeat
+        WHERE leader_lease.holder = excluded.holder OR leader_lease.expires_at < ?
+        ''',
+        (LEADER_ID, now + LEADER_LEASE_TIMEOUT, now, now)
+    )
+    acquired = cursor.rowcount == 1
+    conn.commit()
+    conn.close()
+    return acquired
+
+
+def get_leader_lease():
+    """Возвращает (владелец, время окончания аренды) или None"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT holder, expires_at FROM leader_lease WHERE name = 'telegram'")
+    result = cursor.fetchone()
+    conn.close()
+    return result
+
+
+def release_leader_lease():
+    """Освобождает аренду при остановке"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM leader_lease WHERE name = 'telegram' AND holder = ?", (LEADER_ID,))
+    conn.commit()
+    conn.close()
+
+
+async def wait_for_leader_lease():
+    """
+    Резервный экземпляр ждет, пока ведущий остановится или перестанет продлевать аренду.
+    Пока он ждет, проверка состояния отвечает, что экземпляр исправен (standby).
+    """
+    if not try_acquire_leader_lease():
+        lease = get_leader_lease()
+        holder = lease[0] if lease else "неизвестен"
+        logger.info(f"⏸ Ведущий экземпляр {holder} уже работает, ожидаем освобождения аренды...")
+        health_state['standby'] = True
+        await start_health_server()
+        try:
+            while not try_acquire_leader_lease():
+                await asyncio.sleep(LEADER_HEARTBEAT_INTERVAL)
+        finally:
+            await stop_health_server()
+            health_state['standby'] = False
+    logger.info(f"👑 Экземпляр {LEADER_ID} стал ведущим")
+
+
+async def leader_heartbeat_loop(application: Application):
+    """Продлевает аренду ведущего. Если аренду занял другой экземпляр, этот останавливается"""
+    while not shutdown_requested:
+        await asyncio.sleep(LEADER_HEARTBEAT_INTERVAL)
+        try:
+            acquired = await asyncio.to_thread(try_acquire_leader_lease)
+        except Exception as e:
+            logger.error(f"❌ Ошибка продления аренды ведущего: {e}")
+            continue
+        if not acquired:
+            logger.error("❌ Аренда ведущего потеряна (другой экземпляр занял ее), останавливаемся")
+            request_shutdown(application.stop_running)
+            return
+
+
+# ---------------- Схлопывание повторяющихся комментариев ----------------
+# Сколько секунд помнить отправленные комментарии (0 - не схлопывать повторы)
+DUPLICATE_WINDOW = int(os.getenv("DUPLICATE_WINDOW", "3600"))
+# Максимальное число различающихся бит SimHash у почти одинаковых текстов
+# (замена одного слова в комментарии из 10 слов дает 6-8 бит, разные тексты - от 15)
+DUPLICATE_MAX_DISTANCE = max(0, min(15, int(os.getenv("DUPLICATE_MAX_DISTANCE", "8"))))
+# Короткие комментарии часто совпадают без всякого спама, их не схлопываем
+DUPLICATE_MIN_TOKENS = 5
+# Не больше стольких отпечатков в памяти, даже если за DUPLICATE_WINDOW их набралось больше
+DUPLICATE_MAX_ALERTS = int(os.getenv("DUPLICATE_MAX_ALERTS", "5000"))
+SIMHASH_SHINGLE = 4
+# Отпечаток делится на DUPLICATE_MAX_DISTANCE + 1 полос: у отпечатков, различающихся не больше
+# чем в DUPLICATE_MAX_DISTANCE битах, хотя бы одна полоса совпадает, поэтому кандидатов ищем по полосам
+SIMHASH_BANDS = DUPLICATE_MAX_DISTANCE + 1
+SIMHASH_BAND_BITS = 64 // SIMHASH_BANDS
+
+
+def simhash(text_norm):
+    """64-битный SimHash нормализованного текста по 4-символьным фрагментам (None для коротких текстов)"""
+    tokens = TOKEN_PATTERN.findall(text_norm)
+    if len(tokens) < DUPLICATE_MIN_TOKENS:
+        return None
+
+    text = ' '.join(tokens)
+    weights = [0] * 64
+    for feature in {text[i:i + SIMHASH_SHINGLE] for i in range(len(text) - SIMHASH_SHINGLE + 1)}:
+        value = int.from_bytes(hashlib.blake2b(feature.encode(), digest_size=8).digest(), 'big')
+        for bit in range(64):
+            weights[bit] += 1 if value >> bit & 1 else -1
+
+    return sum(1 << bit for bit in range(64) if weights[bit] > 0)
+
+
+def format_groups_count(count):
+    return f"{count} группе" if count % 10 == 1 and count % 100 != 11 else f"{count} группах"
+
+
+class DuplicateAlert:
+    """Уведомление о комментарии, к которому присоединяются его повторы из других групп"""
+
+    def __init__(self, fingerprint, group_domain, tenant_id=None):
+        self.fingerprint = fingerprint
+        self.tenant_id = tenant_id
+        self.created_at = time.time()
+        self.groups = {group_domain}
+        # (chat_id, message_id, с фото ли сообщение, исходный текст уведомления)
+        self.messages = []
+
+    def get_text(self, text_message):
+        if len(self.groups) < 2:
+            return text_message
+        return f"{text_message}\n\n🔁 <b>Замечено в {format_groups_count(len(self.groups))}</b>"
+
+
+class FingerprintIndex:
+    """
+    Отпечатки комментариев, отправленных за последние DUPLICATE_WINDOW секунд.
+    В многопользовательском режиме у каждого чата-владельца свои отпечатки: повторы
+    схлопываются только с уведомлениями того же чата
+    """
+
+    def __init__(self, window, max_distance, max_alerts):
+        self.window = window
+        self.max_distance = max_distance
+        self.max_alerts = max_alerts
+        self.bands = {}
+        self.alerts = deque()
+
+    def __len__(self):
+        return len(self.alerts)
+
+    @staticmethod
+    def get_band_keys(fingerprint, tenant_id=None):
+        mask = (1 << SIMHASH_BAND_BITS) - 1
+        return [(tenant_id, band, fingerprint >> (band * SIMHASH_BAND_BITS) & mask) for band in range(SIMHASH_BANDS)]
+
+    def drop_oldest(self):
+        alert = self.alerts.popleft()
+        for key in self.get_band_keys(alert.fingerprint, alert.tenant_id):
+            bucket = self.bands[key]
+            bucket.remove(alert)
+            if not bucket:
+                del self.bands[key]
+
+    def expire(self):
+        cutoff = time.time() - self.window
+        while self.alerts and self.alerts[0].created_at < cutoff:
+            self.drop_oldest()
+
+    def find(self, fingerprint, tenant_id=None):
+        self.expire()
+        for key in self.get_band_keys(fingerprint, tenant_id):
+            for alert in self.bands.get(key, ()):
+                if bin(alert.fingerprint ^ fingerprint).count('1') <= self.max_distance:
+                    return alert
+        return None
+
+    def add(self, alert):
+        self.alerts.append(alert)
+        for key in self.get_band_keys(alert.fingerprint, alert.tenant_id):
+            self.bands.setdefault(key, []).append(alert)
+        while len(self.alerts) > self.max_alerts:
+            self.drop_oldest()
+
+
+duplicate_index = FingerprintIndex(DUPLICATE_WINDOW, DUPLICATE_MAX_DISTANCE, DUPLICATE_MAX_ALERTS)
+
+
+async def update_duplicate_alert(context, alert):
+    """Обновляет счетчик групп в уже отправленных уведомлениях"""
+    for chat_id, message_id, is_photo, text_message in alert.messages:
+        text = alert.get_text(text_message)
+        try:
+            if is_photo:
+                await context.bot.edit_message_caption(
+                    chat_id=chat_id, message_id=message_id, caption=text, parse_mode='HTML')
+            else:
+                await context.bot.edit_message_text(
+                    text, chat_id=chat_id, message_id=message_id,
+                    parse_mode='HTML', disable_web_page_preview=True)
+        except TelegramError as e:
+            logger.debug(f"Не удалось обновить уведомление в чате {chat_id}: {e}")
+
+
+async def send_collapsing_duplicates(context, text_message, photo_url, chat_ids, text, group_domain, tenant_id=None):
+    """
+    Отправляет уведомление, но почти одинаковый комментарий, уже отправленный недавно
+    (например, спам в нескольких группах), не отправляется повторно: в исходных
+    уведомлениях обновляется счетчик "Замечено в N группах".
+    Возвращает False, если уведомление не удалось отправить ни в один чат.
+    """
+    if chat_ids is None:
+        chat_ids = [chat[0] for chat in get_all_chats()]
+    if not chat_ids:
+        return True
+
+    fingerprint = simhash(normalize_text(text)) if DUPLICATE_WINDOW > 0 else None
+    if fingerprint is None:
+        return bool(await send_notification_with_photo(context, text_message, photo_url, chat_ids))
+
+    alert = duplicate_index.find(fingerprint, tenant_id)
+    is_new = alert is None
+    if is_new:
+        alert = DuplicateAlert(fingerprint, group_domain, tenant_id)
+    else:
+        logger.info(f"🔁 Повтор комментария в группе {group_domain} схлопнут с уже отправленным уведомлением")
+        if group_domain not in alert.groups:
+            alert.groups.add(group_domain)
+            await update_duplicate_alert(context, alert)
+
+        # Уведомление получают только чаты, которым исходное не отправлялось (другие подписки)
+        notified_chats = {message[0] for message in alert.messages}
+        chat_ids = [chat_id for chat_id in chat_ids if chat_id not in notified_chats]
+
+    if not chat_ids:
+        return True
+    sent = await send_notification_with_photo(context, alert.get_text(text_message), photo_url, chat_ids)
+    alert.messages.extend(message + (text_message,) for message in sent)
+    # Отпечаток запоминается только после отправки: неотправленное уведомление не должно скрывать повторы
+    if is_new and sent:
+        duplicate_index.add(alert)
+    return bool(sent)
+
+
+# ---------------- Улучшенная функция отправки уведомлений с фото ----------------
+async def send_notification_with_photo(context: CallbackContext, text_message: str, photo_url: str = None,
+                                      chat_ids=None):
+    """
+    Улучшенная функция отправки уведомлений с фото пользователя под текстом.
+    chat_ids - чаты-получатели (по умолчанию все чаты для уведомлений).
+    Фото загружается один раз, в остальные чаты отправляется по file_id из Telegram.
+    Возвращает [(chat_id, message_id, с фото ли сообщение)] отправленных сообщений.
+    """
+    sent = []
+
+    if chat_ids is None:
+        chat_ids = [chat[0] for chat in get_all_chats()]
+    if not chat_ids:
+        return sent
+
+    photo = await download_photo(photo_url) if photo_url else None
+
+    for chat_id in chat_ids:
+        max_retries = 3
+        for attempt in range(max_retries):
+            try:
+                # Если есть фото, отправляем его с текстом как caption
+                if photo:
+                    if hasattr(photo, 'seek'):
+                        photo.seek(0)
+                    message = await context.bot.send_photo(
+                        chat_id=chat_id,
+                        photo=photo,
+                        caption=text_message,
+                        parse_mode='HTML'
+                    )
+                    if message.photo:
+                        photo = message.photo[-1].file_id
+                    sent.append((chat_id, message.message_id, True))
+                else:
+                    # Если нет фото или его не удалось загрузить, отправляем только текст
+                    message = await context.bot.send_message(
+                        chat_id=chat_id,
+                        text=text_message,
+                        disable_web_page_preview=True,
+                        parse_mode='HTML'
+                    )
+                    sent.append((chat_id, message.message_id, False))
+                break
+            except NetworkError as e:
+                if attempt == max_retries - 1:
+                    pass
+                else:
+                    await asyncio.sleep(2 * (attempt + 1))
+            except Exception as e:
+                break
+
+        await asyncio.sleep(0.1)
+
+    return sent
+
+
+# ---------------- Формирование уведомления о найденном комментарии ----------------
+def build_found_comment(group_domain, owner_id, post_id, comment_id, from_id, text, keyword, user_name, city):
+    """Возвращает текст уведомления и данные для Excel по найденному комментарию"""
+    group_link = f"https://vk.com/{group_domain}"
+    post_link = f"https://vk.com/wall{owner_id}_{post_id}?reply={comment_id}"
+    user_link = f"https://vk.com/id{from_id}" if from_id else "не доступно"
+
+    # Формируем текстовое сообщение с новым порядком полей
+    text_message = (
+        "⚡ Хром работал 24/7 и обнаружил комментарий, необходимо включиться!\n\n"
+        f"💬 <b>Текст комментария:</b>\n"
+        f"{user_name}: {text[:500]}\n\n"
+        f"🔗 <b>Ссылка на страницу пользователя:</b> {user_link}\n"
+        f"🌍 <b>Город:</b> {city}\n"
+        f"🔗 <b>Ссылка на комментарий:</b> {post_link}\n"
+        f"🔗 <b>Ссылка на группу:</b> {group_link}\n"
+        f"🔍 <b>Маркер:</b> {keyword}"
+    )
+
+    # Подготавливаем данные для Excel в новом порядке
+    comment_excel_data = {
+        'user_name': user_name,
+        'user_link': user_link,
+        'city': city,
+        'text': text,
+        'comment_link': post_link,
+        'keyword': keyword,
+        'detection_date': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    }
+
+    return text_message, comment_excel_data
+
+
+# ---------------- Фоновые проверки ----------------
+# Как часто обновлять сообщение с прогрессом проверки (Telegram ограничивает частоту редактирования)
+SCAN_PROGRESS_INTERVAL = 5
+
+# Выполняющаяся проверка и ожидающие своей очереди ручные проверки
+scan_jobs = []
+
+
+def format_duration(seconds):
+    """Короткая запись длительности для сообщений о прогрессе"""
+    seconds = int(seconds)
+    if seconds < 60:
+        return f"{seconds} сек"
+    if seconds < 3600:
+        return f"{seconds // 60} мин"
+    return f"{seconds // 3600} ч {seconds % 3600 // 60} мин"
+
+
+class ScanJob:
+    """Проверка групп (плановая или ручная) и сообщения, в которых показывается ее прогресс"""
+
+    def __init__(self, target=None):
+        self.target = target
+        self.total_groups = 0
+        self.done_groups = 0
+        self.found = 0
+        self.started_at = None
+        self.finished = False
+        self.interrupted = False
+        self.timed_out = False
+        # Проверка завершилась ошибкой (не считается успешной для проверки состояния)
+        self.failed = False
+        self.last_report = 0
+        # (chat_id, message_id) сообщений с прогрессом
+        self.watchers = []
+
+    def get_progress_text(self):
+        title = f"Проверка группы {self.target}" if self.target else "Проверка всех групп"
+
+        if self.finished:
+            if self.timed_out:
+                return (f"⏱ {title} прервана: не уложилась в {format_duration(SCAN_DEADLINE)}. "
+                        f"Обработано {self.done_groups} из {self.total_groups} групп, найдено {self.found}. "
+                        f"Следующая проверка продолжит с того же места.")
+            if self.interrupted:
+                return (f"🛑 {title} остановлена: обработано {self.done_groups} из {self.total_groups} групп, "
+                        f"найдено {self.found}. Продолжится после перезапуска.")
+            if self.found > 0:
+                return (f"✅ {title} завершена! Обработано {self.done_groups} групп, "
+                        f"найдено {self.found} новых комментариев с ключевыми словами.")
+            return (f"✅ {title} завершена! Обработано {self.done_groups} групп, "
+                    f"новых комментариев с ключевыми словами не найдено.")
+
+        if self.started_at is None:
+            return f"⏳ {title} ожидает завершения текущей проверки..."
+
+        text = f"🔄 {title}: {self.done_groups}/{self.total_groups} групп, найдено {self.found}"
+        if self.done_groups:
+            elapsed = time.time() - self.started_at
+            remaining = elapsed / self.done_groups * (self.total_groups - self.done_groups)
+            text += f", осталось ~{format_duration(remaining)}"
+        return text
+
+    async def report(self, bot, force=False):
+        """Обновляет сообщения с прогрессом, но не чаще раза в SCAN_PROGRESS_INTERVAL секунд"""
+        if not self.watchers or bot is None:
+            return
+
+        now = time.time()
+        if not force and now - self.last_report < SCAN_PROGRESS_INTERVAL:
+            return
+        self.last_report = now
+
+        text = self.get_progress_text()
+        for chat_id, message_id in self.watchers:
+            try:
+                await bot.edit_message_text(text, chat_id=chat_id, message_id=message_id)
+            except TelegramError as e:
+                # Текст не изменился или сообщение удалено - прогресс просто не обновится
+                logger.debug(f"Не удалось обновить прогресс проверки в чате {chat_id}: {e}")
+
+
+def find_scan_job(target=None):
+    """Ищет выполняющуюся или ожидающую проверку тех же групп"""
+    for job in scan_jobs:
+        if job.target == target and not job.finished:
+            return job
+    return None
+
+
+async def start_manual_scan(update: Update, context: ContextTypes.DEFAULT_TYPE, target=None):
+    """
+    Запускает ручную проверку в фоне. Если такая проверка уже идет или ждет очереди,
+    сообщение с прогрессом подключается к ней.
+    """
+    job = find_scan_job(target)
+    is_new = job is None
+    if is_new:
+        job = ScanJob(target)
+        scan_jobs.append(job)
+        logger.info(f"🔄 Ручная проверка запущена пользователем{f' для группы {target}' if target else ''}")
+    else:
+        logger.info("🔄 Ручная проверка присоединена к уже идущей проверке")
+
+    message = await update.message.reply_text(
+        job.get_progress_text() if is_new else f"🔁 Проверка уже выполняется, показываю ее прогресс.\n{job.get_progress_text()}"
+    )
+    job.watchers.append((message.chat_id, message.message_id))
+
+    if is_new:
+        context.application.create_task(check_vk_comments(context, job))
+    elif job.finished:
+        await job.report(context.bot, force=True)
+
+
+async def check_vk_comments(context: CallbackContext, job=None):
+    """
+    Запускает проверку групп. Плановая проверка пропускается, если уже идет другая,
+    ручные проверки (job) ждут своей очереди. Возвращает (обработано групп, найдено).
+    """
+    if job is None:
+        if scan_lock.locked():
+            logger.info("🔁 Проверка уже выполняется, пропускаем...")
+            return 0, 0
+        job = ScanJob()
+
+    if job not in scan_jobs:
+        scan_jobs.append(job)
+
+    try:
+        async with scan_lock:
+            if shutdown_requested:
+                job.interrupted = True
+                return 0, 0
+            # Проверка идет в отдельной задаче: cancel_running_scan прерывает только ее,
+            # а не вызвавший цикл (например, цикл воркера проверки)
+            scan_task = asyncio.create_task(scan_groups(context, job))
+            try:
+                # Зависший запрос не должен навсегда занять очередь проверок
+                done, _ = await asyncio.wait({scan_task}, timeout=SCAN_DEADLINE or None)
+            except asyncio.CancelledError:
+                scan_task.cancel()
+                raise
+            if not done:
+                scan_task.cancel()
+                await asyncio.wait({scan_task})
+                job.timed_out = True
+                await report_stuck_scan(context, job)
+                return job.done_groups, job.found
+            if scan_task.cancelled():
+                # Проверку прервал cancel_running_scan при остановке
+                return job.done_groups, job.found
+            result = scan_task.result()
+            if not job.interrupted and not job.failed and not job.target:
+                health_state['last_success'] = time.time()
+            return result
+    finally:
+        job.finished = True
+        scan_jobs.remove(job)
+        if context is not None:
+            try:
+                await job.report(context.bot, force=True)
+            except Exception as e:
+                logger.error(f"❌ Ошибка отправки итогов проверки: {e}")
+
+
+# ---------------- Сторожевой таймер и проверка состояния ----------------
+# HTTP-порт проверки состояния для Docker и мониторинга (0 - отключено)
+HEALTH_PORT = int(os.getenv("HEALTH_PORT", "8080"))
+HEALTH_HOST = os.getenv("HEALTH_HOST", "0.0.0.0")
+LOOP_LAG_INTERVAL = 1
+# При большей задержке цикла событий бот считается неготовым
+LOOP_LAG_LIMIT = 5
+
+health_state = {
+    'started_at': time.time(),
+    'last_success': None,
+    'loop_lag': 0.0,
+    'stuck_scans': 0,
+    'last_stuck_at': None,
+    # Резервный экземпляр, ожидающий аренды ведущего, исправен
+    'standby': False,
+}
+health_runner = None
+loop_lag_task = None
+
+
+async def report_stuck_scan(context, job):
+    """Сообщает о проверке, прерванной сторожевым таймером"""
+    health_state['stuck_scans'] += 1
+    health_state['last_stuck_at'] = time.time()
+    logger.error(f"⏱ Проверка не уложилась в {format_duration(SCAN_DEADLINE)} и прервана "
+                 f"(обработано {job.done_groups} из {job.total_groups} групп)")
+
+    # Ручную проверку видно по сообщению с прогрессом, о плановой сообщаем в чаты уведомлений
+    if context is None or job.watchers or MULTI_TENANT:
+        return
+    text = (f"⚠️ Проверка групп зависла и прервана через {format_duration(SCAN_DEADLINE)}: "
+            f"обработано {job.done_groups} из {job.total_groups} групп. "
+            f"Следующая проверка продолжит с того же места.")
+    for chat_id, _, _ in get_all_chats():
+        try:
+            await context.bot.send_message(chat_id, text)
+        except TelegramError as e:
+            logger.debug(f"Не удалось отправить сообщение о зависшей проверке в чат {chat_id}: {e}")
+
+
+async def monitor_loop_lag():
+    """Измеряет задержку цикла событий: насколько позже запланированного просыпается sleep"""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        health_state['loop_lag'] = max(0.0, loop.time() - started - LOOP_LAG_INTERVAL)
+
+
+def get_outbox_depth():
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT COUNT(*) FROM notification_outbox WHERE failed_at IS NULL')
+    depth = cursor.fetchone()[0]
+    conn.close()
+    return depth
+
+
+def get_health_report():
+    """Состояние процесса: последняя успешная проверка, задержка цикла событий, очереди"""
+    now = time.time()
+    last_success = health_state['last_success']
+    running = [job for job in scan_jobs if job.started_at and not job.finished]
+
+    # Плановая проверка должна завершаться хотя бы раз за пару интервалов (с учетом ее длительности)
+    stale_after = CHECK_INTERVAL * 2 + (SCAN_DEADLINE or CHECK_INTERVAL)
+    scans_ok = (WORKER_MODE == 'frontend'
+                or now - (last_success or health_state['started_at']) < stale_after)
+    ready = ((scans_ok or health_state['standby'])
+             and health_state['loop_lag'] < LOOP_LAG_LIMIT and not shutdown_requested)
+
+    return {
+        'status': ('standby' if health_state['standby'] else 'ok') if ready else 'degraded',
+        'ready': ready,
+        'mode': WORKER_MODE,
+        'worker_id': WORKER_ID,
+        'uptime': round(now - health_state['started_at']),
+        'last_success': datetime.fromtimestamp(last_success).isoformat(timespec='seconds') if last_success else None,
+        'last_success_age': round(now - last_success) if last_success else None,
+        'loop_lag_ms': round(health_state['loop_lag'] * 1000, 1),
+        'scan_running_for': round(now - running[0].started_at) if running else None,
+        'scan_queue': len(scan_jobs),
+        'outbox_depth': get_outbox_depth(),
+        'archive_buffer': len(archive_buffer),
+        'stuck_scans': health_state['stuck_scans'],
+        'quarantined_groups': len(get_quarantined_groups()),
+        'rss_bytes': get_rss_bytes(),
+    }
+
+
+async def handle_health_request(request):
+    """
+    /health - процесс жив (всегда 200), /ready - 200 или 503 в зависимости от состояния.
+    Тело ответа - JSON с показателями.
+    """
+    report = await asyncio.to_thread(get_health_report)
+    status = 503 if request.path == '/ready' and not report['ready'] else 200
+    return web.json_response(report, status=status, dumps=lambda data: json.dumps(data, ensure_ascii=False))
+
+
+async def start_health_server():
+    """Запускает HTTP-сервер проверки состояния и измерение задержки цикла событий"""
+    global health_runner, loop_lag_task
+    loop_lag_task = asyncio.create_task(monitor_loop_lag())
+    if HEALTH_PORT <= 0:
+        return
+    app = web.Application()
+    app.router.add_get('/health', handle_health_request)
+    app.router.add_get('/ready', handle_health_request)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, HEALTH_HOST, HEALTH_PORT).start()
+    except OSError as e:
+        logger.error(f"❌ Не удалось открыть порт проверки состояния {HEALTH_PORT}: {e}")
+        await runner.cleanup()
+        return
+    health_runner = runner
+    logger.info(f"🩺 Проверка состояния: http://{HEALTH_HOST}:{HEALTH_PORT}/health")
+
+
+async def stop_health_server():
+    global health_runner, loop_lag_task
+    if loop_lag_task:
+        loop_lag_task.cancel()
+        loop_lag_task = None
+    if health_runner:
+        await health_runner.cleanup()
+        health_runner = None
+
+
+# ---------------- Профилирование памяти ----------------
+# Замеры RSS и tracemalloc (1 - включить; tracemalloc замедляет работу на 10-30%)
+MEMORY_PROFILING = os.getenv("MEMORY_PROFILING", "0") == "1"
+MEMORY_SAMPLE_INTERVAL = int(os.getenv("MEMORY_SAMPLE_INTERVAL", "300"))
+MEMORY_TOP_STATS = 10
+
+# (время, RSS, память под tracemalloc) - последние двое суток при интервале по умолчанию
+memory_samples = deque(maxlen=576)
+# Снимок после первого интервала: рост считается от него, а не от импорта модулей при запуске
+memory_baseline = None
+memory_task = None
+
+
+def get_rss_bytes():
+    """Текущий RSS процесса (только Linux, иначе None)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def format_bytes(size):
+    if size is None:
+        return "н/д"
+    for unit in ("Б", "КБ", "МБ"):
+        if abs(size) < 1024:
+            return f"{size:.0f} {unit}" if unit == "Б" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.2f} ГБ"
+
+
+def take_memory_sample():
+    traced = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+    memory_samples.append((time.time(), get_rss_bytes(), traced))
+
 
+def get_trace_location(stat):
+    frame = stat.traceback[0]
+    return f"{os.path.basename(frame.filename)}:{frame.lineno}"
 
-def add_keyword(keyword: str):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('INSERT OR IGNORE INTO keywords (keyword) VALUES (?)', (keyword,))
-    conn.commit()
-    conn.close()
 
+def get_memory_snapshot():
+    """Снимок tracemalloc без служебных выделений самого tracemalloc и импорта модулей"""
+    return tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    ))
 
-def delete_group(domain: str):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM vk_groups WHERE domain = ?', (domain,))
-    conn.commit()
-    conn.close()
 
+def get_memory_growth(snapshot, limit=MEMORY_TOP_STATS):
+    """Места с наибольшим ростом памяти с момента первого замера"""
+    if memory_baseline is None:
+        return []
+    return [stat for stat in snapshot.compare_to(memory_baseline, 'lineno') if stat.size_diff > 0][:limit]
 
-def delete_keyword(keyword: str):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM keywords WHERE keyword = ?', (keyword,))
-    conn.commit()
-    conn.close()
 
+def get_memory_text():
+    """
+    Отчет для /memory: RSS и его рост, заполненность кэшей. Читает структуры,
+    которые меняет цикл событий, поэтому вызывается в нем же
+    """
+    lines = [f"🧠 Память процесса: {format_bytes(get_rss_bytes())}"]
+
+    samples = [sample for sample in memory_samples if sample[1] is not None]
+    if len(samples) >= 2:
+        (first_time, first_rss, _), (last_time, last_rss, _) = samples[0], samples[-1]
+        hours = max((last_time - first_time) / 3600, 1 / 60)
+        lines.append(f"📈 За {format_duration(last_time - first_time)}: {format_bytes(first_rss)} → "
+                     f"{format_bytes(last_rss)} ({format_bytes((last_rss - first_rss) / hours)}/ч), "
+                     f"максимум {format_bytes(max(sample[1] for sample in samples))}")
+
+    lines.append("\n📦 Кэши (записей / предел, попадания):")
+    for name, (size, limit, count, hits, misses, evictions) in get_cache_stats().items():
+        hit_rate = f"{hits * 100 // (hits + misses)}%" if hits + misses else "-"
+        copies = f" в {count} наборах" if count > 1 else ""
+        lines.append(f"• {name}: {size} / {limit}{copies}, {hit_rate}, вытеснено {evictions}")
+    lines.append(f"• duplicates: {len(duplicate_index)} / {DUPLICATE_MAX_ALERTS}")
+    lines.append(f"• archive_buffer: {len(archive_buffer)} / {ARCHIVE_FLUSH_ROWS}")
+
+    if not tracemalloc.is_tracing():
+        lines.append("\nℹ️ Подробный отчет о выделениях памяти: MEMORY_PROFILING=1")
+    return "\n".join(lines)
+
+
+def get_tracemalloc_text():
+    """Крупнейшие и растущие выделения памяти для /memory (снимок tracemalloc, можно вызывать в потоке)"""
+    snapshot = get_memory_snapshot()
+    traced, peak = tracemalloc.get_traced_memory()
+    lines = [f"🔬 tracemalloc: {format_bytes(traced)}, пик {format_bytes(peak)}"]
+    lines.append("Крупнейшие выделения:")
+    for stat in snapshot.statistics('lineno')[:MEMORY_TOP_STATS]:
+        lines.append(f"• {format_bytes(stat.size)} ({stat.count} блоков) {get_trace_location(stat)}")
+
+    growth = get_memory_growth(snapshot)
+    if growth:
+        lines.append("Рост с первого замера:")
+        for stat in growth:
+            lines.append(f"• +{format_bytes(stat.size_diff)} {get_trace_location(stat)}")
+    elif memory_baseline is None:
+        lines.append(f"Рост появится после первого замера (через {format_duration(MEMORY_SAMPLE_INTERVAL)} после запуска)")
+    return "\n".join(lines)
+
+
+async def memory_sampler_loop():
+    """Периодические замеры памяти; воркер проверки без Telegram видит рост только в логе"""
+    global memory_baseline
+    while True:
+        await asyncio.sleep(MEMORY_SAMPLE_INTERVAL)
+        take_memory_sample()
+        _, rss, traced = memory_samples[-1]
+        if memory_baseline is None:
+            memory_baseline = await asyncio.to_thread(get_memory_snapshot)
+            logger.info(f"🧠 Память: RSS {format_bytes(rss)}, tracemalloc {format_bytes(traced)} (первый замер)")
+            continue
+
+        growth = await asyncio.to_thread(lambda: get_memory_growth(get_memory_snapshot(), 3))
+        top = ", ".join(f"{get_trace_location(stat)} +{format_bytes(stat.size_diff)}" for stat in growth)
+        logger.info(f"🧠 Память: RSS {format_bytes(rss)}, tracemalloc {format_bytes(traced)}"
+                    + (f", рост: {top}" if top else ""))
+
+
+def start_memory_profiling():
+    """Включает tracemalloc и периодические замеры, если задано MEMORY_PROFILING"""
+    global memory_task
+    take_memory_sample()
+    if not MEMORY_PROFILING or memory_task is not None:
+        return
+    tracemalloc.start()
+    memory_task = asyncio.create_task(memory_sampler_loop())
+    logger.info(f"🧠 Профилирование памяти включено, замер каждые {format_duration(MEMORY_SAMPLE_INTERVAL)}")
+
+
+def stop_memory_profiling():
+    global memory_task
+    if memory_task:
+        memory_task.cancel()
+        memory_task = None
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+async def memory_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Расход памяти процесса: /memory"""
+    if MULTI_TENANT:
+        await update.message.reply_text("⚠️ В многопользовательском режиме отчет о памяти доступен "
+                                        "администратору через MEMORY_PROFILING и лог")
+        return
+    text = get_memory_text()
+    if tracemalloc.is_tracing():
+        # Снимок tracemalloc может занять заметное время, не задерживаем цикл событий
+        text += "\n\n" + await asyncio.to_thread(get_tracemalloc_text)
+    await update.message.reply_text(text)
+
+
+# ---------------- Записи постов и комментариев ----------------
+# Ответы VK сразу сводятся к нужным полям: полные словари (вложения, лайки, ветки)
+# не хранятся до конца проверки и не нагружают сборщик мусора
+class PostRecord:
+    """Пост стены"""
+    __slots__ = ('id', 'text', 'date', 'is_pinned', 'comments_count')
+
+    def __init__(self, item):
+        self.id = item['id']
+        self.text = item.get('text', '')
+        self.date = item.get('date', 0)
+        self.is_pinned = bool(item.get('is_pinned'))
+        self.comments_count = item.get('comments', {}).get('count', 0)
+
+
+class CommentRecord:
+    """Комментарий с нормализованным текстом (используется для поиска и сохраняется в архив)"""
+    __slots__ = ('id', 'from_id', 'text', 'date', 'text_norm')
+
+    def __init__(self, item):
+        self.id = item.get('id')
+        self.from_id = item.get('from_id')
+        self.text = item.get('text', '')
+        self.date = item.get('date')
+        self.text_norm = normalize_text(self.text)
+
+
+class AuthorRecord:
+    """Автор комментария"""
+    __slots__ = ('name', 'city', 'photo')
+
+    def __init__(self, profile):
+        self.name = f"{profile.get('first_name', '')} {profile.get('last_name', '')}".strip() or None
+        self.city = profile.get('city', {}).get('title')
+        self.photo = profile.get('photo_200')
+
+
+EMPTY_AUTHOR = AuthorRecord({})
+
+
+async def fetch_posts(vk, group_id, count, offset=0, low_priority=False):
+    """Загружает посты стены. Возвращает ([PostRecord], всего постов на стене) или None"""
+    response = await safe_vk_request(
+        vk.wall.get,
+        owner_id=-group_id,
+        offset=offset,
+        count=count,
+        filter="owner",
+        low_priority=low_priority
+    )
+    if not response or 'items' not in response:
+        return None
+    return [PostRecord(item) for item in response['items']], response.get('count', 0)
+
+
+async def fetch_comments(vk, group_id, post_id, low_priority=False):
+    """Загружает комментарии поста. Возвращает ([CommentRecord], {from_id: AuthorRecord}) или None"""
+    response = await safe_vk_request(
+        vk.wall.getComments,
+        owner_id=-group_id,
+        post_id=post_id,
+        count=COMMENTS_COUNT,
+        extended=1,
+        fields="city,photo_200",
+        low_priority=low_priority
+    )
+    if not response or 'items' not in response:
+        return None
 
-def delete_all_keywords():
-    """Удаляет все ключевые слова из базы данных"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM keywords')
-    conn.commit()
-    conn.close()
-    logger.info("✅ Все ключевые слова удалены из базы данных")
+    # Профили авторов приходят в том же ответе и не требуют отдельных запросов
+    authors = {profile['id']: AuthorRecord(profile) for profile in response.get('profiles', [])}
+    return [CommentRecord(item) for item in response['items']], authors
 
 
-# ---------------- Улучшенная функция безопасного VK запроса ----------------
-async def safe_vk_request(func, *args, **kwargs):
-    """Безопасный вызов VK API с обработкой ошибок"""
-    max_retries = 3
-    retry_delay = 2
+# ---------------- Улучшенная проверка VK ----------------
+async def scan_posts(context, vk, domain, group_id, posts, watchers, low_priority=False):
+    """
+    Проверяет комментарии к постам группы (PostRecord): загружает их, сохраняет в архив,
+    проверяет одной пачкой на ключевые слова всех отслеживающих группу чатов
+    (watchers - [(tenant_id, ключевые слова)]) и доставляет совпадения.
+    Возвращает (проверено комментариев, найдено совпадений).
+    """
+    checked_count = 0
+    found_count = 0
 
-    for attempt in range(max_retries):
-        try:
-            return func(*args, **kwargs)
-        except vk_api.exceptions.ApiError as e:
-            if attempt == max_retries - 1:
-                raise
-            await asyncio.sleep(retry_delay * (attempt + 1))
-        except (requests.exceptions.RequestException, ConnectionError, TimeoutError) as e:
-            if attempt == max_retries - 1:
-                raise
-            await asyncio.sleep(retry_delay * (attempt + 1))
-        except Exception as e:
-            raise
+    # Собираем комментарии всех постов, чтобы проверить их одной пачкой
+    candidates = []
 
-    return None
+    for post in posts:
+        if post.comments_count > 0:
+            try:
+                fetched = await fetch_comments(vk, group_id, post.id, low_priority)
+                if not fetched:
+                    continue
 
+                comments, authors = fetched
+                checked_count += len(comments)
+                archive_comments(domain, -group_id, post.id, comments, authors)
 
-# ---------------- Улучшенная функция отправки уведомлений с фото ----------------
-async def send_notification_with_photo(context: CallbackContext, text_message: str, photo_url: str = None):
-    """Улучшенная функция отправки уведомлений с фото пользователя под текстом"""
-    chats = get_all_chats()
+            except Exception as e:
+                logger.warning(f"    ⚠️ Ошибка получения комментариев к посту {post.id}: {e}")
+                continue
+
+            for comment in comments:
+                if not comment.id or (comment.from_id and comment.from_id < 0):
+                    continue
+                candidates.append((post.id, comment, authors))
+
+    tenant_matches = await match_comments_for_tenants(
+        [comment.text_norm for _, comment, _ in candidates], watchers
+    )
+
+    for (post_id, comment, authors), matches in zip(candidates, tenant_matches):
+        # Комментарий, подошедший нескольким чатам, записывается в Excel и статистику один раз
+        recorded = False
+        for tenant_id, found_keyword, matched_keywords in matches:
+            comment_id = comment.id
+            text = comment.text
+            from_id = comment.from_id
+
+            if not claim_comment(-group_id, post_id, comment_id, found_keyword, tenant_id):
+                continue
+            claim = (-group_id, post_id, comment_id, tenant_id)
 
-    for chat_id, chat_type, chat_title in chats:
-        max_retries = 3
-        for attempt in range(max_retries):
             try:
-                # Если есть фото, отправляем его с текстом как caption
-                if photo_url:
-                    photo_data = await download_photo(photo_url)
-                    if photo_data:
-                        await context.bot.send_photo(
-                            chat_id=chat_id,
-                            photo=photo_data,
-                            caption=text_message,
-                            parse_mode='HTML'
-                        )
-                    else:
-                        # Если не удалось загрузить фото, отправляем только текст
-                        await context.bot.send_message(
-                            chat_id=chat_id,
-                            text=text_message,
-                            disable_web_page_preview=True,
-                            parse_mode='HTML'
-                        )
-                else:
-                    # Если нет фото, отправляем только текст
-                    await context.bot.send_message(
-                        chat_id=chat_id,
-                        text=text_message,
-                        disable_web_page_preview=True,
-                        parse_mode='HTML'
+                author = authors.get(from_id)
+                if author is None:
+                    user_info = await safe_vk_request(
+                        vk.users.get,
+                        user_ids=from_id,
+                        fields="city,photo_200",
+                        low_priority=low_priority
                     )
-                break
-            except NetworkError as e:
-                if attempt == max_retries - 1:
-                    pass
-                else:
-                    await asyncio.sleep(2 * (attempt + 1))
+                    # Автор общий для всех чатов, которым подошел комментарий
+                    author = authors[from_id] = AuthorRecord(user_info[0]) if user_info else EMPTY_AUTHOR
+
+                user_name = author.name or "Неизвестный пользователь"
+                city = author.city or "не указан"
+                # URL аватарки
+                photo_url = author.photo
+
+                text_message, comment_excel_data = build_found_comment(
+                    domain, -group_id, post_id, comment_id, from_id,
+                    text, found_keyword, user_name, city
+                )
+
+                # Отправляем уведомление и сохраняем комментарий
+                if not await deliver_comment(context, text_message, photo_url, comment_excel_data, domain, claim,
+                                             record=not recorded, keywords=matched_keywords):
+                    logger.warning(f"    ⚠️ Уведомление о комментарии {comment_id} не отправлено, "
+                                   f"повтор при следующей проверке")
+                    continue
+                if not recorded:
+                    increment_total_comments_count()
+                    found_count += 1
+                    recorded = True
+
+                logger.info(f"    ✅ НАЙДЕН КОММЕНТАРИЙ: {user_name} - '{found_keyword}'")
+
             except Exception as e:
-                break
+                # Отметка снимается, чтобы комментарий был отправлен следующей проверкой
+                finish_comment_claim(claim, None)
+                logger.error(f"    ❌ Ошибка обработки найденного комментария: {e}")
 
-        await asyncio.sleep(0.1)
+    return checked_count, found_count
 
 
-# ---------------- Улучшенная проверка VK ----------------
-async def check_vk_comments(context: CallbackContext):
+async def scan_groups(context: CallbackContext, job):
     """Улучшенная функция проверки комментариев с обработкой ошибок"""
-    global is_checking
-
-    if is_checking:
-        logger.info("🔁 Проверка уже выполняется, пропускаем...")
-        return 0, 0
+    global current_scan_task
 
-    is_checking = True
+    current_scan_task = asyncio.current_task()
     found_count = 0
     processed_groups = 0
     total_checked_comments = 0
@@ -774,149 +4891,143 @@ async def check_vk_comments(context: CallbackContext):
 
     try:
         groups = get_groups()
-        keywords = get_keywords()
 
         if not groups:
             logger.warning("⚠️ Нет групп для проверки")
             return processed_groups, found_count
 
-        if not keywords:
+        # Каждая группа загружается один раз, комментарии проверяются для всех отслеживающих ее чатов
+        watchers = get_group_watchers(groups)
+        if not watchers:
             logger.warning("⚠️ Нет ключевых слов для проверки")
             return processed_groups, found_count
+        groups = [(domain, group_id) for domain, group_id in groups if domain in watchers]
+
+        # Группы на карантине пропускаются до его окончания (проверка отдельной группы проверяет и их)
+        quarantined = {group[0] for group in get_quarantined_groups()}
+        if quarantined and not job.target:
+            skipped = [domain for domain, _ in groups if domain in quarantined]
+            groups = [(domain, group_id) for domain, group_id in groups if domain not in quarantined]
+            if skipped:
+                logger.info(f"🚧 Пропускаем {len(skipped)} групп на карантине")
 
+        vk = get_vk()
         if not vk:
             logger.error("❌ VK API не инициализирован")
+            job.failed = True
             return processed_groups, found_count
 
-        logger.info(f"🔍 Начинаем проверку: {len(groups)} групп, {len(keywords)} ключевых слов")
+        keywords_count = len({keyword for group_watchers in watchers.values()
+                              for _, keywords in group_watchers for keyword in keywords})
+        logger.info(f"🔍 Начинаем проверку: {len(groups)} групп, {keywords_count} ключевых слов")
 
         start_time = time.time()
 
-        for domain, group_id in groups:
+        if job.target:
+            # Проверка одной группы не затрагивает контрольную точку общей проверки
+            groups = [(domain, group_id) for domain, group_id in groups if domain == job.target]
+            checkpoint_domain, checkpoint_post_id = None, None
+        else:
+            groups = get_worker_groups(groups)
+
+            # Продолжаем прерванную проверку с сохраненной группы, затем проверяем группы с начала списка
+            checkpoint_domain, checkpoint_post_id = load_scan_checkpoint()
+
+        domains = [domain for domain, _ in groups]
+        if checkpoint_domain in domains:
+            start_index = domains.index(checkpoint_domain)
+            groups = groups[start_index:] + groups[:start_index]
+            logger.info(f"⏯ Продолжаем прерванную проверку с группы {checkpoint_domain}")
+        else:
+            checkpoint_post_id = None
+
+        group_settings = get_group_settings()
+        interrupted = False
+        job.total_groups = len(groups)
+        job.started_at = time.time()
+        await job.report(context.bot if context else None, force=True)
+
+        for group_index, (domain, group_id) in enumerate(groups):
+            if shutdown_requested:
+                logger.info("🛑 Проверка остановлена, прогресс сохранен")
+                interrupted = True
+                break
+
             try:
                 processed_groups += 1
                 group_comments_checked = 0
                 group_comments_found = 0
                 group_posts_checked = 0
 
+                if not group_id:
+                    logger.warning(f"  ⚠️ У группы {domain} нет ID, пропускаем")
+                    continue
+
                 logger.info(f"📋 Проверяем группу: {domain} (ID: {group_id})")
 
+                posts_count, max_age_days, pinned_mode = group_settings.get(
+                    domain, (POSTS_COUNT, MAX_POST_AGE_DAYS, PINNED_POSTS))
+
                 # Получаем посты со стены
                 try:
-                    posts = await safe_vk_request(
-                        vk.wall.get,
-                        owner_id=-group_id,
-                        count=20,
-                        filter="owner"
-                    )
-                    if not posts or 'items' not in posts:
+                    try:
+                        fetched = await fetch_posts(vk, group_id, posts_count)
+                    except Exception as e:
+                        if is_account_wide_error(e):
+                            raise VkUnavailableError(VK_ACCOUNT_ERRORS.get(getattr(e, 'code', None), str(e))) from e
+                        quarantined_until = record_group_failure(domain, getattr(e, 'code', None), str(e))
+                        if quarantined_until:
+                            until = datetime.fromtimestamp(quarantined_until).strftime('%d.%m %H:%M')
+                            logger.warning(f"  🚧 Группа {domain} на карантине до {until}: {e}")
+                        raise
+                    record_group_success(domain)
+                    if not fetched:
                         logger.warning(f"  ⚠️ В группе {domain} нет постов или ошибка доступа")
                         continue
 
-                    posts = posts['items']
+                    # Старые и закрепленные посты не тратят запросы к VK
+                    posts = filter_posts_for_scan(fetched[0], max_age_days, pinned_mode)
                     group_posts_checked = len(posts)
                     total_checked_posts += len(posts)
                     logger.info(f"  📝 Получено {len(posts)} постов для проверки")
 
                     # Добавляем посты в Excel (без проверки на уникальность)
                     for post in posts:
-                        post_text = post.get('text', '')
-                        add_post_to_excel(domain, group_id, post['id'], post_text)
+                        record_checked_post(domain, group_id, post.id, post.text)
 
+                except VkUnavailableError:
+                    raise
                 except Exception as e:
                     logger.error(f"  ❌ Ошибка получения постов для {domain}: {e}")
                     continue
 
-                for post in posts:
-                    if post.get('comments', {}).get('count', 0) > 0:
-                        try:
-                            comments = await safe_vk_request(
-                                vk.wall.getComments,
-                                owner_id=-group_id,
-                                post_id=post['id'],
-                                count=100
-                            )
-                            if not comments or 'items' not in comments:
-                                continue
-
-                            comments = comments['items']
-                            group_comments_checked += len(comments)
-                            total_checked_comments += len(comments)
-
-                        except Exception as e:
-                            logger.warning(f"    ⚠️ Ошибка получения комментариев к посту {post['id']}: {e}")
-                            continue
-
-                        for comment in comments:
-                            comment_id = comment.get('id')
-                            if not comment_id:
-                                continue
-
-                            text = comment.get('text', '')
-                            from_id = comment.get('from_id')
-
-                            if from_id and from_id < 0:
-                                continue
-
-                            contains, found_keyword = contains_keyword(text, keywords)
-
-                            if contains:
-                                try:
-                                    user_info = await safe_vk_request(
-                                        vk.users.get,
-                                        user_ids=from_id,
-                                        fields="city,photo_200"
-                                    )
-                                    user_name = "Неизвестный пользователь"
-                                    city = "не указан"
-                                    photo_url = None
-
-                                    if user_info:
-                                        user_info = user_info[0]
-                                        user_name = f"{user_info.get('first_name', '')} {user_info.get('last_name', '')}".strip()
-                                        city = user_info.get("city", {}).get("title", "не указан")
-                                        # Получаем URL аватарки
-                                        photo_url = user_info.get('photo_200')
-
-                                    group_link = f"https://vk.com/{domain}"
-                                    post_link = f"https://vk.com/wall-{group_id}_{post['id']}?reply={comment_id}"
-                                    user_link = f"https://vk.com/id{from_id}" if from_id else "не доступно"
-
-                                    # Формируем текстовое сообщение с новым порядком полей
-                                    text_message = (
-                                        "⚡ Хром работал 24/7 и обнаружил комментарий, необходимо включиться!\n\n"
-                                        f"💬 <b>Текст комментария:</b>\n"
-                                        f"{user_name}: {text[:500]}\n\n"
-                                        f"🔗 <b>Ссылка на страницу пользователя:</b> {user_link}\n"
-                                        f"🌍 <b>Город:</b> {city}\n"
-                                        f"🔗 <b>Ссылка на комментарий:</b> {post_link}\n"
-                                        f"🔗 <b>Ссылка на группу:</b> {group_link}\n"
-                                        f"🔍 <b>Маркер:</b> {found_keyword}"
-                                    )
-
-                                    # Подготавливаем данные для Excel в новом порядке
-                                    comment_excel_data = {
-                                        'user_name': user_name,
-                                        'user_link': user_link,
-                                        'city': city,
-                                        'text': text,
-                                        'comment_link': post_link,
-                                        'keyword': found_keyword,
-                                        'detection_date': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                                    }
-
-                                    # Добавляем комментарий в Excel
-                                    add_comment_to_excel(comment_excel_data)
-
-                                    await send_notification_with_photo(context, text_message, photo_url)
-                                    increment_total_comments_count()
-                                    found_count += 1
-                                    group_comments_found += 1
-
-                                    logger.info(f"    ✅ НАЙДЕН КОММЕНТАРИЙ: {user_name} - '{found_keyword}'")
-
-                                except Exception as e:
-                                    logger.error(f"    ❌ Ошибка обработки найденного комментария: {e}")
+                # Пропускаем посты, проверенные до перезапуска
+                if group_index == 0 and checkpoint_post_id:
+                    post_ids = [post.id for post in posts]
+                    if checkpoint_post_id in post_ids:
+                        posts = posts[post_ids.index(checkpoint_post_id) + 1:]
+
+                # Посты проверяются порциями, после каждой порции сохраняется контрольная точка
+                for i in range(0, len(posts), SCAN_POSTS_PER_BATCH):
+                    if shutdown_requested:
+                        interrupted = True
+                        break
+
+                    batch = posts[i:i + SCAN_POSTS_PER_BATCH]
+                    checked, found = await scan_posts(context, vk, domain, group_id, batch, watchers[domain])
+                    group_comments_checked += checked
+                    total_checked_comments += checked
+                    group_comments_found += found
+                    found_count += found
+                    job.found = found_count
+
+                    flush_archive_buffer()
+                    if not job.target:
+                        save_scan_checkpoint(domain, batch[-1].id)
+
+                if interrupted:
+                    logger.info("🛑 Проверка остановлена, прогресс сохранен")
+                    break
 
                 # Логируем результаты по группе
                 if group_comments_found > 0:
@@ -926,12 +5037,32 @@ async def check_vk_comments(context: CallbackContext):
                     logger.info(
                         f"  📊 Группа {domain}: проверено {group_posts_checked} постов, {group_comments_checked} комментариев, совпадений нет")
 
+                # Следующая проверка после перезапуска начнется со следующей группы
+                if group_index + 1 < len(groups) and not job.target:
+                    save_scan_checkpoint(groups[group_index + 1][0], None)
+
+                job.done_groups = processed_groups
+                await job.report(context.bot if context else None)
+
                 await asyncio.sleep(0.5)
 
+            except VkUnavailableError as e:
+                # Остальные группы упрутся в ту же ошибку: прерываемся и продолжим с этой группы
+                logger.error(f"❌ VK недоступен ({e}), проверка прервана на группе {domain}")
+                processed_groups -= 1
+                if not job.target:
+                    save_scan_checkpoint(domain, checkpoint_post_id if group_index == 0 else None)
+                interrupted = True
+                break
             except Exception as e:
                 logger.error(f"❌ Критическая ошибка при проверке группы {domain}: {e}")
                 continue
 
+        job.done_groups = processed_groups
+        job.interrupted = interrupted
+        if not interrupted and not job.target:
+            clear_scan_checkpoint()
+
         # Итоговый отчет
         end_time = time.time()
         duration = end_time - start_time
@@ -945,11 +5076,129 @@ async def check_vk_comments(context: CallbackContext):
 
         return processed_groups, found_count
 
+    except asyncio.CancelledError:
+        logger.warning("🛑 Проверка прервана, прогресс сохранен до последней контрольной точки")
+        job.interrupted = True
+        raise
     except Exception as e:
         logger.error(f"💥 Критическая ошибка в функции проверки: {e}")
+        job.failed = True
         return processed_groups, found_count
     finally:
-        is_checking = False
+        flush_archive_buffer()
+        current_scan_task = None
+
+
+# ---------------- Загрузка истории новых групп ----------------
+# Насколько глубоко (в днях) проверять старые посты новой группы, 0 - не проверять
+BACKFILL_MAX_AGE_DAYS = int(os.getenv("BACKFILL_MAX_AGE_DAYS", "0"))
+BACKFILL_PAGE_SIZE = 100
+
+
+def schedule_group_backfill(cursor, domain):
+    """Ставит новую группу в очередь загрузки истории (в транзакции добавления группы)"""
+    if BACKFILL_MAX_AGE_DAYS > 0:
+        cursor.execute(
+            'INSERT OR IGNORE INTO group_backfill (group_domain, created_at) VALUES (?, ?)',
+            (domain, time.time())
+        )
+
+
+def get_pending_backfills():
+    """Возвращает [(домен, ID группы, смещение)] групп с незавершенной загрузкой истории"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        '''
+        SELECT b.group_domain, g.group_id, b.next_offset
+        FROM group_backfill b JOIN vk_groups g ON g.domain = b.group_domain
+        WHERE b.done = 0 AND g.group_id IS NOT NULL AND (g.quarantined_until IS NULL OR g.quarantined_until <= ?)
+        ORDER BY b.created_at
+        ''',
+        (time.time(),)
+    )
+    result = cursor.fetchall()
+    conn.close()
+    return result
+
+
+def save_backfill_progress(domain, next_offset, done=False):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        'UPDATE group_backfill SET next_offset = ?, done = ?, updated_at = ? WHERE group_domain = ?',
+        (next_offset, int(done), time.time(), domain)
+    )
+    conn.commit()
+    conn.close()
+
+
+async def backfill_group_history(context, vk, domain, group_id, offset, watchers):
+    """
+    Проходит стену группы страницами wall.get, начиная со смещения offset, до постов старше
+    BACKFILL_MAX_AGE_DAYS дней. После каждой страницы смещение сохраняется в базе данных.
+    """
+    cutoff = time.time() - BACKFILL_MAX_AGE_DAYS * 86400
+    found_count = 0
+
+    while not shutdown_requested:
+        posts, total_count = await fetch_posts(
+            vk, group_id, BACKFILL_PAGE_SIZE, offset=offset, low_priority=True
+        ) or ([], 0)
+
+        # Закрепленный пост может быть старым и стоять первым, на глубину обхода он не влияет
+        recent = [post for post in posts if post.date >= cutoff]
+        reached_cutoff = any(post.date < cutoff and not post.is_pinned for post in posts)
+
+        for i in range(0, len(recent), SCAN_POSTS_PER_BATCH):
+            checked, found = await scan_posts(
+                context, vk, domain, group_id, recent[i:i + SCAN_POSTS_PER_BATCH], watchers, low_priority=True
+            )
+            found_count += found
+        flush_archive_buffer()
+
+        offset += len(posts)
+        done = not posts or reached_cutoff or offset >= total_count
+        save_backfill_progress(domain, offset, done)
+
+        if done:
+            logger.info(f"📜 История группы {domain} проверена: {offset} постов, найдено {found_count}")
+            break
+
+    return found_count
+
+
+async def historical_backfill(context: CallbackContext):
+    """Фоновая загрузка истории новых групп (использует лимит запросов, оставшийся от проверки)"""
+    if BACKFILL_MAX_AGE_DAYS <= 0:
+        return
+
+    pending = get_pending_backfills()
+    if not pending:
+        return
+
+    pending_groups = [(domain, group_id) for domain, group_id, _ in pending]
+    watchers = get_group_watchers(pending_groups)
+    if not watchers:
+        return
+
+    vk = get_vk()
+    if not vk:
+        return
+
+    own_groups = {domain for domain, _ in get_worker_groups(pending_groups)}
+
+    for domain, group_id, offset in pending:
+        if shutdown_requested:
+            break
+        if domain not in own_groups or domain not in watchers:
+            continue
+
+        logger.info(f"📜 Проверяем историю группы {domain} за {BACKFILL_MAX_AGE_DAYS} дней (смещение {offset})")
+        try:
+            await backfill_group_history(context, vk, domain, group_id, offset, watchers[domain])
+        except Exception as e:
+            logger.error(f"❌ Ошибка проверки истории группы {domain}: {e}")
 
 
 # ---------------- Обработка сообщений ----------------
@@ -959,11 +5208,13 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.message.chat_id
     chat_type = update.effective_chat.type
     message_text = user_input.lower()
+    tenant_id = get_tenant_id(update)
 
     if message_text == "статус":
-        groups = get_groups()
-        keywords = get_keywords()
-        chats = get_all_chats()
+        groups = get_groups(tenant_id)
+        keywords = get_keywords(tenant_id)
+        # В многопользовательском режиме чужие чаты не показываются
+        chats = get_all_chats() if tenant_id is None else []
 
         # Проверяем статус текущего чата
         current_chat_status = "✅ добавлен" if is_chat_in_db(chat_id) else "❌ не добавлен"
@@ -975,7 +5226,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         status_text = (
                 f"📊 <b>Текущий статус:</b>\n\n"
-                f"{get_bot_status()}\n\n"
+                f"{get_bot_status(tenant_id)}\n\n"
                 f"<b>Детальная информация:</b>\n"
                 f"Группы ВК: {len(groups)}\n"
                 f"Ключевые слова: {len(keywords)}\n"
@@ -991,12 +5242,23 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=get_main_keyboard())
         context.user_data['awaiting_input'] = 'group'
 
+    elif message_text == "импорт групп":
+        await update.message.reply_text(
+            "Отправьте список ссылок на группы (каждая с новой строки или через запятую) "
+            "или файл txt/csv/xlsx со ссылками:",
+            reply_markup=get_main_keyboard())
+        context.user_data['awaiting_input'] = 'import_groups'
+
     elif message_text == "добавить ключевое слово":
-        await update.message.reply_text("Введите ключевые слова через запятую:", reply_markup=get_main_keyboard())
+        await update.message.reply_text(
+            "Введите ключевые слова через запятую.\n"
+            "Можно использовать правила: купить AND NOT продам, ремонт OR отделка, "
+            "\"ремонт квартир\", купить NEAR/5 квартиру, ремонт*",
+            reply_markup=get_main_keyboard())
         context.user_data['awaiting_input'] = 'keyword'
 
     elif message_text == "список групп":
-        groups = get_groups()
+        groups = get_groups(tenant_id)
         if groups:
             group_list = "\n".join([f"{i + 1}. {g[0]} (ID: {g[1]})" for i, g in enumerate(groups)])
             await update.message.reply_text(f"Отслеживаемые группы:\n{group_list}", reply_markup=get_main_keyboard())
@@ -1004,13 +5266,13 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("Список групп пуст.", reply_markup=get_main_keyboard())
 
     elif message_text == "список ключевых слов":
-        keywords = get_keywords()
+        keywords = get_keywords(tenant_id)
         await update.message.reply_text(
             "Ключевые слова:\n" + ("\n".join(keywords) if keywords else "Список ключевых слов пуст."),
             reply_markup=get_main_keyboard())
 
     elif message_text == "удалить группу":
-        groups = get_groups()
+        groups = get_groups(tenant_id)
         if groups:
             await update.message.reply_text(
                 "Выберите группу для удаления:\n" + "\n".join([f"{i + 1}. {g[0]}" for i, g in enumerate(groups)]),
@@ -1020,7 +5282,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("Список групп пуст.", reply_markup=get_main_keyboard())
 
     elif message_text == "удалить ключевое слово":
-        keywords = get_keywords()
+        keywords = get_keywords(tenant_id)
         if keywords:
             await update.message.reply_text("Выберите ключевое слово для удаления:\n" + "\n".join(
                 [f"{i + 1}. {k}" for i, k in enumerate(keywords)]), reply_markup=get_main_keyboard())
@@ -1030,9 +5292,9 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # НОВАЯ КНОПКА: Удалить все ключевые слова
     elif message_text == "удалить все ключевые слова":
-        keywords = get_keywords()
+        keywords = get_keywords(tenant_id)
         if keywords:
-            delete_all_keywords()
+            delete_all_keywords(tenant_id)
             await update.message.reply_text(
                 "✅ Все ключевые слова удалены!",
                 reply_markup=get_main_keyboard()
@@ -1080,69 +5342,55 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 reply_markup=get_main_keyboard()
             )
 
+    elif message_text == "список чатов" and tenant_id is not None:
+        await update.message.reply_text(
+            "👤 Уведомления по вашим группам и ключевым словам приходят в этот чат.",
+            reply_markup=get_main_keyboard())
+
     elif message_text == "список чатов":
         chat_list_text = get_chats_list_text()
         await update.message.reply_text(chat_list_text, reply_markup=get_main_keyboard())
 
+    elif message_text == "проверить сейчас" and WORKER_MODE == 'frontend':
+        request_scan()
+        logger.info("🔄 Ручная проверка запрошена у воркеров")
+        await update.message.reply_text(
+            f"🔄 Запрос на проверку передан воркерам ({len(get_live_workers())} активных). "
+            "Найденные комментарии придут уведомлениями.",
+            reply_markup=get_main_keyboard())
+
     elif message_text == "проверить сейчас":
-        await update.message.reply_text("🔄 Запускаю проверку...", reply_markup=get_main_keyboard())
-        logger.info("🔄 Ручная проверка запущена пользователем")
-        processed_groups, found_count = await check_vk_comments(context)
-        total_comments = get_total_comments_count()
-        excel_posts, excel_comments = get_excel_stats()
+        # Проверка идет в фоне, бот продолжает отвечать на сообщения
+        await start_manual_scan(update, context)
 
-        if found_count > 0:
+    elif message_text == "проверить группу":
+        groups = get_groups(tenant_id)
+        if groups:
             await update.message.reply_text(
-                f"✅ Проверка завершена! Найдено {found_count} новых комментариев с ключевыми словами.\n"
-                f"📈 Всего найдено: {total_comments}\n"
-                f"📁 Постов в Excel: {excel_posts}\n"
-                f"📁 Комментариев в Excel: {excel_comments}",
+                "Выберите группу для проверки (номер или имя):\n" +
+                "\n".join([f"{i + 1}. {g[0]}" for i, g in enumerate(groups)]),
                 reply_markup=get_main_keyboard())
+            context.user_data['awaiting_input'] = 'scan_group'
         else:
-            await update.message.reply_text(
-                f"✅ Проверка завершена! Новых комментариев с ключевыми словами не найдено.\n"
-                f"📈 Всего найдено: {total_comments}\n"
-                f"📁 Постов в Excel: {excel_posts}\n"
-                f"📁 Комментариев в Excel: {excel_comments}",
-                reply_markup=get_main_keyboard())
+            await update.message.reply_text("Список групп пуст.", reply_markup=get_main_keyboard())
 
-    elif message_text == "экспорт в excel":
-        """Новая команда для отправки Excel файлов"""
-        try:
-            excel_posts, excel_comments = get_excel_stats()
-
-            # Форматируем файлы перед отправкой
-            format_excel_file(POSTS_EXCEL_FILE)
-            format_excel_file(COMMENTS_EXCEL_FILE)
-
-            if excel_posts > 0 and os.path.exists(POSTS_EXCEL_FILE):
-                with open(POSTS_EXCEL_FILE, 'rb') as posts_file:
-                    await update.message.reply_document(
-                        document=posts_file,
-                        filename="checked_posts.xlsx",
-                        caption=f"📊 Файл с проверенными постами\nКоличество записей: {excel_posts}"
-                    )
-            else:
-                await update.message.reply_text("📭 Файл с постами пуст или не существует")
-
-            if excel_comments > 0 and os.path.exists(COMMENTS_EXCEL_FILE):
-                with open(COMMENTS_EXCEL_FILE, 'rb') as comments_file:
-                    await update.message.reply_document(
-                        document=comments_file,
-                        filename="found_comments.xlsx",
-                        caption=f"📊 Файл с найденными комментариями\nКоличество записей: {excel_comments}"
-                    )
-            else:
-                await update.message.reply_text("📭 Файл с комментариями пуст или не существует")
+    elif message_text == "экспорт в excel" and tenant_id is not None:
+        # Общие файлы Excel содержат находки всех чатов
+        await update.message.reply_text(
+            "⚠️ В многопользовательском режиме экспорт недоступен. "
+            "Для поиска по архиву ваших групп используйте /search.",
+            reply_markup=get_main_keyboard())
 
-        except Exception as e:
-            await update.message.reply_text(f"❌ Ошибка при экспорте в Excel: {e}")
+    elif message_text == "экспорт в excel":
+        # Кроме Excel доступна выгрузка всей истории в колоночном формате для pandas
+        await update.message.reply_text(get_export_menu_text(), reply_markup=get_main_keyboard())
+        context.user_data['awaiting_input'] = 'export_format'
 
     elif 'awaiting_input' in context.user_data:
         input_type = context.user_data['awaiting_input']
 
         if input_type == 'group':
-            groups = [g[0] for g in get_groups()]
+            groups = [g[0] for g in get_groups(tenant_id)]
 
             extracted_identifier = extract_group_id_from_url(user_input)
 
@@ -1158,13 +5406,13 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             else:
                 try:
                     group_info = await safe_vk_request(
-                        vk.groups.getById,
+                        get_vk().groups.getById,
                         group_id=extracted_identifier
                     )
                     if group_info:
                         group_info = group_info[0]
                         group_id = group_info['id']
-                        add_group(extracted_identifier, group_id)
+                        add_group(extracted_identifier, group_id, tenant_id)
                         logger.info(f"✅ Добавлена группа: {extracted_identifier} (ID: {group_id})")
                         await update.message.reply_text(f"✅ Группа {extracted_identifier} (ID: {group_id}) добавлена!",
                                                         reply_markup=get_main_keyboard())
@@ -1185,38 +5433,66 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                                                     reply_markup=get_main_keyboard())
             context.user_data.pop('awaiting_input')
 
+        elif input_type == 'import_groups':
+            context.user_data.pop('awaiting_input')
+            await update.message.reply_text("🔄 Импортирую группы...", reply_markup=get_main_keyboard())
+            try:
+                added, existing_count, failed = await import_groups(user_input.splitlines(), tenant_id)
+                await update.message.reply_text(format_import_result(added, existing_count, failed),
+                                                reply_markup=get_main_keyboard())
+            except Exception as e:
+                logger.error(f"❌ Ошибка импорта групп: {e}")
+                await update.message.reply_text(f"❌ Ошибка импорта групп: {e}", reply_markup=get_main_keyboard())
+
         elif input_type == 'keyword':
             keywords_input = user_input.split(',')
             added_count = 0
             existing_count = 0
 
+            added_keywords = []
+
+            invalid_rules = []
+
             for kw in keywords_input:
                 keyword = kw.strip()
                 if keyword:
-                    keywords = get_keywords()
+                    rule_error = validate_keyword_rule(keyword)
+                    if rule_error:
+                        invalid_rules.append(f"{keyword}: {rule_error}")
+                        continue
+                    keywords = get_keywords(tenant_id)
                     if keyword not in keywords:
-                        add_keyword(keyword)
+                        add_keyword(keyword, tenant_id)
+                        added_keywords.append(keyword)
                         added_count += 1
                         logger.info(f"✅ Добавлено ключевое слово: '{keyword}'")
                     else:
                         existing_count += 1
 
             if added_count > 0:
-                await update.message.reply_text(f"✅ Добавлено {added_count} ключевых слов!",
+                await update.message.reply_text(f"✅ Добавлено {added_count} ключевых слов!\n"
+                                                f"📚 Проверяю по ним архив уже просмотренных комментариев...",
                                                 reply_markup=get_main_keyboard())
+                # Проверка архива выполняется в фоне, без запросов к VK
+                context.application.create_task(
+                    backfill_keywords_from_archive(context, added_keywords, report_chat_id=chat_id, tenant_id=tenant_id)
+                )
             if existing_count > 0:
                 await update.message.reply_text(f"⚠️ {existing_count} слов уже были в списке!",
                                                 reply_markup=get_main_keyboard())
+            if invalid_rules:
+                await update.message.reply_text("❌ Не удалось разобрать правила:\n" + "\n".join(invalid_rules),
+                                                reply_markup=get_main_keyboard())
 
             context.user_data.pop('awaiting_input')
 
         elif input_type == 'delete_group':
-            groups = get_groups()
+            groups = get_groups(tenant_id)
             try:
                 index = int(user_input) - 1
                 if 0 <= index < len(groups):
                     removed = groups[index][0]
-                    delete_group(removed)
+                    delete_group(removed, tenant_id)
                     logger.info(f"❌ Удалена группа: {removed}")
                     await update.message.reply_text(f"❌ Группа {removed} удалена!", reply_markup=get_main_keyboard())
                 else:
@@ -1226,13 +5502,55 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                                                 reply_markup=get_main_keyboard())
             context.user_data.pop('awaiting_input')
 
+        elif input_type == 'export_format':
+            context.user_data.pop('awaiting_input')
+            export_format = EXPORT_FORMATS.get(user_input.strip(), (None,))[0]
+            if export_format is None:
+                await update.message.reply_text("⚠️ Пожалуйста, введите номер формата!",
+                                                reply_markup=get_main_keyboard())
+            elif export_format == 'parquet' and not is_parquet_available():
+                await update.message.reply_text("⚠️ Для выгрузки в Parquet установите пакет pyarrow "
+                                                "или выберите CSV.gz", reply_markup=get_main_keyboard())
+            elif export_format == 'xlsx':
+                try:
+                    await send_excel_files(update)
+                except Exception as e:
+                    await update.message.reply_text(f"❌ Ошибка при экспорте в Excel: {e}")
+            else:
+                try:
+                    await send_history_export(update, export_format)
+                except Exception as e:
+                    logger.error(f"❌ Ошибка выгрузки истории: {e}")
+                    await update.message.reply_text(f"❌ Ошибка выгрузки истории: {e}",
+                                                    reply_markup=get_main_keyboard())
+
+        elif input_type == 'scan_group':
+            context.user_data.pop('awaiting_input')
+            groups = [g[0] for g in get_groups(tenant_id)]
+            if user_input.strip().isdigit():
+                index = int(user_input) - 1
+                target = groups[index] if 0 <= index < len(groups) else None
+            else:
+                target = extract_group_id_from_url(user_input)
+
+            if target not in groups:
+                await update.message.reply_text("⚠️ Такой группы нет в списке!", reply_markup=get_main_keyboard())
+            elif WORKER_MODE == 'frontend':
+                request_scan(target, update.effective_chat.id)
+                await update.message.reply_text(
+                    f"🔄 Запрос на проверку группы {target} передан воркерам. "
+                    "Найденные комментарии придут уведомлениями, итог проверки - в этот чат.",
+                    reply_markup=get_main_keyboard())
+            else:
+                await start_manual_scan(update, context, target)
+
         elif input_type == 'delete_keyword':
-            keywords = get_keywords()
+            keywords = get_keywords(tenant_id)
             try:
                 index = int(user_input) - 1
                 if 0 <= index < len(keywords):
                     removed = keywords[index]
-                    delete_keyword(removed)
+                    delete_keyword(removed, tenant_id)
                     logger.info(f"❌ Удалено ключевое слово: '{removed}'")
                     await update.message.reply_text(f"❌ Ключевое слово '{removed}' удалено!",
                                                     reply_markup=get_main_keyboard())
@@ -1249,6 +5567,36 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("Используйте кнопки для управления ботом", reply_markup=get_main_keyboard())
 
 
+# ---------------- Обработка файлов ----------------
+async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Принимает файл со ссылками на группы для массового импорта"""
+    if context.user_data.get('awaiting_input') != 'import_groups':
+        await update.message.reply_text("Чтобы импортировать группы из файла, сначала нажмите \"Импорт групп\"",
+                                        reply_markup=get_main_keyboard())
+        return
+
+    context.user_data.pop('awaiting_input')
+    document = update.message.document
+
+    try:
+        telegram_file = await document.get_file()
+        data = bytes(await telegram_file.download_as_bytearray())
+        raw_items = read_group_links_from_file(document.file_name, data)
+    except Exception as e:
+        logger.error(f"❌ Ошибка чтения файла {document.file_name}: {e}")
+        await update.message.reply_text(f"❌ Не удалось прочитать файл: {e}", reply_markup=get_main_keyboard())
+        return
+
+    await update.message.reply_text("🔄 Импортирую группы...", reply_markup=get_main_keyboard())
+    try:
+        added, existing_count, failed = await import_groups(raw_items, get_tenant_id(update))
+        await update.message.reply_text(format_import_result(added, existing_count, failed),
+                                        reply_markup=get_main_keyboard())
+    except Exception as e:
+        logger.error(f"❌ Ошибка импорта групп: {e}")
+        await update.message.reply_text(f"❌ Ошибка импорта групп: {e}", reply_markup=get_main_keyboard())
+
+
 # ---------------- Улучшенная периодическая проверка ----------------
 async def periodic_check(context: CallbackContext):
     """Улучшенная функция периодической проверки с обработкой ошибок"""
@@ -1266,16 +5614,65 @@ async def periodic_check(context: CallbackContext):
         logger.error(f"💥 Ошибка в автоматической проверке: {e}")
 
 
+async def archive_maintenance(context: CallbackContext):
+    """
+    Ежечасная очистка устаревших данных и ежедневное обслуживание
+    (ротация Excel файлов, VACUUM, ANALYZE) в час MAINTENANCE_HOUR
+    """
+    global last_maintenance_day
+
+    try:
+        await asyncio.to_thread(prune_expired_data)
+    except Exception as e:
+        logger.error(f"❌ Ошибка очистки устаревших данных: {e}")
+
+    now = datetime.now()
+    if now.hour != MAINTENANCE_HOUR or last_maintenance_day == now.date():
+        return
+    last_maintenance_day = now.date()
+
+    # Excel файлы изменяются только из цикла событий, поэтому ротация выполняется в нем же
+    try:
+        rollover_excel_files()
+    except Exception as e:
+        logger.error(f"❌ Ошибка ротации Excel файлов: {e}")
+
+    try:
+        await asyncio.to_thread(run_database_maintenance)
+    except Exception as e:
+        logger.error(f"❌ Ошибка обслуживания базы данных: {e}")
+
+
 # ---------------- Проверка доступности VK API ----------------
-def check_vk_api_availability():
+async def check_vk_api_availability():
     """Проверяет доступность VK API"""
     try:
-        response = requests.get('https://api.vk.com/method/utils.getServerTime', timeout=10)
-        return response.status_code == 200
-    except:
+        async with get_http_session().get(VK_API_URL + 'utils.getServerTime') as response:
+            return response.status == 200
+    except Exception:
         return False
 
 
+# ---------------- Действия после запуска ----------------
+async def warm_up(context: CallbackContext):
+    """
+    Подготовка после начала приема сообщений: Excel файлы, проверка VK API
+    и заполнение отсутствующих ID групп. Бот отвечает пользователям уже во время нее.
+    """
+    try:
+        await asyncio.to_thread(init_excel_files)
+    except Exception as e:
+        logger.error(f"❌ Ошибка инициализации Excel файлов: {e}")
+
+    if not await check_vk_api_availability():
+        logger.warning("✗ VK API недоступен")
+
+    try:
+        await backfill_missing_group_ids()
+    except Exception as e:
+        logger.error(f"❌ Ошибка заполнения ID групп: {e}")
+
+
 # ---------------- Упрощенная функция запуска ----------------
 def main():
     """Основная функция"""
@@ -1287,23 +5684,50 @@ def main():
         print("   Создайте файл .env и укажите в нем VK_TOKEN=your_token")
         sys.exit(1)
     
-    if not TELEGRAM_TOKEN:
+    if not TELEGRAM_TOKEN and WORKER_MODE != 'scanner':
         print("❌ ОШИБКА: TELEGRAM_TOKEN не найден в переменных окружения!")
         print("   Создайте файл .env и укажите в нем TELEGRAM_TOKEN=your_token")
         sys.exit(1)
 
+    # По WORKER_ID воркер находит свою контрольную точку, поэтому он не должен меняться при перезапуске
+    if WORKER_MODE == 'scanner' and not os.getenv("WORKER_ID"):
+        print("❌ ОШИБКА: для WORKER_MODE=scanner нужно указать постоянный WORKER_ID!")
+        print("   Например: WORKER_ID=scanner-1")
+        sys.exit(1)
+
+    if TELEGRAM_MODE == 'webhook' and not WEBHOOK_URL and WORKER_MODE != 'scanner':
+        print("❌ ОШИБКА: для TELEGRAM_MODE=webhook нужно указать WEBHOOK_URL!")
+        print("   Например: WEBHOOK_URL=https://example.com")
+        sys.exit(1)
+
     # Устанавливаем время запуска бота
     bot_start_time = datetime.now()
 
     # Инициализация базы данных
     init_db()
 
-    # Инициализация Excel файлов
-    init_excel_files()
-
-    # Проверка доступности VK API
-    if not check_vk_api_availability():
-        print("✗ VK API недоступен")
+    # Воркер проверки работает без Telegram и Excel файлов
+    if WORKER_MODE == 'scanner':
+        print("=" * 50)
+        print(f"🧩 ВОРКЕР ПРОВЕРКИ {WORKER_ID}")
+        print("=" * 50)
+        try:
+            asyncio.run(run_scanner())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            print("Воркер остановлен")
+        return
+
+    # Второй экземпляр с тем же токеном ждет, пока освободится аренда ведущего.
+    # Цикл событий остается текущим: в нем же затем работает Telegram
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(wait_for_leader_lease())
+    except KeyboardInterrupt:
+        print("Бот остановлен")
+        return
 
     # Выводим сообщение о запуске бота
     print("=" * 50)
@@ -1315,45 +5739,108 @@ def main():
     print(f"🔍 Ключевых слов: {len(get_keywords())}")
     print(f"💬 Чатов для уведомлений: {len(get_all_chats())}")
 
-    # Статистика Excel файлов
-    excel_posts, excel_comments = get_excel_stats()
-    print(f"📁 Постов в Excel: {excel_posts}")
-    print(f"📁 Комментариев в Excel: {excel_comments}")
-
-    print("⏰ Автопроверка каждые 10 минут")
+    print(f"⏰ Автопроверка каждые {format_duration(CHECK_INTERVAL)}")
+    if TELEGRAM_MODE == 'webhook':
+        print(f"🌐 Webhook: {WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH} (порт {WEBHOOK_PORT})")
     print("=" * 50)
     print("📝 Ожидание проверки...")
     print("=" * 50)
 
     try:
         # Создаем Application с включенным JobQueue
-        application = Application.builder().token(TELEGRAM_TOKEN).build()
+        builder = (
+            Application.builder()
+            .token(TELEGRAM_TOKEN)
+            .post_init(on_post_init)
+            .post_stop(on_post_stop)
+        )
+        if TELEGRAM_API_URL:
+            builder = builder.base_url(f"{TELEGRAM_API_URL}/bot").base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+        application = builder.build()
 
         # Хендлеры
         application.add_handler(CommandHandler("start", start))
         application.add_handler(CommandHandler("keyboard", keyboard_command))
+        application.add_handler(CommandHandler("search", search_command))
+        application.add_handler(CommandHandler("subscribe", subscribe_command))
+        application.add_handler(CommandHandler("unsubscribe", unsubscribe_command))
+        application.add_handler(CommandHandler("subscriptions", subscriptions_command))
+        application.add_handler(CommandHandler("groupcfg", groupcfg_command))
+        application.add_handler(CommandHandler("quarantine", quarantine_command))
+        application.add_handler(CommandHandler("memory", memory_command))
         application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+        application.add_handler(MessageHandler(filters.Document.ALL, handle_document))
 
-        # Периодическая проверка каждые 10 минут
         job_queue = application.job_queue
+
+        # Подготовка Excel файлов и проверка VK API после начала приема сообщений
+        job_queue.run_once(warm_up, when=1, name="warm_up")
+
+        # Очистка устаревших данных раз в час и ежедневное обслуживание
         job_queue.run_repeating(
-            periodic_check,
-            interval=600,
-            first=10,
-            name="periodic_vk_check",
-            job_kwargs={
-                'misfire_grace_time': 300,
-                'coalesce': True,
-                'max_instances': 1
-            }
+            archive_maintenance,
+            interval=3600,
+            first=60,
+            name="archive_maintenance"
         )
 
+        if WORKER_MODE == 'frontend':
+            # Проверку выполняют воркеры, здесь только доставка их результатов
+            job_queue.run_repeating(
+                deliver_outbox,
+                interval=5,
+                first=5,
+                name="deliver_outbox",
+                job_kwargs={
+                    'coalesce': True,
+                    'max_instances': 1
+                }
+            )
+        else:
+            # Загрузка истории новых групп в фоне
+            job_queue.run_repeating(
+                historical_backfill,
+                interval=60,
+                first=30,
+                name="historical_backfill",
+                job_kwargs={
+                    'coalesce': True,
+                    'max_instances': 1
+                }
+            )
+
+            # Периодическая проверка каждые CHECK_INTERVAL секунд
+            job_queue.run_repeating(
+                periodic_check,
+                interval=CHECK_INTERVAL,
+                first=10,
+                name="periodic_vk_check",
+                job_kwargs={
+                    'misfire_grace_time': 300,
+                    'coalesce': True,
+                    'max_instances': 1
+                }
+            )
+
         # Запускаем бота с обработкой ошибок
-        application.run_polling(
-            poll_interval=1,
-            timeout=30,
-            drop_pending_updates=True
-        )
+        # Сигналы остановки обрабатывает request_shutdown (см. on_post_init)
+        if TELEGRAM_MODE == 'webhook':
+            application.run_webhook(
+                listen=WEBHOOK_LISTEN,
+                port=WEBHOOK_PORT,
+                url_path=WEBHOOK_PATH,
+                webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET,
+                drop_pending_updates=True,
+                stop_signals=None
+            )
+        else:
+            application.run_polling(
+                poll_interval=1,
+                timeout=30,
+                drop_pending_updates=True,
+                stop_signals=None
+            )
 
     except NetworkError as e:
         print(f"Сетевая ошибка: {e}")
@@ -1362,6 +5849,8 @@ def main():
         print(f"Ошибка: {e}")
 
     finally:
+        shutdown_match_pool()
+        release_leader_lease()
         print("Бот остановлен")
 
 